@@ -20,10 +20,21 @@ from datetime import datetime
 from dotenv import load_dotenv
 import pvporcupine
 import pyaudio
-import struct
 import numpy as np
 import webrtcvad
 import collections
+import itertools
+import concurrent.futures
+import queue
+import argparse
+import base64
+import gzip
+import hashlib
+import shutil
+import tempfile
+import http.server
+import urllib.request
+import urllib.error
 from array import array
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, 
                            QVBoxLayout, QLabel, QScrollArea, QFrame,
@@ -40,14 +51,76 @@ from PyQt6.QtGui import (QPainter, QColor, QPainterPath, QLinearGradient,
                         QFontDatabase, QFont, QImage, QPixmap)
 import random
 import re
+import difflib
 import pygame
 
 # Load environment variables
 load_dotenv()
 
+class ModelRegistry:
+    """Shared pool of GenerativeModel clients keyed by model name, generation config, safety settings and tools"""
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _make_key(self, model_name, generation_config, safety_settings, tools=None):
+        return (
+            model_name,
+            json.dumps(generation_config, sort_keys=True, default=str) if generation_config else None,
+            json.dumps(safety_settings, sort_keys=True, default=str) if safety_settings else None,
+            json.dumps(tools, sort_keys=True, default=str) if tools else None
+        )
+
+    def get_model(self, model_name, generation_config=None, safety_settings=None, tools=None):
+        """Return a pooled model client, building it only the first time a key is seen"""
+        key = self._make_key(model_name, generation_config, safety_settings, tools)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                print(f"Debug: Creating pooled model client for {model_name}")
+                model = genai.GenerativeModel(
+                    model_name=model_name,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                    tools=tools
+                )
+                self._models[key] = model
+            return model
+
+    def invalidate(self, model_name=None):
+        """Drop pooled clients (all of them, or only those for one model) so they are rebuilt on next use"""
+        with self._lock:
+            if model_name is None:
+                self._models.clear()
+            else:
+                for key in [k for k in self._models if k[0] == model_name]:
+                    del self._models[key]
+
+    def switch_model(self, old_model, new_model):
+        """Move the pool from old_model to new_model and return the model now in use
+
+        new_model must be a known Gemini model whose client builds; otherwise the old pooled clients
+        are kept and old_model stays in use.
+        """
+        if not new_model or new_model == old_model:
+            return old_model
+        if get_valid_model_name(new_model) != new_model:
+            print(f"Debug: Unknown model '{new_model}', keeping {old_model}")
+            return old_model
+        try:
+            self.get_model(new_model)
+        except Exception as e:
+            print(f"Debug: Could not build a client for {new_model}, keeping {old_model}: {str(e)}")
+            return old_model
+        # Drop the old model's clients only once the new one is ready; they are rebuilt if it is used again
+        self.invalidate(old_model)
+        return new_model
+
+model_registry = ModelRegistry()
+
 def initialize_gemini(api_key):
     """Initialize Gemini AI with proper error handling"""
-    global gemini_initialized
+    global gemini_initialized, gemini_api_key
     try:
         if not api_key or not isinstance(api_key, str) or len(api_key.strip()) == 0:
             print("Notice: Gemini API key not provided - running in limited mode")
@@ -56,7 +129,13 @@ def initialize_gemini(api_key):
         
         # Clean the API key (remove whitespace and quotes)
         clean_key = api_key.strip().strip('"\'')
+        
+        # genai.configure() drops the cached transport, so only call it when the key actually changes
+        if gemini_initialized and clean_key == gemini_api_key:
+            return True
         genai.configure(api_key=clean_key)
+        model_registry.invalidate()  # Pooled clients are bound to the previous key
+        gemini_api_key = clean_key
         gemini_initialized = True
         return True
     except Exception as e:
@@ -71,6 +150,7 @@ def is_gemini_initialized():
 
 # Initialize global state
 gemini_initialized = False
+gemini_api_key = None
 # Initialize with empty key first (will be configured from settings)
 initialize_gemini("")
 
@@ -85,19 +165,2604 @@ class SignalEmitter(QObject):
     status_changed = pyqtSignal(str)
     animation_trigger = pyqtSignal(str)
     new_message = pyqtSignal(str, bool)  # message, is_user
+    stream_started = pyqtSignal(int)  # stream id of a streamed assistant reply that is starting
+    stream_chunk = pyqtSignal(int, str)  # stream id, partial text of the streamed reply
+    stream_finished = pyqtSignal(int, str)  # stream id, full text of the streamed reply
+    command_submitted = pyqtSignal(str, bool, object)  # command, voice, turn from a listener thread
+    ui_call = pyqtSignal(object, object)  # callable, Future to complete on the GUI thread
+
+class SentenceSplitter:
+    """Accumulate streamed text and hand back complete sentences as soon as they are finished"""
+    SENTENCE_END = re.compile(r'(?<=[.!?؟])\s+|\n+')
+
+    def __init__(self, min_length=12):
+        self.buffer = ""
+        self.min_length = min_length  # Avoid speaking tiny fragments like "Dr." on their own
+
+    def feed(self, text):
+        """Add streamed text and return the list of sentences completed by it"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in self.SENTENCE_END.finditer(self.buffer):
+            sentence = self.buffer[start:match.start()].strip()
+            if len(sentence) < self.min_length:
+                continue  # Keep short fragments attached to the next sentence
+            sentences.append(sentence)
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        """Return whatever is left once the stream has ended"""
+        remainder = self.buffer.strip()
+        self.buffer = ""
+        return [remainder] if remainder else []
+
+class ResponseBudget:
+    """Per-channel answer budgets: a short spoken summary for TTS and a bounded full answer for the chat"""
+    DELIMITER = re.compile(r'^[ \t]*-{3,}[ \t]*$', re.MULTILINE)
+    # A trailing partial line that could still turn into the delimiter while streaming
+    PENDING_DELIMITER = re.compile(r'\n[ \t]*-{0,3}[ \t]*$')
+
+    def __init__(self, spoken_words=35, chat_words=250, tokens_per_word=1.5, enabled=True):
+        self.spoken_words = spoken_words
+        self.chat_words = chat_words
+        self.tokens_per_word = tokens_per_word
+        self.enabled = enabled
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            spoken_words=settings.get('spoken_budget_words', 35),
+            chat_words=settings.get('chat_budget_words', 250),
+            enabled=settings.get('response_budgets', True),
+        )
+
+    def max_output_tokens(self):
+        return int((self.spoken_words + self.chat_words) * self.tokens_per_word) + 16
+
+    def scaled(self, factor):
+        """A tighter budget for when a turn is running out of time"""
+        return ResponseBudget(max(8, int(self.spoken_words * factor)), max(30, int(self.chat_words * factor)),
+                              self.tokens_per_word, self.enabled)
+
+    def generation_config(self, base=None, extra_tokens=0):
+        """Generation config capping the reply at the combined spoken and chat budget
+
+        extra_tokens leaves room for output that is not answer text, such as the keys and quoting of a JSON reply.
+        """
+        config = dict(base or {})
+        if self.enabled:
+            cap = self.max_output_tokens() + extra_tokens
+            config['max_output_tokens'] = min(config.get('max_output_tokens', cap), cap)
+        return config or None
+
+    def shape_prompt(self, prompt):
+        """Ask for a short spoken summary first, then the details for the chat after a --- line"""
+        if not self.enabled:
+            return prompt
+        return (
+            f"{prompt}\n\n"
+            f"(Start with a spoken answer of at most {self.spoken_words} words in plain sentences, without markdown. "
+            f"If more detail would help, add a line containing only --- and then the full answer "
+            f"in at most {self.chat_words} words. Otherwise stop after the spoken answer.)"
+        )
+
+    def split(self, text):
+        """Return (spoken, chat) text for a shaped reply"""
+        match = self.DELIMITER.search(text)
+        if not match:
+            return text.strip(), text.strip()
+        spoken = text[:match.start()].strip()
+        details = text[match.end():].strip()
+        return spoken, f"{spoken}\n\n{details}" if details else spoken
+
+    def speakable_prefix(self, text):
+        """Length of streamed text that is safe to speak: stops at the delimiter and holds back a partial one"""
+        match = self.DELIMITER.search(text)
+        if match:
+            return match.start(), True
+        pending = self.PENDING_DELIMITER.search(text)
+        return (pending.start() if pending else len(text)), False
+
+class ConversationSession:
+    """Rolling multi-turn history for one user, kept under a token budget by compacting old turns into a summary"""
+    def __init__(self, user_id='default', token_budget=2000, keep_recent_turns=4):
+        self.user_id = user_id
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns  # Exchanges kept verbatim after compaction
+        self.max_turn_tokens = token_budget // 4  # Cap on a single stored turn
+        self.max_summary_tokens = token_budget // 4
+        self.summary = ""
+        self.turns = []  # [{'role': 'user' | 'model', 'text': str}]
+        self.generation = 0  # Bumped by clear() so a compaction that started before it is discarded
+        self.compacting = False  # Only one compaction runs at a time
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate_tokens(text):
+        """Rough token estimate (about 4 characters per token)"""
+        return max(1, len(text) // 4)
+
+    def _clip(self, text, max_tokens):
+        max_chars = max_tokens * 4
+        return text if len(text) <= max_chars else text[:max_chars].rsplit(' ', 1)[0] + "..."
+
+    def history_tokens(self):
+        with self.lock:
+            return self.estimate_tokens(self.summary) + sum(self.estimate_tokens(t['text']) for t in self.turns)
+
+    def build_contents(self, prompt):
+        """Build the multi-turn contents list for generate_content"""
+        contents = []
+        with self.lock:
+            if self.summary:
+                contents.append({'role': 'user', 'parts': [f"Summary of our conversation so far: {self.summary}"]})
+                contents.append({'role': 'model', 'parts': ["Understood, I'll keep that in mind."]})
+            for turn in self.turns:
+                contents.append({'role': turn['role'], 'parts': [turn['text']]})
+        contents.append({'role': 'user', 'parts': [prompt]})
+        return contents
+
+    def add_exchange(self, prompt, reply):
+        """Record a completed user/assistant exchange"""
+        with self.lock:
+            self.turns.append({'role': 'user', 'text': self._clip(prompt, self.max_turn_tokens)})
+            self.turns.append({'role': 'model', 'text': self._clip(reply, self.max_turn_tokens)})
+
+    def needs_compaction(self):
+        return self.history_tokens() > self.token_budget
+
+    def compact(self, summarizer=None):
+        """Fold the oldest turns into the summary until the history fits the budget again"""
+        if not self.needs_compaction():
+            return False
+        with self.lock:
+            if self.compacting:
+                return False
+            self.compacting = True
+            generation = self.generation
+            # Keep the newest turns verbatim while they fit in what the summary leaves of the budget
+            keep = 0
+            recent_tokens = 0
+            for turn in reversed(self.turns):
+                turn_tokens = self.estimate_tokens(turn['text'])
+                if keep >= self.keep_recent_turns * 2 or recent_tokens + turn_tokens > self.token_budget - self.max_summary_tokens:
+                    break
+                keep += 1
+                recent_tokens += turn_tokens
+            keep -= keep % 2  # Never split a user/assistant exchange
+            old_turns = self.turns[:len(self.turns) - keep]
+            previous_summary = self.summary
+        try:
+            if not old_turns:
+                return False
+
+            new_summary = None
+            if summarizer:
+                try:
+                    new_summary = summarizer(previous_summary, old_turns)
+                except Exception as e:
+                    print(f"Debug: Summarizer failed, using local compaction: {str(e)}")
+            if not new_summary:
+                # Local fallback: keep the first sentence of every compacted turn
+                points = [f"{'User' if t['role'] == 'user' else 'Assistant'}: {t['text'].split('. ')[0]}" for t in old_turns]
+                new_summary = " ".join(filter(None, [previous_summary] + points))
+
+            with self.lock:
+                if self.generation != generation:
+                    return False  # Cleared while summarizing; the old turns are gone already
+                # Turns are only appended while compacting, so the compacted ones are still
+                # at the front and anything added while summarizing is kept
+                self.turns = self.turns[len(old_turns):]
+                # Keep the most recent part of the summary if it grew past its own budget
+                max_chars = self.max_summary_tokens * 4
+                new_summary = new_summary.strip()
+                if len(new_summary) > max_chars:
+                    new_summary = new_summary[-max_chars:].split(' ', 1)[-1]
+                self.summary = new_summary
+            return True
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def clear(self):
+        with self.lock:
+            self.summary = ""
+            self.turns = []
+            self.generation += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {'summary': self.summary, 'turns': list(self.turns), 'updated': time.time()}
+
+class SessionStore:
+    """Persist conversation sessions per user in sessions.json"""
+    def __init__(self, path='sessions.json'):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _read_all(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Debug: Error reading sessions file: {str(e)}")
+            return {}
+
+    def load(self, user_id='default', token_budget=2000):
+        """Load a user's session, or start an empty one"""
+        session = ConversationSession(user_id, token_budget=token_budget)
+        with self.lock:
+            data = self._read_all().get(user_id)
+        if data:
+            session.summary = data.get('summary', '')
+            session.turns = data.get('turns', [])
+        return session
+
+    def save(self, session):
+        with self.lock:
+            sessions = self._read_all()
+            sessions[session.user_id] = session.to_dict()
+            try:
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    json.dump(sessions, f, indent=4, ensure_ascii=False)
+            except Exception as e:
+                print(f"Debug: Error saving sessions file: {str(e)}")
+
+class ResponseCache:
+    """LRU cache of LLM answers keyed by normalized prompt and model, with per-entry TTL and on-disk persistence"""
+    # Prompts whose answers go stale quickly get a much shorter lifetime
+    VOLATILE_WORDS = {'weather', 'time', 'today', 'tomorrow', 'tonight', 'now', 'news', 'latest', 'current', 'date'}
+    # Follow-ups only make sense with the conversation context, so they are never served from cache
+    FOLLOW_UP_PREFIXES = ('and ', 'what about', 'how about', 'also ', 'then ', 'why')
+    FOLLOW_UP_WORDS = {'it', 'that', 'this', 'they', 'them', 'he', 'she', 'those', 'these', 'again', 'more'}
+
+    def __init__(self, path='response_cache.json', max_entries=500, ttl=6 * 3600, volatile_ttl=600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.volatile_ttl = volatile_ttl
+        self.entries = collections.OrderedDict()  # key -> [expires_at, response]
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # One writer at a time, so an older snapshot never replaces a newer one
+        self.last_save = 0
+        self.save_interval = 5  # Seconds between writes to disk
+        self.load()
+
+    @staticmethod
+    def normalize(prompt):
+        """Lowercase, drop punctuation and collapse whitespace"""
+        text = re.sub(r"[^\w\s]", "", prompt.lower())
+        return " ".join(text.split())
+
+    def make_key(self, prompt, model_name):
+        return f"{model_name}|{self.normalize(prompt)}"
+
+    def is_cacheable(self, prompt):
+        """Check that a prompt stands on its own and does not refer back to the conversation"""
+        normalized = self.normalize(prompt)
+        if not normalized or normalized.startswith(self.FOLLOW_UP_PREFIXES):
+            return False
+        return not (set(normalized.split()) & self.FOLLOW_UP_WORDS)
+
+    def get(self, prompt, model_name):
+        """Return the cached answer, or None on a miss or an expired entry"""
+        key = self.make_key(prompt, model_name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, prompt, model_name, response, ttl=None):
+        if ttl is None:
+            volatile = set(self.normalize(prompt).split()) & self.VOLATILE_WORDS
+            ttl = self.volatile_ttl if volatile else self.ttl
+        key = self.make_key(prompt, model_name)
+        with self.lock:
+            self.entries[key] = [time.time() + ttl, response]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            # Claim the save under the lock so concurrent puts don't all write the file
+            save_due = time.time() - self.last_save > self.save_interval
+            if save_due:
+                self.last_save = time.time()
+        if save_due:
+            self.save()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self.entries)
+            }
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            with self.lock:
+                for key, expires_at, response in data:
+                    if expires_at > now:
+                        self.entries[key] = [expires_at, response]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Debug: Error loading response cache: {str(e)}")
+
+    def save(self):
+        """Write live entries to disk in a compact form (atomic replace)"""
+        with self.save_lock:
+            now = time.time()
+            with self.lock:
+                data = [[key, entry[0], entry[1]] for key, entry in self.entries.items() if entry[0] > now]
+                self.last_save = now
+            temp_path = None
+            try:
+                # A temp file of our own next to the cache, so os.replace stays on one filesystem
+                fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                                 suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.path)))
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                print(f"Debug: Error saving response cache: {str(e)}")
+                if temp_path and os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+class CancelToken:
+    """Cooperative cancellation flag handed to a running command"""
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []  # Run once on cancel, e.g. to close a connection a worker is blocked on
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Debug: Cancel callback failed: {str(e)}")
+
+    def add_callback(self, callback):
+        """Call callback when the token is cancelled, or right away if it already is"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def wait(self, timeout):
+        """Sleep for up to timeout seconds, waking early on cancel; returns True if cancelled"""
+        return self._event.wait(timeout)
+
+class TurnDeadline:
+    """Time budget for one voice turn, started at the wake word and consumed by capture, STT, routing, LLM and TTS"""
+    def __init__(self, budget=25.0, low_threshold=6.0):
+        self.budget = budget
+        self.low_threshold = low_threshold  # Below this many seconds, stages switch to cheaper fallbacks
+        self.started = time.monotonic()
+        self.expires_at = self.started + budget
+        self.stages = []
+        self._stage_started = self.started
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def is_low(self):
+        return self.remaining() < self.low_threshold
+
+    def take(self, wanted, reserve=0.0, minimum=0.0):
+        """Seconds a stage may use: what it wants, capped so `reserve` is left for the stages after it"""
+        return max(minimum, min(wanted, self.remaining() - reserve))
+
+    def mark(self, stage):
+        """Record how long the stage that just finished took"""
+        now = time.monotonic()
+        self.stages.append((stage, now - self._stage_started))
+        self._stage_started = now
+
+    def summary(self):
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.stages)
+        return f"{stages} ({self.remaining():.1f}s of {self.budget:.0f}s left)"
+
+class CircuitOpenError(Exception):
+    """Raised when the LLM backend keeps failing and calls are being failed fast"""
+    pass
+
+class CircuitBreaker:
+    """Open after repeated failures, then let a single trial call through once the reset timeout passes"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN  # Let one trial call through
+                return True
+            if self.state == self.HALF_OPEN:
+                return False  # A trial call is already in flight
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def release_trial(self):
+        """End a half-open trial that said nothing about the service's health; the next call is a new trial"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"Debug: Circuit breaker opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+class ResilientCaller:
+    """Per-call deadlines, jittered exponential backoff on retryable errors and a circuit breaker around LLM calls"""
+    # google.api_core exception class names and HTTP codes that are worth retrying
+    RETRYABLE_ERRORS = {'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+                        'DeadlineExceeded', 'GatewayTimeout', 'BadGateway', 'Aborted', 'RetryError'}
+    RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+    # Requests the service rejected as invalid; they say nothing about its health
+    CLIENT_ERRORS = {'InvalidArgument', 'BadRequest', 'Unauthenticated', 'Unauthorized', 'PermissionDenied',
+                     'Forbidden', 'NotFound', 'FailedPrecondition', 'OutOfRange'}
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=8.0, deadline=30.0, breaker=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def is_retryable(self, error):
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        if type(error).__name__ in self.RETRYABLE_ERRORS:
+            return True
+        return getattr(error, 'code', None) in self.RETRYABLE_CODES
+
+    def is_client_error(self, error):
+        if type(error).__name__ in self.CLIENT_ERRORS:
+            return True
+        code = getattr(error, 'code', None)
+        return isinstance(code, int) and 400 <= code < 500 and code not in self.RETRYABLE_CODES
+
+    def backoff_delay(self, attempt):
+        """Full-jitter exponential backoff"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _attempts(self, deadline, cancel_token):
+        """Yield the remaining time budget for each allowed attempt"""
+        deadline_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+        for attempt in range(self.max_retries + 1):
+            # Check the budget first: allow() may start a half-open trial that must then be settled
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                self._count('deadline_exceeded')
+                raise TimeoutError("LLM request deadline exceeded")
+            if not self.breaker.allow():
+                self._count('short_circuited')
+                raise CircuitOpenError("The AI service is failing repeatedly; not sending requests for a moment")
+            if attempt:
+                self._count('retries')
+            self._count('calls')
+            yield attempt, remaining, deadline_at
+
+    def _handle_failure(self, error, attempt, deadline_at, cancel_token):
+        """Record a failure and sleep before the next attempt, or re-raise if it should not be retried"""
+        if cancel_token and cancel_token.is_cancelled():
+            # The caller dropped the request (e.g. closed its connection); that says nothing about the service
+            self.breaker.release_trial()
+            raise error
+        self._count('failures')
+        if self.is_client_error(error):
+            # The service rejected the request itself; that neither opens nor closes the circuit
+            self.breaker.release_trial()
+            raise error
+        self.breaker.record_failure()
+        if not self.is_retryable(error) or attempt >= self.max_retries:
+            raise error
+        delay = min(self.backoff_delay(attempt), max(0, deadline_at - time.monotonic()))
+        print(f"Debug: Retryable LLM error ({type(error).__name__}), retrying in {delay:.2f}s")
+        if cancel_token and cancel_token.wait(delay):
+            raise error
+        elif not cancel_token:
+            time.sleep(delay)
+
+    def call(self, fn, deadline=None, cancel_token=None, call_info=None):
+        """Call fn(timeout) with retries; fn must honour the remaining-time timeout it is given"""
+        for attempt, remaining, deadline_at in self._attempts(deadline, cancel_token):
+            if call_info is not None:
+                call_info['retries'] = attempt
+            try:
+                result = fn(remaining)
+            except Exception as e:
+                self._handle_failure(e, attempt, deadline_at, cancel_token)
+                continue
+            self._count('successes')
+            self.breaker.record_success()
+            return result
+
+    def call_stream(self, fn, deadline=None, cancel_token=None, call_info=None):
+        """Like call() for streaming fn(timeout); retries only until the first chunk has arrived"""
+        for attempt, remaining, deadline_at in self._attempts(deadline, cancel_token):
+            if call_info is not None:
+                call_info['retries'] = attempt
+            try:
+                iterator = iter(fn(remaining))
+                first_chunk = next(iterator, None)
+            except Exception as e:
+                self._handle_failure(e, attempt, deadline_at, cancel_token)
+                continue
+            break
+        # The backend has answered; a consumer that stops reading early must not leave the breaker half-open
+        self._count('successes')
+        self.breaker.record_success()
+        if first_chunk is not None:
+            yield first_chunk
+        try:
+            for chunk in iterator:
+                yield chunk
+        except Exception as e:
+            if cancel_token and cancel_token.is_cancelled():
+                raise
+            self._count('stream_failures')
+            if not self.is_client_error(e):
+                self.breaker.record_failure()
+            raise
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.counters)
+        metrics['circuit_state'] = self.breaker.state
+        return metrics
+
+# Shared resilience wrapper used for every generate_content call
+llm_caller = ResilientCaller()
+
+class LLMResponse:
+    """Backend-neutral LLM result (a whole reply, or one streamed chunk of it)"""
+    def __init__(self, text, prompt_tokens=None, response_tokens=None, model_name=None, function_calls=None):
+        self.text = text or ""
+        self.prompt_tokens = prompt_tokens
+        self.response_tokens = response_tokens
+        self.model_name = model_name
+        self.function_calls = function_calls or []  # [(name, args dict)] requested by the model
+
+class LLMBackend:
+    """Interface implemented by every LLM backend
+
+    contents is either a prompt string or a list of {'role': 'user' | 'model', 'parts': [...]} turns.
+    parts for generate_multimodal is a list of strings, PIL images or {'mime_type', 'data'} blobs.
+    tools is a list of {'function_declarations': [...]} in the Gemini format.
+    stream gets the request's cancel_token so it can drop the connection as soon as the request is abandoned.
+    """
+    name = 'base'
+
+    def is_available(self):
+        return True
+
+    def generate(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None):
+        raise NotImplementedError
+
+    def stream(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None,
+               cancel_token=None):
+        raise NotImplementedError
+
+    def generate_multimodal(self, parts, model_name=None, generation_config=None, safety_settings=None, timeout=None):
+        raise NotImplementedError
+
+    @staticmethod
+    def contents_to_messages(contents):
+        """Normalize contents to a list of (role, text) pairs"""
+        if isinstance(contents, str):
+            return [('user', contents)]
+        messages = []
+        for item in contents:
+            if isinstance(item, dict):
+                text = " ".join(str(part) for part in item.get('parts', []) if isinstance(part, str))
+                messages.append((item.get('role', 'user'), text))
+            elif isinstance(item, str):
+                messages.append(('user', item))
+        return messages
+
+class GeminiBackend(LLMBackend):
+    """google.generativeai backend using the pooled model clients"""
+    name = 'gemini'
+
+    def __init__(self, api_key=''):
+        self.api_key = api_key
+
+    def is_available(self):
+        return initialize_gemini(self.api_key) if self.api_key else is_gemini_initialized()
+
+    def _model(self, model_name, generation_config, safety_settings, tools=None):
+        return model_registry.get_model(model_name, generation_config=generation_config, safety_settings=safety_settings,
+                                        tools=tools)
+
+    @staticmethod
+    def _to_response(response, model_name):
+        parts = []
+        candidates = getattr(response, 'candidates', None) or []
+        if candidates and getattr(candidates[0], 'content', None):
+            parts = candidates[0].content.parts
+        function_calls = [
+            (part.function_call.name, dict(part.function_call.args or {}))
+            for part in parts if 'function_call' in part and part.function_call.name
+        ]
+        try:
+            text = response.text
+        except ValueError:
+            # Blocked or empty candidate, or a function call without text
+            text = "".join(part.text for part in parts if 'text' in part)
+        usage = getattr(response, 'usage_metadata', None)
+        return LLMResponse(
+            text,
+            prompt_tokens=getattr(usage, 'prompt_token_count', None) if usage else None,
+            response_tokens=getattr(usage, 'candidates_token_count', None) if usage else None,
+            model_name=model_name,
+            function_calls=function_calls
+        )
+
+    def generate(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None):
+        model_name = get_valid_model_name(model_name or 'gemini-2.0-flash')
+        model = self._model(model_name, generation_config, safety_settings, tools)
+        response = model.generate_content(contents, request_options={"timeout": timeout} if timeout else None)
+        return self._to_response(response, model_name)
+
+    def stream(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None,
+               cancel_token=None):
+        model_name = get_valid_model_name(model_name or 'gemini-2.0-flash')
+        model = self._model(model_name, generation_config, safety_settings, tools)
+        response = model.generate_content(contents, stream=True, request_options={"timeout": timeout} if timeout else None)
+        for chunk in response:
+            if cancel_token and cancel_token.is_cancelled():
+                return  # Closing the generator closes the response stream
+            yield self._to_response(chunk, model_name)
+
+    def generate_multimodal(self, parts, model_name=None, generation_config=None, safety_settings=None, timeout=None):
+        return self.generate(parts, model_name, generation_config, safety_settings, timeout)
+
+class LocalHTTPBackend(LLMBackend):
+    """OpenAI-compatible chat completions endpoint (llama.cpp server, vLLM, Ollama, ...)"""
+    name = 'local'
+
+    def __init__(self, base_url='http://127.0.0.1:8080/v1', model=None, api_key=''):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.api_key = api_key
+
+    def _messages(self, contents):
+        return [{'role': 'assistant' if role == 'model' else role, 'content': text}
+                for role, text in self.contents_to_messages(contents)]
+
+    @staticmethod
+    def _image_part(part):
+        if isinstance(part, dict):
+            mime_type, data = part['mime_type'], part['data']
+        else:
+            buffer = io.BytesIO()
+            part.convert('RGB').save(buffer, format='JPEG', quality=85)
+            mime_type, data = 'image/jpeg', buffer.getvalue()
+        url = f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+        return {'type': 'image_url', 'image_url': {'url': url}}
+
+    def _payload(self, messages, model_name, generation_config, stream, tools=None):
+        config = generation_config or {}
+        payload = {'model': self.model or model_name or 'local', 'messages': messages, 'stream': stream}
+        if tools:
+            payload['tools'] = [{'type': 'function', 'function': declaration}
+                                for tool in tools for declaration in tool.get('function_declarations', [])]
+        if 'temperature' in config:
+            payload['temperature'] = config['temperature']
+        if 'top_p' in config:
+            payload['top_p'] = config['top_p']
+        if 'max_output_tokens' in config:
+            payload['max_tokens'] = config['max_output_tokens']
+        return payload
+
+    def _open(self, payload, timeout):
+        request = urllib.request.Request(
+            f"{self.base_url}/chat/completions",
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}
+        )
+        if self.api_key:
+            request.add_header('Authorization', f"Bearer {self.api_key}")
+        try:
+            return urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError:
+            raise  # Carries .code, so the retry policy can tell 429/5xx from client errors
+        except urllib.error.URLError as e:
+            raise ConnectionError(f"Local LLM endpoint unreachable: {e.reason}")
+
+    @staticmethod
+    def _function_calls(tool_calls):
+        calls = []
+        for tool_call in tool_calls or []:
+            function = tool_call.get('function') or {}
+            try:
+                args = json.loads(function.get('arguments') or '{}')
+            except ValueError:
+                args = {}
+            calls.append((function.get('name'), args))
+        return calls
+
+    def _complete(self, messages, model_name, generation_config, timeout, tools=None):
+        payload = self._payload(messages, model_name, generation_config, stream=False, tools=tools)
+        with self._open(payload, timeout) as response:
+            data = json.loads(response.read().decode('utf-8'))
+        usage = data.get('usage') or {}
+        message = data['choices'][0]['message']
+        return LLMResponse(
+            message.get('content') or '',
+            prompt_tokens=usage.get('prompt_tokens'),
+            response_tokens=usage.get('completion_tokens'),
+            model_name=data.get('model', payload['model']),
+            function_calls=self._function_calls(message.get('tool_calls'))
+        )
+
+    def generate(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None):
+        return self._complete(self._messages(contents), model_name, generation_config, timeout, tools)
+
+    def stream(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None,
+               cancel_token=None):
+        payload = self._payload(self._messages(contents), model_name, generation_config, stream=True, tools=tools)
+        tool_calls = {}  # Streamed tool calls arrive in fragments keyed by index
+        with self._open(payload, timeout) as response:
+            if cancel_token:
+                # Closing the socket wakes a read that is still waiting for the first token
+                cancel_token.add_callback(response.close)
+            for raw_line in response:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                event = json.loads(data)
+                usage = event.get('usage') or {}
+                choices = event.get('choices') or [{}]
+                delta = choices[0].get('delta') or {}
+                for fragment in delta.get('tool_calls') or []:
+                    call = tool_calls.setdefault(fragment.get('index', 0), {'name': '', 'arguments': ''})
+                    function = fragment.get('function') or {}
+                    call['name'] += function.get('name') or ''
+                    call['arguments'] += function.get('arguments') or ''
+                yield LLMResponse(
+                    delta.get('content') or '',
+                    prompt_tokens=usage.get('prompt_tokens'),
+                    response_tokens=usage.get('completion_tokens'),
+                    model_name=event.get('model', payload['model'])
+                )
+        if tool_calls:
+            yield LLMResponse("", model_name=payload['model'], function_calls=self._function_calls(
+                [{'function': tool_calls[index]} for index in sorted(tool_calls)]))
+
+    def generate_multimodal(self, parts, model_name=None, generation_config=None, safety_settings=None, timeout=None):
+        content = [{'type': 'text', 'text': part} if isinstance(part, str) else self._image_part(part) for part in parts]
+        return self._complete([{'role': 'user', 'content': content}], model_name, generation_config, timeout)
+
+class FakeBackend(LLMBackend):
+    """Deterministic offline backend with configurable latency, for benchmarks and CI"""
+    name = 'fake'
+
+    def __init__(self, first_token_latency=0.2, token_latency=0.02, responses=None):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.responses = responses or {}  # Normalized prompt -> canned reply, or {'name', 'args'} for a function call
+
+    def reply_for(self, contents, tools=None):
+        messages = self.contents_to_messages(contents)
+        prompt = messages[-1][1] if messages else ""
+        canned = self.responses.get(ResponseCache.normalize(prompt))
+        if isinstance(canned, dict) and not tools:
+            canned = None  # Function calls are only returned when tools are offered
+        if canned:
+            return prompt, canned
+        return prompt, f"You asked: {prompt.strip()}. This is a deterministic reply from the offline test backend."
+
+    def _usage(self, prompt, text):
+        return len(prompt.split()), len(text.split())
+
+    def _function_call(self, call, model_name):
+        time.sleep(self.first_token_latency)
+        return LLMResponse("", model_name=model_name or 'fake', function_calls=[(call['name'], dict(call.get('args') or {}))])
+
+    def generate(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None):
+        prompt, text = self.reply_for(contents, tools)
+        if isinstance(text, dict):
+            return self._function_call(text, model_name)
+        words = text.split(' ')
+        time.sleep(self.first_token_latency + self.token_latency * (len(words) - 1))
+        prompt_tokens, response_tokens = self._usage(prompt, text)
+        return LLMResponse(text, prompt_tokens, response_tokens, model_name or 'fake')
+
+    def stream(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None,
+               cancel_token=None):
+        prompt, text = self.reply_for(contents, tools)
+        if isinstance(text, dict):
+            yield self._function_call(text, model_name)
+            return
+        words = text.split(' ')
+        if cancel_token and cancel_token.wait(self.first_token_latency):
+            return
+        elif not cancel_token:
+            time.sleep(self.first_token_latency)
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(self.token_latency)
+            last = index == len(words) - 1
+            prompt_tokens, response_tokens = self._usage(prompt, text) if last else (None, None)
+            yield LLMResponse(word + ('' if last else ' '), prompt_tokens, response_tokens, model_name or 'fake')
+
+    def generate_multimodal(self, parts, model_name=None, generation_config=None, safety_settings=None, timeout=None):
+        images = sum(1 for part in parts if not isinstance(part, str))
+        text_prompt = " ".join(part for part in parts if isinstance(part, str))
+        return self.generate(f"{text_prompt} [{images} image(s)]", model_name, generation_config, safety_settings, timeout)
+
+class CassetteBackend(LLMBackend):
+    """Records every request/response of another backend to a gzip JSONL cassette, or replays one offline
+
+    Requests are keyed by model, contents (images by SHA-256 digest), generation config and tools.
+    Replay serves recordings for a key in order and sleeps for the recorded latencies unless
+    replay_latency is 'zero'.
+    """
+    name = 'cassette'
+
+    def __init__(self, path, mode='record', inner=None, replay_latency='original'):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode '{mode}'")
+        if mode == 'record' and inner is None:
+            raise ValueError("Recording needs a backend to record")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        self.replay_latency = replay_latency
+        self.name = f"{inner.name}+record" if mode == 'record' else 'replay'
+        self.lock = threading.Lock()
+        self.entries = collections.defaultdict(list)
+        self.positions = collections.Counter()
+        if mode == 'replay':
+            self.load()
+
+    @classmethod
+    def describe(cls, value):
+        """JSON-safe form of request contents with image bytes replaced by their digest"""
+        if isinstance(value, str):
+            return value
+        if isinstance(value, dict) and isinstance(value.get('data'), (bytes, bytearray)):
+            return {'mime_type': value.get('mime_type'), 'sha256': hashlib.sha256(value['data']).hexdigest()}
+        if isinstance(value, dict):
+            return {key: cls.describe(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls.describe(item) for item in value]
+        if hasattr(value, 'tobytes') and hasattr(value, 'size'):
+            return {'image': hashlib.sha256(value.tobytes()).hexdigest(), 'size': list(value.size)}
+        return value if isinstance(value, (int, float, bool)) or value is None else str(value)
+
+    def make_request(self, contents, model_name, generation_config, tools):
+        request = {
+            'model': model_name,
+            'contents': self.describe(contents),
+            'generation_config': self.describe(generation_config),
+            'tools': self.describe(tools),
+        }
+        key = hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return key, request
+
+    def load(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"Cassette not found: {self.path}")
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[entry['key']].append(entry)
+        print(f"Debug: Loaded {sum(len(v) for v in self.entries.values())} cassette entries from {self.path}")
+
+    def append(self, entry):
+        # Each append is its own gzip member; gzip readers treat concatenated members as one stream
+        with self.lock:
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def is_available(self):
+        return True if self.mode == 'replay' else self.inner.is_available()
+
+    # Recording
+
+    def _record(self, kind, key, request, started, chunks):
+        text = "".join(chunk.text for chunk, _ in chunks)
+        last = chunks[-1][0] if chunks else LLMResponse("")
+        self.append({
+            'key': key,
+            'kind': kind,
+            'request': request,
+            'recorded_at': time.time(),
+            'chunks': [{'offset': round(offset - started, 4), 'text': chunk.text} for chunk, offset in chunks],
+            'text': text,
+            'prompt_tokens': next((c.prompt_tokens for c, _ in reversed(chunks) if c.prompt_tokens is not None), None),
+            'response_tokens': next((c.response_tokens for c, _ in reversed(chunks) if c.response_tokens is not None), None),
+            'model_name': last.model_name,
+            'function_calls': [[name, args] for chunk, _ in chunks for name, args in chunk.function_calls],
+        })
+
+    def _recorded_generate(self, kind, call, contents, model_name, generation_config, tools):
+        key, request = self.make_request(contents, model_name, generation_config, tools)
+        started = time.monotonic()
+        response = call()
+        self._record(kind, key, request, started, [(response, time.monotonic())])
+        return response
+
+    # Replay
+
+    def _next_entry(self, contents, model_name, generation_config, tools):
+        key, request = self.make_request(contents, model_name, generation_config, tools)
+        with self.lock:
+            recordings = self.entries.get(key)
+            if not recordings:
+                raise LookupError(f"No cassette recording for this {request['model']} request")
+            entry = recordings[self.positions[key] % len(recordings)]
+            self.positions[key] += 1
+        return entry
+
+    def _wait_until(self, started, offset):
+        if self.replay_latency != 'zero':
+            remaining = started + offset - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def _entry_response(self, entry, text, last=True):
+        return LLMResponse(
+            text,
+            prompt_tokens=entry.get('prompt_tokens') if last else None,
+            response_tokens=entry.get('response_tokens') if last else None,
+            model_name=entry.get('model_name'),
+            function_calls=[tuple(call) for call in entry.get('function_calls', [])] if last else None
+        )
+
+    def _replay_generate(self, contents, model_name, generation_config, tools):
+        entry = self._next_entry(contents, model_name, generation_config, tools)
+        started = time.monotonic()
+        self._wait_until(started, entry['chunks'][-1]['offset'] if entry['chunks'] else 0)
+        return self._entry_response(entry, entry['text'])
+
+    def _replay_stream(self, contents, model_name, generation_config, tools):
+        entry = self._next_entry(contents, model_name, generation_config, tools)
+        started = time.monotonic()
+        chunks = entry['chunks'] or [{'offset': 0, 'text': ''}]
+        for index, chunk in enumerate(chunks):
+            self._wait_until(started, chunk['offset'])
+            yield self._entry_response(entry, chunk['text'], last=index == len(chunks) - 1)
+
+    # LLMBackend interface
+
+    def generate(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None):
+        if self.mode == 'replay':
+            return self._replay_generate(contents, model_name, generation_config, tools)
+        return self._recorded_generate(
+            'generate',
+            lambda: self.inner.generate(contents, model_name, generation_config, safety_settings, timeout=timeout, tools=tools),
+            contents, model_name, generation_config, tools
+        )
+
+    def stream(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None,
+               cancel_token=None):
+        if self.mode == 'replay':
+            yield from self._replay_stream(contents, model_name, generation_config, tools)
+            return
+        key, request = self.make_request(contents, model_name, generation_config, tools)
+        started = time.monotonic()
+        chunks = []
+        for chunk in self.inner.stream(contents, model_name, generation_config, safety_settings, timeout=timeout,
+                                       tools=tools, cancel_token=cancel_token):
+            chunks.append((chunk, time.monotonic()))
+            yield chunk
+        # Only complete streams are recorded, so replays never end early
+        self._record('stream', key, request, started, chunks)
+
+    def generate_multimodal(self, parts, model_name=None, generation_config=None, safety_settings=None, timeout=None):
+        if self.mode == 'replay':
+            return self._replay_generate(parts, model_name, generation_config, None)
+        return self._recorded_generate(
+            'multimodal',
+            lambda: self.inner.generate_multimodal(parts, model_name, generation_config, safety_settings, timeout=timeout),
+            parts, model_name, generation_config, None
+        )
+
+def create_llm_backend(settings):
+    """Build the LLM backend selected by 'llm_backend' in settings.json, wrapped in a cassette if configured"""
+    cassette_path = settings.get('llm_cassette')
+    cassette_mode = settings.get('llm_cassette_mode', 'record')
+    if cassette_path and cassette_mode == 'replay':
+        return CassetteBackend(cassette_path, 'replay', replay_latency=settings.get('llm_cassette_latency', 'original'))
+    backend = _create_base_llm_backend(settings)
+    if cassette_path:
+        return CassetteBackend(cassette_path, 'record', inner=backend)
+    return backend
+
+def _create_base_llm_backend(settings):
+    backend_name = settings.get('llm_backend', 'gemini')
+    if backend_name == 'local':
+        return LocalHTTPBackend(
+            base_url=settings.get('local_llm_url', 'http://127.0.0.1:8080/v1'),
+            model=settings.get('local_llm_model') or None,
+            api_key=settings.get('local_llm_api_key', '')
+        )
+    if backend_name == 'fake':
+        return FakeBackend(
+            first_token_latency=settings.get('fake_llm_latency', 0.2),
+            token_latency=settings.get('fake_llm_token_latency', 0.02)
+        )
+    if backend_name != 'gemini':
+        print(f"Warning: Unknown LLM backend '{backend_name}', using Gemini")
+    return GeminiBackend(settings.get('gemini_api_key', '').strip())
+
+def configure_llm_backend(settings):
+    """Switch the active LLM backend to the one selected in settings"""
+    global llm_backend
+    llm_backend = create_llm_backend(settings)
+    print(f"Debug: Using '{llm_backend.name}' LLM backend")
+    return llm_backend
+
+# Active LLM backend (configured from settings by the main window)
+llm_backend = GeminiBackend()
+
+class LLMTelemetry:
+    """In-process registry of per-request LLM metrics with percentile summaries and an optional JSONL sink"""
+    # USD per million (prompt, response) tokens
+    PRICING = {
+        'gemini-2.0-flash': (0.10, 0.40),
+        'gemini-2.0-flash-lite': (0.075, 0.30),
+        'gemini-1.5-flash': (0.075, 0.30),
+        'gemini-1.5-pro': (1.25, 5.00),
+    }
+
+    def __init__(self, max_records=2000, sink_path=None):
+        self.records = collections.deque(maxlen=max_records)
+        self.sink_path = sink_path
+        self.lock = threading.Lock()
+
+    def estimate_cost(self, model_name, prompt_tokens, response_tokens):
+        prompt_price, response_price = self.PRICING.get(model_name, (0.0, 0.0))
+        return ((prompt_tokens or 0) * prompt_price + (response_tokens or 0) * response_price) / 1_000_000
+
+    def record(self, record):
+        """Store one request record and append it to the JSONL sink if configured"""
+        record['cost_usd'] = self.estimate_cost(record.get('model'), record.get('prompt_tokens'), record.get('response_tokens'))
+        with self.lock:
+            self.records.append(record)
+            if self.sink_path:
+                try:
+                    with open(self.sink_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except Exception as e:
+                    print(f"Debug: Error writing telemetry: {str(e)}")
+
+    @staticmethod
+    def percentile(values, pct):
+        """Nearest-rank percentile of a list of numbers"""
+        if not values:
+            return None
+        ordered = sorted(values)
+        index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def select(self, model_name=None, purpose=None, window=None):
+        with self.lock:
+            records = [r for r in self.records
+                       if (model_name is None or r.get('model') == model_name)
+                       and (purpose is None or r.get('purpose') == purpose)]
+        return records[-window:] if window else records
+
+    def latency_percentile(self, model_name, pct, field='total_ms', window=200, min_samples=1):
+        """Percentile of a latency field over a model's recent successful requests (None below min_samples)"""
+        values = [r[field] for r in self.select(model_name, window=window)
+                  if r.get(field) is not None and not r.get('error') and r.get('purpose') != 'warmup']
+        if len(values) < max(1, min_samples):
+            return None
+        return self.percentile(values, pct)
+
+    def summary(self, model_name=None, purpose=None):
+        """Aggregate counts, latency percentiles, tokens and cost"""
+        records = self.select(model_name, purpose)
+        ok = [r for r in records if not r.get('error')]
+        total_ms = [r['total_ms'] for r in ok]
+        ttfb_ms = [r['ttfb_ms'] for r in ok if r.get('ttfb_ms') is not None]
+        return {
+            'requests': len(records),
+            'errors': len(records) - len(ok),
+            'retries': sum(r.get('retries', 0) for r in records),
+            'total_ms': {p: self.percentile(total_ms, p) for p in (50, 90, 99)},
+            'ttfb_ms': {p: self.percentile(ttfb_ms, p) for p in (50, 90, 99)},
+            'prompt_tokens': sum(r.get('prompt_tokens') or 0 for r in records),
+            'response_tokens': sum(r.get('response_tokens') or 0 for r in records),
+            'cost_usd': round(sum(r.get('cost_usd', 0) for r in records), 6),
+        }
+
+    def summary_by_model(self):
+        models = sorted({r.get('model') for r in self.select()} - {None})
+        return {model: self.summary(model) for model in models}
+
+# Shared telemetry registry for every LLM call
+llm_telemetry = LLMTelemetry()
+
+class ModelRouter:
+    """Route each prompt to a Gemini tier: fast for short chat and voice, strong for long, code or reasoning prompts"""
+    # Fastest first
+    TIERS = ('gemini-2.0-flash-lite', 'gemini-2.0-flash', 'gemini-1.5-flash', 'gemini-1.5-pro')
+    CODE_HINTS = ('code', 'function', 'script', 'python', 'javascript', 'sql', 'regex', 'debug', 'error:', 'traceback',
+                  'compile', 'algorithm', '```', 'def ', 'class ')
+    REASONING_HINTS = ('explain', 'why ', 'compare', 'analyze', 'analyse', 'step by step', 'prove', 'calculate',
+                       'plan ', 'difference between', 'pros and cons', 'summarize', 'summarise', 'essay', 'in detail')
+
+    def __init__(self, fast_model='gemini-2.0-flash-lite', default_model='gemini-2.0-flash', strong_model='gemini-1.5-pro',
+                 short_prompt_words=12, long_prompt_words=80, latency_budgets_ms=None, latency_percentile=90,
+                 min_samples=5, enabled=True):
+        self.models = {'fast': fast_model, 'default': default_model, 'strong': strong_model}
+        self.short_prompt_words = short_prompt_words
+        self.long_prompt_words = long_prompt_words
+        # Budget for time to first chunk per route; a tier that keeps missing it is swapped for a faster one
+        self.latency_budgets_ms = {'fast': 1200, 'default': 2500, 'strong': 6000}
+        self.latency_budgets_ms.update(latency_budgets_ms or {})
+        self.latency_percentile = latency_percentile
+        self.min_samples = min_samples
+        self.enabled = enabled
+
+    @classmethod
+    def from_settings(cls, settings):
+        default_model = get_valid_model_name(settings.get('gemini_model', 'gemini-2.0-flash'))
+        return cls(
+            fast_model=get_valid_model_name(settings.get('router_fast_model', 'gemini-2.0-flash-lite')),
+            default_model=default_model,
+            strong_model=get_valid_model_name(settings.get('router_strong_model', 'gemini-1.5-pro')),
+            short_prompt_words=settings.get('router_short_prompt_words', 12),
+            long_prompt_words=settings.get('router_long_prompt_words', 80),
+            latency_budgets_ms=settings.get('router_latency_budgets_ms'),
+            latency_percentile=settings.get('router_latency_percentile', 90),
+            enabled=settings.get('model_routing', True),
+        )
+
+    def classify(self, prompt, voice=False):
+        """Return 'fast', 'default' or 'strong' for a prompt"""
+        text = prompt.lower()
+        words = len(text.split())
+        if words >= self.long_prompt_words or any(hint in text for hint in self.CODE_HINTS):
+            return 'strong'
+        if any(hint in text for hint in self.REASONING_HINTS):
+            return 'default' if voice and words < self.short_prompt_words else 'strong'
+        if voice or words <= self.short_prompt_words:
+            return 'fast'
+        return 'default'
+
+    def observed_latency(self, model_name):
+        return llm_telemetry.latency_percentile(model_name, self.latency_percentile, field='ttfb_ms',
+                                                min_samples=self.min_samples)
+
+    def route(self, prompt, voice=False):
+        """Return (model_name, route) for a prompt, adapting to observed first-chunk latency"""
+        if not self.enabled:
+            return self.models['default'], 'fixed'
+        route = self.classify(prompt, voice)
+        model_name = self.models[route]
+        budget = self.latency_budgets_ms.get(route)
+        observed = self.observed_latency(model_name)
+        if budget and observed is not None and observed > budget:
+            # The chosen tier is running slow; step down to the nearest faster tier that is within budget
+            # or has not been measured yet, otherwise to whichever tier is observed to be quickest
+            faster = self.TIERS[:self.TIERS.index(model_name)] if model_name in self.TIERS else ()
+            candidates = list(reversed(faster))
+            measured = []
+            for candidate in candidates:
+                candidate_latency = self.observed_latency(candidate)
+                if candidate_latency is None or candidate_latency <= budget:
+                    print(f"Debug: {model_name} p{self.latency_percentile} {observed:.0f} ms over budget, using {candidate}")
+                    return candidate, f"{route}-fallback"
+                measured.append((candidate_latency, candidate))
+            if measured and min(measured)[0] < observed:
+                return min(measured)[1], f"{route}-fallback"
+        return model_name, route
+
+def _estimate_tokens(contents):
+    """Fallback token estimate when the backend reports no usage"""
+    text = " ".join(text for _, text in LLMBackend.contents_to_messages(contents))
+    return ConversationSession.estimate_tokens(text)
+
+def _record_llm_call(kind, purpose, model_name, contents, started, first_chunk_at, prompt_tokens, response_tokens,
+                     response_text, retries, error):
+    finished = time.monotonic()
+    llm_telemetry.record({
+        'timestamp': time.time(),
+        'backend': llm_backend.name,
+        'model': model_name,
+        'kind': kind,
+        'purpose': purpose,
+        'prompt_tokens': prompt_tokens if prompt_tokens is not None else _estimate_tokens(contents),
+        'response_tokens': response_tokens if response_tokens is not None else (
+            ConversationSession.estimate_tokens(response_text) if response_text else 0),
+        'usage_reported': prompt_tokens is not None,
+        'ttfb_ms': round((first_chunk_at - started) * 1000, 1) if first_chunk_at else None,
+        'total_ms': round((finished - started) * 1000, 1),
+        'retries': retries,
+        'error': error,
+    })
+
+def _timed_generate(kind, purpose, contents, model_name, fn, deadline, cancel_token):
+    info = {}
+    started = time.monotonic()
+    response = None
+    error = None
+    try:
+        response = llm_caller.call(fn, deadline=deadline, cancel_token=cancel_token, call_info=info)
+        return response
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        finished = time.monotonic() if response is not None else None
+        _record_llm_call(
+            kind, purpose, (response.model_name if response else None) or model_name, contents, started, finished,
+            response.prompt_tokens if response else None, response.response_tokens if response else None,
+            response.text if response else "", info.get('retries', 0), error
+        )
+
+def llm_generate(contents, model_name=None, generation_config=None, safety_settings=None, cancel_token=None, deadline=None,
+                 purpose='chat', tools=None):
+    """Generate a reply through the active backend with deadlines, retries, the circuit breaker and telemetry"""
+    return _timed_generate(
+        'generate', purpose, contents, model_name,
+        lambda timeout: llm_backend.generate(contents, model_name, generation_config, safety_settings, timeout=timeout,
+                                             tools=tools),
+        deadline, cancel_token
+    )
+
+def llm_stream(contents, model_name=None, generation_config=None, safety_settings=None, cancel_token=None, deadline=None,
+               purpose='chat', tools=None):
+    """Stream a reply through the active backend; retried only until the first chunk arrives"""
+    info = {}
+    started = time.monotonic()
+    first_chunk_at = None
+    prompt_tokens = response_tokens = None
+    reported_model = None
+    text = ""
+    error = None
+    try:
+        chunks = llm_caller.call_stream(
+            lambda timeout: llm_backend.stream(contents, model_name, generation_config, safety_settings, timeout=timeout,
+                                               tools=tools, cancel_token=cancel_token),
+            deadline=deadline, cancel_token=cancel_token, call_info=info
+        )
+        for chunk in chunks:
+            if first_chunk_at is None:
+                first_chunk_at = time.monotonic()
+            text += chunk.text
+            reported_model = chunk.model_name or reported_model
+            if chunk.prompt_tokens is not None:
+                prompt_tokens = chunk.prompt_tokens
+            if chunk.response_tokens is not None:
+                response_tokens = chunk.response_tokens
+            yield chunk
+    except GeneratorExit:
+        error = 'Cancelled'
+        raise
+    except Exception as e:
+        error = 'Cancelled' if cancel_token and cancel_token.is_cancelled() else type(e).__name__
+        raise
+    finally:
+        _record_llm_call('stream', purpose, reported_model or model_name, contents, started, first_chunk_at,
+                         prompt_tokens, response_tokens, text, info.get('retries', 0), error)
+
+def llm_generate_multimodal(parts, model_name=None, generation_config=None, safety_settings=None, cancel_token=None,
+                            deadline=None, purpose='camera'):
+    """Generate a reply for text and image parts through the active backend"""
+    return _timed_generate(
+        'multimodal', purpose, parts, model_name,
+        lambda timeout: llm_backend.generate_multimodal(parts, model_name, generation_config, safety_settings, timeout=timeout),
+        deadline, cancel_token
+    )
+
+class HedgePolicy:
+    """When to send a duplicate LLM request that has not produced a first chunk in time, and how often it happened"""
+    def __init__(self, enabled=False, percentile=95, default_delay=1.5, min_delay=0.3, max_delay=5.0,
+                 hedge_model='same', max_hedge_rate=0.1, max_extra_cost_usd=None, window=200):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.default_delay = default_delay  # Used until the model has enough latency samples
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.hedge_model = hedge_model  # 'same' or 'faster'
+        self.max_hedge_rate = max_hedge_rate
+        self.max_extra_cost_usd = max_extra_cost_usd
+        self.recent = collections.deque(maxlen=window)  # Whether each recent request was hedged
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def configure(self, settings):
+        self.enabled = settings.get('hedge_requests', False)
+        self.percentile = settings.get('hedge_percentile', 95)
+        self.hedge_model = settings.get('hedge_model', 'same')
+        self.max_hedge_rate = settings.get('hedge_max_rate', 0.1)
+        self.max_extra_cost_usd = settings.get('hedge_max_extra_cost_usd')
+
+    def delay(self, model_name):
+        """Seconds to wait for the first chunk before hedging: the model's observed percentile, clamped"""
+        observed = llm_telemetry.latency_percentile(model_name, self.percentile, field='ttfb_ms', min_samples=20)
+        if observed is None:
+            return self.default_delay
+        return max(self.min_delay, min(self.max_delay, observed / 1000))
+
+    def target_model(self, model_name):
+        if self.hedge_model == 'faster' and model_name in ModelRouter.TIERS:
+            index = ModelRouter.TIERS.index(model_name)
+            return ModelRouter.TIERS[max(0, index - 1)]
+        return model_name
+
+    def extra_cost(self):
+        return llm_telemetry.summary(purpose='hedge')['cost_usd']
+
+    def hedge_rate(self):
+        with self.lock:
+            return sum(self.recent) / len(self.recent) if self.recent else 0.0
+
+    def can_hedge(self):
+        if not self.enabled or self.hedge_rate() >= self.max_hedge_rate:
+            return False
+        return self.max_extra_cost_usd is None or self.extra_cost() < self.max_extra_cost_usd
+
+    def record(self, hedged, hedge_won=False):
+        with self.lock:
+            self.recent.append(hedged)
+            self.counts['requests'] += 1
+            self.counts['hedged'] += hedged
+            self.counts['hedge_wins'] += hedge_won
+
+    def metrics(self):
+        metrics = dict(self.counts)
+        metrics['hedge_rate'] = round(self.hedge_rate(), 3)
+        metrics['extra_cost_usd'] = self.extra_cost()
+        return metrics
+
+# Shared hedging policy for streamed chat replies
+hedge_policy = HedgePolicy()
+
+def llm_stream_hedged(contents, model_name=None, generation_config=None, safety_settings=None, cancel_token=None,
+                      deadline=None, purpose='chat', tools=None, policy=None):
+    """llm_stream that sends a duplicate request if no chunk arrives within the hedge delay; first to answer wins"""
+    policy = policy or hedge_policy
+    if not policy.can_hedge():
+        if policy.enabled:
+            policy.record(False)
+        yield from llm_stream(contents, model_name, generation_config, safety_settings, cancel_token=cancel_token,
+                              deadline=deadline, purpose=purpose, tools=tools)
+        return
+    
+    events = queue.Queue()
+    tokens = []
+    # Both requests share the primary's absolute deadline, so a hedge cannot stretch the turn
+    deadline_at = time.monotonic() + (llm_caller.deadline if deadline is None else deadline)
+
+    def pump(index, request_model, request_purpose, token):
+        stream = llm_stream(contents, request_model, generation_config, safety_settings, cancel_token=token,
+                            deadline=max(0.0, deadline_at - time.monotonic()), purpose=request_purpose, tools=tools)
+        try:
+            for chunk in stream:
+                if token.is_cancelled():
+                    break
+                events.put((index, 'chunk', chunk))
+            events.put((index, 'done', None))
+        except Exception as e:
+            events.put((index, 'error', e))
+        finally:
+            stream.close()
+
+    def launch(request_model, request_purpose):
+        token = CancelToken()
+        tokens.append(token)
+        threading.Thread(target=pump, args=(len(tokens) - 1, request_model, request_purpose, token), daemon=True).start()
+
+    if cancel_token:
+        cancel_token.add_callback(lambda: events.put((None, 'cancel', None)))
+    launch(model_name, purpose)
+    hedge_delay = policy.delay(model_name)
+    hedge_timer = threading.Timer(hedge_delay, events.put, args=((None, 'hedge', None),))
+    hedge_timer.daemon = True
+    hedge_timer.start()
+    winner = None
+    failures = 0
+    try:
+        while True:
+            index, kind, payload = events.get()
+            if kind == 'cancel':
+                return
+            if kind == 'hedge':
+                if winner is None and deadline_at > time.monotonic():
+                    hedge_model = policy.target_model(model_name)
+                    print(f"Debug: No first chunk after {hedge_delay:.2f}s, hedging on {hedge_model}")
+                    launch(hedge_model, 'hedge')
+                continue
+            if winner is not None and index != winner:
+                continue  # Late output from the losing request
+            if kind == 'error':
+                failures += 1
+                if winner is not None or failures == len(tokens):
+                    raise payload
+                continue  # The other request may still answer
+            if winner is None:
+                winner = index
+                hedge_timer.cancel()
+                # Cancelling drops the loser's connection right away, even before its first chunk
+                for other, token in enumerate(tokens):
+                    if other != winner:
+                        token.cancel()
+            if kind == 'done':
+                return
+            yield payload
+    finally:
+        hedge_timer.cancel()
+        for token in tokens:
+            token.cancel()
+        policy.record(len(tokens) > 1, hedge_won=winner == 1)
+
+class FakeLLMRequestHandler(http.server.BaseHTTPRequestHandler):
+    """OpenAI-compatible /v1/chat/completions stand-in served from a FakeBackend"""
+    backend = FakeBackend()
+
+    def do_POST(self):
+        if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        contents = [{'role': message.get('role', 'user'),
+                     'parts': [message['content'] if isinstance(message.get('content'), str) else
+                               " ".join(p.get('text', '') for p in message.get('content', []) if p.get('type') == 'text')]}
+                    for message in body.get('messages', [])]
+        model_name = body.get('model', 'fake')
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for chunk in self.backend.stream(contents, model_name):
+                event = {'model': model_name, 'choices': [{'delta': {'content': chunk.text}}]}
+                if chunk.response_tokens is not None:
+                    event['usage'] = {'prompt_tokens': chunk.prompt_tokens, 'completion_tokens': chunk.response_tokens}
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        else:
+            response = self.backend.generate(contents, model_name)
+            data = json.dumps({
+                'model': model_name,
+                'choices': [{'message': {'role': 'assistant', 'content': response.text}}],
+                'usage': {'prompt_tokens': response.prompt_tokens, 'completion_tokens': response.response_tokens}
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+def serve_fake_llm(port=8080, host='127.0.0.1', first_token_latency=0.2, token_latency=0.02):
+    """Run the offline stand-in LLM server until interrupted"""
+    FakeLLMRequestHandler.backend = FakeBackend(first_token_latency, token_latency)
+    server = http.server.ThreadingHTTPServer((host, port), FakeLLMRequestHandler)
+    print(f"Fake LLM server listening on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class CommandExecutor:
+    """Bounded worker pool for command processing that returns futures and lets newer requests supersede older ones"""
+    def __init__(self, max_workers=2, max_pending=4):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="command")
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.active = {}  # future -> CancelToken
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, supersede=True):
+        """Run fn(*args, cancel_token=token) on the pool and return its future"""
+        if supersede:
+            self.cancel_all()
+        if not self.slots.acquire(blocking=False):
+            raise RuntimeError("Too many commands in progress")
+        token = CancelToken()
+        try:
+            future = self.pool.submit(fn, *args, cancel_token=token)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.active[future] = token
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self.lock:
+            self.active.pop(future, None)
+        self.slots.release()
+        if not future.cancelled() and future.exception():
+            print(f"Error in command worker: {str(future.exception())}")
+
+    def cancel_all(self):
+        """Cancel queued commands and ask running ones to stop"""
+        with self.lock:
+            pending = list(self.active.items())
+        for future, token in pending:
+            token.cancel()
+            future.cancel()
+        return len(pending)
+
+    def shutdown(self):
+        self.cancel_all()
+        self.pool.shutdown(wait=False)
+
+class SpeculativeDispatcher:
+    """Start an LLM request on a stable partial transcript and hand it over if the final transcript agrees"""
+    def __init__(self, start_fn, is_eligible=None, min_words=3, stable_count=2, similarity=0.9):
+        self.start_fn = start_fn  # start_fn(prompt, cancel_token) -> response text
+        self.is_eligible = is_eligible or (lambda text: True)
+        self.min_words = min_words
+        self.stable_count = stable_count
+        self.similarity = similarity
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="speculate")
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self._reset()
+
+    def _reset(self):
+        self.open = False
+        self.last_partial = None
+        self.repeats = 0
+        self.speculation = None  # (normalized prompt, future, cancel token)
+        self.settled = None
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+    def is_material_change(self, speculated, final):
+        """True if the final transcript would need a different answer than the speculated one"""
+        if speculated == final:
+            return False
+        return difflib.SequenceMatcher(None, speculated, final).ratio() < self.similarity
+
+    def begin(self):
+        """Start a new utterance, dropping anything left over from the previous one"""
+        with self.lock:
+            self._cancel_locked()
+            self._reset()
+            self.open = True
+
+    def offer_partial(self, text):
+        """Feed a partial transcript; speculates once the same text has been seen stable_count times in a row"""
+        normalized = self.normalize(text)
+        with self.lock:
+            if not self.open or not normalized:
+                return
+            if normalized == self.last_partial:
+                self.repeats += 1
+            else:
+                self.last_partial = normalized
+                self.repeats = 1
+            if self.repeats < self.stable_count or len(normalized.split()) < self.min_words:
+                return
+            if self.speculation and self.speculation[0] == normalized:
+                return
+        # Local commands are executed by the router, never speculated
+        if not self.is_eligible(text):
+            return
+        with self.lock:
+            if not self.open:
+                return
+            self._cancel_locked()
+            token = CancelToken()
+            future = self.pool.submit(self.start_fn, text, token)
+            self.speculation = (normalized, future, token)
+            self.stats['speculations'] += 1
+        print(f"Debug: Speculating on partial transcript: {text}")
+
+    def settle(self, final_text, allowed=True):
+        """Compare the final transcript with the speculation; keeps it for claim() or cancels it"""
+        normalized = self.normalize(final_text)
+        with self.lock:
+            self.open = False
+            speculation = self.speculation
+            self.speculation = None
+            if speculation is None:
+                return False
+            if not allowed or self.is_material_change(speculation[0], normalized):
+                speculation[2].cancel()
+                self.stats['discarded'] += 1
+                return False
+            self.settled = (normalized, speculation[1], speculation[2])
+            return True
+
+    def claim(self, final_text):
+        """Return the future of a settled speculation for this transcript, or None"""
+        normalized = self.normalize(final_text)
+        with self.lock:
+            settled = self.settled
+            if settled is None or settled[0] != normalized:
+                return None
+            self.settled = None
+            self.stats['adopted'] += 1
+            return settled[1]
+
+    def abandon(self):
+        """End the utterance without a final transcript; a settled speculation is kept"""
+        with self.lock:
+            if self.open and self.speculation:
+                self.speculation[2].cancel()
+                self.stats['discarded'] += 1
+            self.speculation = None
+            self.open = False
+
+    def _cancel_locked(self):
+        for pending in (self.speculation, self.settled):
+            if pending:
+                pending[2].cancel()
+        self.speculation = None
+        self.settled = None
+
+    def cancel(self):
+        with self.lock:
+            self._cancel_locked()
+            self.open = False
+
+    def shutdown(self):
+        self.cancel()
+        self.pool.shutdown(wait=False)
+
+class PartialTranscriber:
+    """Transcribe the audio captured so far while a command is still being recorded
+
+    Audio arrives through feed(), or automatically from a speech_recognition source passed to attach().
+    """
+    class TeeStream:
+        """Wraps a microphone stream and keeps a copy of everything read from it"""
+        def __init__(self, stream, sink):
+            self.stream = stream
+            self.sink = sink
+
+        def read(self, size):
+            data = self.stream.read(size)
+            self.sink(data)
+            return data
+
+        def close(self):
+            self.stream.close()
+
+    def __init__(self, language, on_partial, sample_rate=16000, sample_width=2, interval=0.6, min_audio=1.0,
+                 operation_timeout=5):
+        # A recognizer of its own: the turn sets operation_timeout on the main one while this one is running
+        self.recognizer = sr.Recognizer()
+        self.recognizer.operation_timeout = operation_timeout
+        self.language = language
+        self.on_partial = on_partial
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.interval = interval
+        self.min_bytes = int(min_audio * sample_rate) * sample_width
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.source = None
+        self.original_stream = None
+
+    def feed(self, data):
+        with self.lock:
+            self.buffer.extend(data)
+
+    def attach(self, source):
+        """Copy everything recognizer.listen reads from an entered source"""
+        self.source = source
+        self.original_stream = source.stream
+        source.stream = self.TeeStream(self.original_stream, self.feed)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.original_stream is not None:
+            self.source.stream = self.original_stream
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                if len(self.buffer) < self.min_bytes:
+                    continue
+                snapshot = bytes(self.buffer)
+            audio = sr.AudioData(snapshot, self.sample_rate, self.sample_width)
+            try:
+                text = self.recognizer.recognize_google(audio, language=self.language, show_all=False)
+            except (sr.UnknownValueError, sr.RequestError):
+                continue
+            if not self.stop_event.is_set():
+                self.on_partial(text)
+
+class BatchRunner:
+    """Run prompts from a file through routing, the response cache and the LLM without the UI"""
+    def __init__(self, settings, concurrency=4, use_cache=True):
+        self.settings = settings
+        self.concurrency = max(1, concurrency)
+        self.router = ModelRouter.from_settings(settings)
+        self.budget = ResponseBudget.from_settings(settings)
+        self.cache = ResponseCache(
+            max_entries=settings.get('response_cache_size', 500),
+            ttl=settings.get('response_cache_ttl', 6 * 3600)
+        ) if use_cache and settings.get('response_cache', True) else None
+
+    @staticmethod
+    def read_prompts(path):
+        """Read JSONL ({"prompt": ..., "images": [...], "voice": bool}) or one plain-text prompt per line"""
+        prompts = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('{'):
+                    item = json.loads(line)
+                else:
+                    item = {'prompt': line}
+                item.setdefault('id', len(prompts))
+                prompts.append(item)
+        return prompts
+
+    def run_one(self, item):
+        prompt = item.get('prompt', '')
+        images = item.get('images') or []
+        record = {'id': item.get('id'), 'prompt': prompt, 'images': images}
+        started = time.monotonic()
+        try:
+            if images:
+                # Image prompts go to the camera model, like camera questions in the UI
+                parts = [prompt] + [CameraAnalyzer.encode_image_part(Image.open(path).convert('RGB')) for path in images]
+                model_name, route = CameraAnalyzer.MODEL_NAME, 'camera'
+                response = llm_generate_multimodal(parts, model_name, safety_settings=CameraAnalyzer.SAFETY_SETTINGS,
+                                                   purpose='batch')
+                spoken, text = response.text, response.text
+            else:
+                model_name, route = self.router.route(prompt, item.get('voice', False))
+                use_cache = self.cache is not None and self.cache.is_cacheable(prompt)
+                raw_text = self.cache.get(prompt, model_name) if use_cache else None
+                if raw_text:
+                    route = f"{route}-cache"
+                else:
+                    response = llm_generate(self.budget.shape_prompt(prompt), model_name,
+                                            self.budget.generation_config(), purpose='batch')
+                    raw_text = response.text
+                    if use_cache and raw_text:
+                        self.cache.put(prompt, model_name, raw_text)
+                spoken, text = self.budget.split(raw_text)
+            record.update({'response': text, 'spoken': spoken, 'model': model_name, 'route': route, 'error': None})
+        except Exception as e:
+            record.update({'response': None, 'spoken': None, 'model': None, 'route': None,
+                           'error': f"{type(e).__name__}: {str(e)}"})
+        record['latency_ms'] = round((time.monotonic() - started) * 1000, 1)
+        return record
+
+    def run(self, input_path, output_path):
+        """Process every prompt with at most `concurrency` in flight; writes results in input order"""
+        prompts = self.read_prompts(input_path)
+        started = time.monotonic()
+        errors = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool, \
+                open(output_path, 'w', encoding='utf-8') as out:
+            for record in pool.map(self.run_one, prompts):
+                errors += record['error'] is not None
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+        if self.cache is not None:
+            self.cache.save()
+        elapsed = time.monotonic() - started
+        print(f"Processed {len(prompts)} prompts ({errors} errors) in {elapsed:.1f}s "
+              f"({len(prompts) / elapsed if elapsed else 0:.2f} prompts/s)")
+        return len(prompts), errors
+
+class DocumentSummarizer:
+    """Map-reduce summaries of local files and folders: chunk, summarize chunks in parallel, merge hierarchically"""
+    TEXT_EXTENSIONS = {'.txt', '.md', '.rst', '.py', '.js', '.ts', '.java', '.c', '.cpp', '.h', '.cs', '.go', '.rs',
+                       '.html', '.css', '.json', '.yaml', '.yml', '.toml', '.ini', '.cfg', '.csv', '.xml', '.sql',
+                       '.sh', '.pdf'}
+    SKIP_DIRS = {'.git', '__pycache__', 'node_modules', '.venv', 'venv', 'build', 'dist'}
+
+    def __init__(self, model_name, concurrency=4, chunk_words=1200, fan_in=6, summary_words=150, max_files=200,
+                 budget=None, cache=None):
+        self.model_name = model_name
+        self.concurrency = max(1, concurrency)
+        self.chunk_words = chunk_words
+        self.fan_in = max(2, fan_in)  # Summaries merged per reduce call
+        self.summary_words = summary_words
+        self.max_files = max_files
+        self.budget = budget or ResponseBudget(enabled=False)
+        # Chunk and merge results keyed by the hash of their prompt, so unchanged content is never re-summarized
+        self.cache = cache if cache is not None else ResponseCache(path='summary_cache.json', max_entries=5000,
+                                                                   ttl=30 * 24 * 3600)
+        self.stats = collections.Counter()
+
+    @classmethod
+    def from_settings(cls, settings, model_name, cache=None):
+        return cls(
+            model_name,
+            concurrency=settings.get('document_concurrency', 4),
+            chunk_words=settings.get('document_chunk_words', 1200),
+            fan_in=settings.get('document_fan_in', 6),
+            max_files=settings.get('document_max_files', 200),
+            budget=ResponseBudget.from_settings(settings),
+            cache=cache,
+        )
+
+    def collect_files(self, path):
+        """The file itself, or the supported files under a folder (skipping hidden and build folders)"""
+        if os.path.isfile(path):
+            return [path]
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d not in self.SKIP_DIRS and not d.startswith('.'))
+            for name in sorted(names):
+                if os.path.splitext(name)[1].lower() in self.TEXT_EXTENSIONS:
+                    files.append(os.path.join(root, name))
+                    if len(files) >= self.max_files:
+                        return files
+        return files
+
+    @staticmethod
+    def extract_text(path):
+        if path.lower().endswith('.pdf'):
+            try:
+                from pypdf import PdfReader
+            except ImportError:
+                raise RuntimeError("Reading PDF files needs the pypdf package (pip install pypdf)")
+            reader = PdfReader(path)
+            return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read()
+
+    @staticmethod
+    def chunk_text(text, chunk_words):
+        """Split text into chunks of about chunk_words words, breaking at paragraph boundaries where possible"""
+        chunks = []
+        current = []
+        size = 0
+        for paragraph in re.split(r'\n\s*\n', text):
+            words = paragraph.split()
+            if not words:
+                continue
+            # Paragraphs longer than a whole chunk are cut at word boundaries
+            for start in range(0, len(words), chunk_words):
+                piece = words[start:start + chunk_words]
+                if size and size + len(piece) > chunk_words:
+                    chunks.append("\n\n".join(current))
+                    current, size = [], 0
+                current.append(" ".join(piece))
+                size += len(piece)
+        if current:
+            chunks.append("\n\n".join(current))
+        return chunks
+
+    def generate(self, prompt, generation_config=None, cancel_token=None):
+        """llm_generate with the result cached under the prompt's content hash"""
+        key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        cached = self.cache.get(key, self.model_name)
+        if cached:
+            self.stats['cached'] += 1
+            return cached
+        if cancel_token and cancel_token.is_cancelled():
+            raise RuntimeError("Document summary cancelled")
+        if generation_config is None:
+            generation_config = {"max_output_tokens": self.summary_words * 2, "temperature": 0.2}
+        text = llm_generate(prompt, self.model_name, generation_config or None, cancel_token=cancel_token,
+                            purpose='document').text.strip()
+        self.stats['llm_calls'] += 1
+        if text:
+            self.cache.put(key, self.model_name, text)
+        return text
+
+    def summarize_chunk(self, chunk, cancel_token=None):
+        # Chunk summaries do not depend on the question, so they are reused across questions about the same file
+        return self.generate(
+            "Summarize this excerpt of a document. Keep key facts, figures, names, definitions and conclusions. "
+            f"Answer in at most {self.summary_words} words, without an introduction.\n\n{chunk}",
+            cancel_token=cancel_token
+        )
+
+    def merge(self, summaries, cancel_token=None):
+        joined = "\n\n".join(summaries)
+        return self.generate(
+            "Merge these partial summaries of consecutive parts of a document into one summary. "
+            f"Keep the most important facts and conclusions, in at most {self.summary_words} words.\n\n{joined}",
+            cancel_token=cancel_token
+        )
+
+    def summarize(self, path, question=None, cancel_token=None):
+        """Return the raw answer (shaped by the response budget) summarizing path or answering a question about it"""
+        started = time.monotonic()
+        self.stats.clear()
+        files = self.collect_files(path)
+        if not files:
+            raise FileNotFoundError(f"No readable documents found at {path}")
+        base = os.path.dirname(path) if os.path.isfile(path) else path
+        # Cancelled with the caller's token, or by the first failing chunk so the others are not paid for
+        job_token = CancelToken()
+        if cancel_token:
+            cancel_token.add_callback(job_token.cancel)
+        jobs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            try:
+                # Map: every chunk of every file is summarized concurrently
+                for file_path in files:
+                    try:
+                        chunks = self.chunk_text(self.extract_text(file_path), self.chunk_words)
+                    except Exception as e:
+                        if len(files) == 1:
+                            raise
+                        print(f"Debug: Skipping {file_path}: {str(e)}")
+                        continue
+                    label = os.path.relpath(file_path, base) if base else file_path
+                    jobs.extend((label, pool.submit(self.summarize_chunk, chunk, job_token)) for chunk in chunks)
+                if not jobs:
+                    raise ValueError(f"No text could be extracted from {path}")
+                self.stats['chunks'] = len(jobs)
+                summaries = []
+                for label, future in jobs:
+                    summary = future.result()
+                    if summary:
+                        summaries.append(f"[{label}] {summary}" if len(files) > 1 else summary)
+                # Reduce: merge groups of fan_in summaries in parallel until they fit one final prompt
+                while len(summaries) > self.fan_in:
+                    groups = [summaries[i:i + self.fan_in] for i in range(0, len(summaries), self.fan_in)]
+                    merges = [pool.submit(self.merge, group, job_token) for group in groups]
+                    jobs.extend((None, future) for future in merges)
+                    summaries = [future.result() for future in merges]
+                    self.stats['reduce_levels'] += 1
+            except BaseException:
+                # Leaving the with block waits for the pool, so drop queued requests and stop retries first
+                job_token.cancel()
+                for _, future in jobs:
+                    future.cancel()
+                raise
+        notes = "\n\n".join(summaries)
+        name = os.path.basename(os.path.normpath(path))
+        if question:
+            instruction = f"Using these notes from {name}, answer the question: {question}"
+        else:
+            instruction = f"Using these notes, summarize {name}: its purpose, main points and conclusions."
+        answer = self.generate(f"{self.budget.shape_prompt(instruction)}\n\nNotes:\n{notes}",
+                               self.budget.generation_config() or {}, cancel_token)
+        self.cache.save()
+        self.stats['files'] = len(files)
+        print(f"Debug: Summarized {path} in {time.monotonic() - started:.1f}s {dict(self.stats)}")
+        return answer
+
+def gemini_embed(texts, task_type='retrieval_document', model_name='models/text-embedding-004'):
+    """Embed texts with the Gemini embedding API, 100 per request; returns an (n, dim) float32 array"""
+    vectors = []
+    for start in range(0, len(texts), 100):
+        batch = texts[start:start + 100]
+        result = llm_caller.call(lambda timeout: genai.embed_content(
+            model=model_name, content=batch, task_type=task_type, request_options={"timeout": timeout}
+        ))
+        vectors.extend(result['embedding'])
+    return np.asarray(vectors, dtype=np.float32)
+
+class DocumentIndex:
+    """BM25 index over passages of user documents, kept as memory-mapped numpy segments and updated by file mtime
+
+    Each indexing run writes the passages of new and changed files to a new segment; files that changed or
+    disappeared are masked out of older segments and dropped when segments are merged.
+    """
+    STOPWORDS = {'the', 'a', 'an', 'and', 'or', 'of', 'to', 'in', 'on', 'for', 'is', 'are', 'was', 'were', 'be', 'it',
+                 'this', 'that', 'with', 'as', 'at', 'by', 'from', 'what', 'which', 'who', 'how', 'do', 'does', 'my',
+                 'me', 'i', 'you', 'your', 'about', 'can', 'please', 'tell'}
+    TOKEN = re.compile(r'\w+')
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, folders, path='document_index', passage_words=200, max_segments=8, embed_fn=None):
+        self.folders = [os.path.expanduser(folder) for folder in folders]
+        self.path = path
+        self.passage_words = passage_words
+        self.max_segments = max_segments  # More segments than this get merged into one
+        self.embed_fn = embed_fn  # embed_fn(texts, task_type) -> (n, dim) array, or None for BM25 only
+        self.manifest = {'files': {}, 'segments': [], 'next_segment': 0}
+        self.segments = []
+        self.total_passages = 0
+        self.average_length = 1.0
+        self.lock = threading.Lock()  # Guards the loaded segments while an update swaps them
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.load()
+
+    @classmethod
+    def from_settings(cls, settings):
+        embed = settings.get('retrieval_embeddings', False) and settings.get('llm_backend', 'gemini') == 'gemini'
+        return cls(
+            settings.get('document_folders', []),
+            path=settings.get('document_index_path', 'document_index'),
+            passage_words=settings.get('retrieval_passage_words', 200),
+            embed_fn=gemini_embed if embed else None,
+        )
+
+    @classmethod
+    def tokenize(cls, text):
+        return [token for token in cls.TOKEN.findall(text.lower()) if len(token) > 1 and token not in cls.STOPWORDS]
+
+    @staticmethod
+    def term_hash(term):
+        """Stable 64-bit term id; the vocabulary is stored as a sorted hash array instead of a dictionary"""
+        return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def load(self):
+        """Open the segments listed in the manifest as memory maps; cheap even for very large indexes"""
+        try:
+            with open(os.path.join(self.path, 'manifest.json'), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Debug: Error loading document index: {str(e)}")
+            return
+        segments = []
+        for segment_id in manifest['segments']:
+            try:
+                segments.append(self.open_segment(segment_id, manifest['files']))
+            except Exception as e:
+                print(f"Debug: Skipping document index segment {segment_id}: {str(e)}")
+        total = sum(int(segment['live'].sum()) for segment in segments)
+        length = sum(int(segment['lengths'][segment['live']].sum()) for segment in segments)
+        with self.lock:
+            self.manifest = manifest
+            self.segments = segments
+            self.total_passages = total
+            self.average_length = length / total if total else 1.0
+
+    def open_segment(self, segment_id, live_files):
+        directory = os.path.join(self.path, f"seg_{segment_id}")
+        segment = {'id': segment_id, 'dir': directory}
+        for name in ('terms', 'ptr', 'docs', 'tfs', 'lengths', 'file_ids', 'offsets'):
+            segment[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+        segment['text'] = np.memmap(os.path.join(directory, 'text.bin'), dtype=np.uint8, mode='r') \
+            if segment['offsets'][-1] else np.zeros(0, dtype=np.uint8)
+        vectors_path = os.path.join(directory, 'vectors.npy')
+        segment['vectors'] = np.load(vectors_path, mmap_mode='r') if os.path.exists(vectors_path) else None
+        with open(os.path.join(directory, 'files.json'), 'r', encoding='utf-8') as f:
+            segment['files'] = json.load(f)
+        # Passages of files that were re-indexed elsewhere or deleted no longer count
+        file_live = np.array([live_files.get(path, {}).get('segment') == segment_id for path in segment['files']],
+                             dtype=bool)
+        segment['live'] = file_live[segment['file_ids']] if len(file_live) else np.zeros(0, dtype=bool)
+        return segment
+
+    def passage_text(self, segment, index):
+        start, end = int(segment['offsets'][index]), int(segment['offsets'][index + 1])
+        return bytes(segment['text'][start:end]).decode('utf-8')
+
+    def scan(self):
+        """Map every indexable file under the configured folders to [mtime, size]"""
+        found = {}
+        for folder in self.folders:
+            for root, dirs, names in os.walk(folder):
+                dirs[:] = [d for d in dirs if d not in DocumentSummarizer.SKIP_DIRS and not d.startswith('.')]
+                for name in names:
+                    if os.path.splitext(name)[1].lower() not in DocumentSummarizer.TEXT_EXTENSIONS:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = [stat.st_mtime, stat.st_size]
+        return found
+
+    def update(self):
+        """Index new and changed files into a new segment and forget deleted ones; returns the files indexed"""
+        started = time.monotonic()
+        found = self.scan()
+        with self.lock:
+            manifest = json.loads(json.dumps(self.manifest))
+        files = manifest['files']
+        changed = [path for path, (mtime, size) in found.items()
+                   if files.get(path, {}).get('mtime') != mtime or files.get(path, {}).get('size') != size]
+        removed = [path for path in files if path not in found]
+        if not changed and not removed:
+            return 0
+        for path in removed:
+            del files[path]
+        passages = []
+        for path in changed:
+            try:
+                chunks = DocumentSummarizer.chunk_text(DocumentSummarizer.extract_text(path), self.passage_words)
+            except Exception as e:
+                print(f"Debug: Not indexing {path}: {str(e)}")
+                files.pop(path, None)
+                continue
+            passages.extend((path, chunk) for chunk in chunks)
+            files[path] = {'mtime': found[path][0], 'size': found[path][1]}
+        if passages:
+            segment_id = manifest['next_segment']
+            manifest['next_segment'] += 1
+            self.write_segment(segment_id, passages)
+            manifest['segments'].append(segment_id)
+            for path, _ in passages:
+                files[path]['segment'] = segment_id
+        # Files whose text is now empty stay in the manifest so they are not re-read until they change
+        for path in changed:
+            if path in files:
+                files[path].setdefault('segment', None)
+        if len(manifest['segments']) > self.max_segments:
+            self.merge_segments(manifest)
+        self.save_manifest(manifest)
+        self.load()
+        self.remove_unused_segments()
+        print(f"Debug: Indexed {len(changed)} changed and {len(removed)} removed files "
+              f"({self.total_passages} passages) in {time.monotonic() - started:.1f}s")
+        return len(changed)
+
+    def write_segment(self, segment_id, passages, vectors=None):
+        """Write (path, text) passages as a CSR posting list keyed by sorted term hashes"""
+        directory = os.path.join(self.path, f"seg_{segment_id}")
+        os.makedirs(directory, exist_ok=True)
+        file_index = {}
+        file_ids, lengths, hashes, docs, tfs = [], [], [], [], []
+        offsets = [0]
+        with open(os.path.join(directory, 'text.bin'), 'wb') as text_file:
+            for doc, (path, text) in enumerate(passages):
+                file_ids.append(file_index.setdefault(path, len(file_index)))
+                tokens = self.tokenize(text)
+                lengths.append(len(tokens))
+                for term, count in collections.Counter(tokens).items():
+                    hashes.append(self.term_hash(term))
+                    docs.append(doc)
+                    tfs.append(min(count, 65535))
+                encoded = text.encode('utf-8')
+                text_file.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+        hashes = np.array(hashes, dtype=np.uint64)
+        docs = np.array(docs, dtype=np.int32)
+        order = np.lexsort((docs, hashes))
+        hashes = hashes[order]
+        terms, starts = np.unique(hashes, return_index=True)
+        arrays = {
+            'terms': terms,
+            'ptr': np.append(starts, len(hashes)).astype(np.int64),
+            'docs': docs[order],
+            'tfs': np.array(tfs, dtype=np.uint16)[order],
+            'lengths': np.array(lengths, dtype=np.int32),
+            'file_ids': np.array(file_ids, dtype=np.int32),
+            'offsets': np.array(offsets, dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+        if vectors is None and self.embed_fn is not None:
+            try:
+                vectors = self.embed_fn([text for _, text in passages], 'retrieval_document')
+            except Exception as e:
+                print(f"Debug: Document embeddings unavailable: {str(e)}")
+        if vectors is not None:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-6)
+            np.save(os.path.join(directory, 'vectors.npy'), vectors.astype(np.float16))
+        with open(os.path.join(directory, 'files.json'), 'w', encoding='utf-8') as f:
+            json.dump(list(file_index), f, ensure_ascii=False)
+
+    def merge_segments(self, manifest):
+        """Rewrite all live passages into one segment, dropping those of changed and deleted files"""
+        passages, vectors = [], []
+        segments = [self.open_segment(segment_id, manifest['files']) for segment_id in manifest['segments']]
+        keep_vectors = all(segment['vectors'] is not None for segment in segments)
+        for segment in segments:
+            for index in np.flatnonzero(segment['live']):
+                passages.append((segment['files'][segment['file_ids'][index]], self.passage_text(segment, index)))
+                if keep_vectors:
+                    vectors.append(np.asarray(segment['vectors'][index], dtype=np.float32))
+        segments.clear()  # Release the memory maps before the old segments are removed
+        segment_id = manifest['next_segment']
+        manifest['next_segment'] += 1
+        self.write_segment(segment_id, passages, np.array(vectors) if keep_vectors and vectors else None)
+        manifest['segments'] = [segment_id]
+        for entry in manifest['files'].values():
+            if entry.get('segment') is not None:
+                entry['segment'] = segment_id
+
+    def save_manifest(self, manifest):
+        temp_path = os.path.join(self.path, 'manifest.json.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, separators=(',', ':'), ensure_ascii=False)
+        os.replace(temp_path, os.path.join(self.path, 'manifest.json'))
+
+    def remove_unused_segments(self):
+        in_use = {f"seg_{segment_id}" for segment_id in self.manifest['segments']}
+        for name in os.listdir(self.path):
+            if name.startswith('seg_') and name not in in_use:
+                # Still-mapped files cannot be removed on Windows; they are retried after the next update
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def search(self, query, k=4, min_score=0.0):
+        """Return up to k (score, path, passage) tuples, best first"""
+        terms = {self.term_hash(term) for term in self.tokenize(query)}
+        with self.lock:
+            segments, total, average_length = self.segments, self.total_passages, self.average_length
+        if not terms or not total:
+            return []
+        query_hashes = np.array(sorted(terms), dtype=np.uint64)
+        # Locate each query term's posting list in every segment
+        located = []
+        document_frequency = np.zeros(len(query_hashes))
+        for segment in segments:
+            rows = np.searchsorted(segment['terms'], query_hashes)
+            rows = np.minimum(rows, len(segment['terms']) - 1)
+            found = (segment['terms'][rows] == query_hashes) if len(segment['terms']) else np.zeros(len(rows), bool)
+            spans = [(int(segment['ptr'][row]), int(segment['ptr'][row + 1])) if hit else (0, 0)
+                     for row, hit in zip(rows, found)]
+            document_frequency += [end - start for start, end in spans]
+            located.append(spans)
+        idf = np.log(1 + (total - document_frequency + 0.5) / (document_frequency + 0.5))
+        candidates = []
+        for segment, spans in zip(segments, located):
+            scores = np.zeros(len(segment['lengths']), dtype=np.float32)
+            for term_idf, (start, end) in zip(idf, spans):
+                if start == end:
+                    continue
+                docs = segment['docs'][start:end]
+                tfs = segment['tfs'][start:end].astype(np.float32)
+                norm = self.K1 * (1 - self.B + self.B * segment['lengths'][docs] / average_length)
+                scores[docs] += term_idf * tfs * (self.K1 + 1) / (tfs + norm)
+            scores[~segment['live']] = 0
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k] if len(scores) > k else np.arange(len(scores))
+            candidates.extend((float(scores[index]), segment, int(index)) for index in top if scores[index] > min_score)
+        candidates.sort(key=lambda candidate: -candidate[0])
+        if self.embed_fn is not None and candidates:
+            candidates = self.rerank(query, candidates)
+        return [(score, segment['files'][segment['file_ids'][index]], self.passage_text(segment, index))
+                for score, segment, index in candidates[:k]]
+
+    def rerank(self, query, candidates):
+        """Blend normalized BM25 scores with embedding similarity for segments that have vectors"""
+        try:
+            query_vector = np.asarray(self.embed_fn([query], 'retrieval_query'), dtype=np.float32)[0]
+        except Exception as e:
+            print(f"Debug: Query embedding failed, using BM25 only: {str(e)}")
+            return candidates
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-6)
+        best = candidates[0][0]
+        reranked = []
+        for score, segment, index in candidates:
+            similarity = float(segment['vectors'][index].astype(np.float32) @ query_vector) \
+                if segment['vectors'] is not None else 0.0
+            reranked.append((0.5 * score / best + 0.5 * similarity, segment, index))
+        reranked.sort(key=lambda candidate: -candidate[0])
+        return reranked
+
+    def start(self, interval=600):
+        """Index in the background now and then every interval seconds"""
+        if self.thread is not None or not self.folders:
+            return
+        def worker():
+            os.makedirs(self.path, exist_ok=True)
+            while not self.stop_event.is_set():
+                try:
+                    self.update()
+                except Exception as e:
+                    print(f"Debug: Document indexing failed: {str(e)}")
+                self.stop_event.wait(interval)
+        self.thread = threading.Thread(target=worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.manifest['files']), 'passages': self.total_passages,
+                    'segments': len(self.segments)}
+
+class StartupWarmup:
+    """Warm up subsystems on background threads and track the readiness of each"""
+    def __init__(self):
+        self.status = {}  # name -> {'state': 'warming' | 'ready' | 'failed', 'seconds': float, 'error': str}
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, fn):
+        """Start fn() on its own thread; the subsystem is ready once it returns"""
+        with self.lock:
+            self.status[name] = {'state': 'warming', 'seconds': None, 'error': None}
+            self.events[name] = threading.Event()
+        threading.Thread(target=self._run, args=(name, fn), daemon=True, name=f"warmup-{name}").start()
+
+    def _run(self, name, fn):
+        started = time.monotonic()
+        state, error = 'ready', None
+        try:
+            fn()
+        except Exception as e:
+            state, error = 'failed', str(e)
+        with self.lock:
+            self.status[name] = {'state': state, 'seconds': round(time.monotonic() - started, 2), 'error': error}
+        self.events[name].set()
+        print(f"Debug: Warm-up {name}: {state} in {self.status[name]['seconds']}s" + (f" ({error})" if error else ""))
+
+    def is_ready(self, name):
+        with self.lock:
+            return self.status.get(name, {}).get('state') == 'ready'
+
+    def wait(self, name, timeout=None):
+        event = self.events.get(name)
+        return event.wait(timeout) if event else False
+
+    def summary(self):
+        with self.lock:
+            return ", ".join(
+                f"{name} {info['state']}" + (f" ({info['seconds']}s)" if info['seconds'] is not None else "")
+                for name, info in self.status.items()
+            )
+
+class AudioRingBuffer:
+    """Fixed-size ring of 16-bit mono PCM shared by every consumer of the microphone
+
+    Positions are absolute byte offsets since capture started, so each reader keeps its own cursor
+    and can start from a point in the past, as long as it is still within the ring's capacity.
+    """
+    class Reader:
+        """Independent cursor into the ring; a reader that falls behind by more than the capacity skips ahead"""
+        def __init__(self, ring, position):
+            self.ring = ring
+            self.position = position
+            self.overruns = 0
+
+        def read(self, size, timeout=None):
+            """The next size bytes, waiting for them to be captured; None on timeout or once capture has stopped"""
+            result = self.ring.read(self.position, size, timeout)
+            if result is None:
+                return None
+            start, data = result
+            if start != self.position:
+                self.overruns += 1
+            self.position = start + size
+            return data
+
+        def readinto(self, out, timeout=None):
+            """Fill the writable buffer out with the next len(out) bytes; False on timeout or once capture has stopped"""
+            start = self.ring.read_into(self.position, out, timeout)
+            if start is None:
+                return False
+            if start != self.position:
+                self.overruns += 1
+            self.position = start + len(out)
+            return True
+
+        def seek_to_end(self):
+            """Skip everything captured so far"""
+            self.position = self.ring.written
+
+    def __init__(self, seconds=10, sample_rate=16000, sample_width=2):
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.capacity = int(seconds * sample_rate) * sample_width
+        self.buffer = bytearray(self.capacity)
+        self.view = memoryview(self.buffer)  # Slicing the view copies nothing until the bytes are assigned
+        self.written = 0  # Total bytes ever written
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        data = memoryview(data)
+        size = len(data)
+        with self.condition:
+            if size > self.capacity:
+                self.written += size - self.capacity
+                data = data[-self.capacity:]
+                size = self.capacity
+            start = self.written % self.capacity
+            first = min(size, self.capacity - start)
+            self.view[start:start + first] = data[:first]
+            if first < size:
+                self.view[:size - first] = data[first:]
+            self.written += size
+            self.condition.notify_all()
+
+    def oldest(self):
+        """Oldest position still held in the ring"""
+        return max(0, self.written - self.capacity)
+
+    def read(self, position, size, timeout=None):
+        """(start, data) for size bytes from position (moved up to the oldest data still held), or None"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.closed or self.written >= position + size, timeout):
+                return None
+            if self.written < position + size:
+                return None  # Closed before the data arrived
+            position = max(position, self.oldest())
+            start = position % self.capacity
+            first = min(size, self.capacity - start)
+            data = bytes(self.view[start:start + first])
+            if first < size:
+                data += bytes(self.view[:size - first])
+            return position, data
+
+    def read_into(self, position, out, timeout=None):
+        """Like read(), but copies straight into the writable buffer out and returns only the start position"""
+        out = memoryview(out).cast('B')
+        size = len(out)
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.closed or self.written >= position + size, timeout):
+                return None
+            if self.written < position + size:
+                return None
+            position = max(position, self.oldest())
+            start = position % self.capacity
+            first = min(size, self.capacity - start)
+            out[:first] = self.view[start:start + first]
+            if first < size:
+                out[first:] = self.view[:size - first]
+            return position
+
+    def reader(self, position=None):
+        """A cursor starting at position, or at the live edge"""
+        return self.Reader(self, self.written if position is None else max(position, self.oldest()))
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class RingAudioSource(sr.AudioSource):
+    """speech_recognition audio source that reads from the shared capture ring instead of opening a device"""
+    class Stream:
+        def __init__(self, reader, sample_width, timeout):
+            self.reader = reader
+            self.sample_width = sample_width
+            self.timeout = timeout
+
+        def read(self, frames):
+            data = self.reader.read(frames * self.sample_width, self.timeout)
+            if data is None:
+                raise IOError("Microphone capture stopped")
+            return data
+
+        def close(self):
+            pass
+
+    def __init__(self, reader, sample_rate=16000, sample_width=2, chunk=1024, timeout=2.0):
+        self.reader = reader
+        self.SAMPLE_RATE = sample_rate
+        self.SAMPLE_WIDTH = sample_width
+        self.CHUNK = chunk
+        self.timeout = timeout  # Seconds without captured audio before the device is considered gone
+        self.stream = None
+
+    def __enter__(self):
+        self.stream = self.Stream(self.reader, self.SAMPLE_WIDTH, self.timeout)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream = None
+
+class MicrophoneCapture:
+    """One long-lived PyAudio input stream whose callback fills an AudioRingBuffer
+
+    Wake word detection and command capture read from the ring, so the device is opened once
+    instead of being closed and reopened around every command.
+    """
+    def __init__(self, audio, sample_rate=16000, frames_per_buffer=512, ring_seconds=10):
+        self.audio = audio
+        self.ring = AudioRingBuffer(ring_seconds, sample_rate)
+        self.stream = audio.open(
+            rate=sample_rate,
+            channels=1,
+            format=pyaudio.paInt16,
+            input=True,
+            frames_per_buffer=frames_per_buffer,
+            stream_callback=self._callback
+        )
+        self.stream.start_stream()
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        self.ring.write(in_data)
+        return None, pyaudio.paContinue
+
+    def reader(self, position=None):
+        return self.ring.reader(position)
+
+    def source(self, position=None):
+        """A speech_recognition source over the captured audio, starting at position or at the live edge"""
+        return RingAudioSource(self.reader(position), self.ring.sample_rate, self.ring.sample_width)
+
+    def close(self):
+        try:
+            self.stream.stop_stream()
+            self.stream.close()
+        except Exception as e:
+            print(f"Error closing microphone stream: {str(e)}")
+        self.ring.close()
 
 class VADManager:
-    def __init__(self, aggressiveness=3, sample_rate=16000, frame_duration=30, signal_emitter=None):
+    """WebRTC VAD endpointing as an incremental state machine
+
+    Frame flags live in small preallocated rings with running voiced/unvoiced counters, and the
+    utterance is copied into one preallocated buffer, so the cost per frame does not grow with the
+    length of the utterance.
+    """
+    def __init__(self, aggressiveness=3, sample_rate=16000, frame_duration=30, hangover_ms=300,
+                 max_utterance_ms=15000, signal_emitter=None):
         print("Initializing WebRTC Voice Activity Detection...")
         try:
             self.vad = webrtcvad.Vad(aggressiveness)
             self.sample_rate = sample_rate
             self.frame_duration = frame_duration  # in milliseconds
             self.frame_size = int(sample_rate * frame_duration / 1000)  # samples per frame
-            self.ring_buffer = collections.deque(maxlen=8)  # Buffer for voice frames
-            self.triggered = False
-            self.voiced_frames = []
+            self.frame_bytes = self.frame_size * 2
+            # Frames before the trigger, kept so the start of the utterance is not lost
+            self.start_window = 8
+            self.start_audio = bytearray(self.start_window * self.frame_bytes)
+            self.start_flags = bytearray(self.start_window)
+            # Trailing frames that must be (almost all) silent before an utterance is considered finished
+            self.hangover_window = max(1, int(hangover_ms / frame_duration))
+            self.hangover_flags = bytearray(self.hangover_window)
+            # Utterances longer than this are ended where they are
+            self.max_utterance_frames = max(self.start_window + 1, int(max_utterance_ms / frame_duration))
+            self.utterance = bytearray(self.max_utterance_frames * self.frame_bytes)
+            self.utterance_view = memoryview(self.utterance)
             self.signal_emitter = signal_emitter
+            self.clear()
             
             print(f"WebRTC VAD initialized successfully (Aggressiveness Level: {aggressiveness})")
             print("Noise reduction is now active and ready")
@@ -112,45 +2777,138 @@ class VADManager:
             raise
 
     def process_audio(self, audio_chunk):
-        """Process audio chunk and determine if speech is present"""
+        """Process one frame and determine if speech is present
+
+        Returns (True, utterance) when speech starts, (False, utterance) when it ends and (None, None)
+        otherwise. utterance is a memoryview of the internal buffer, valid until the next utterance starts.
+        """
         try:
             is_speech = self.vad.is_speech(audio_chunk, self.sample_rate)
             
             if not self.triggered:
-                self.ring_buffer.append((audio_chunk, is_speech))
-                num_voiced = len([f for f, speech in self.ring_buffer if speech])
+                slot = self.start_count % self.start_window
+                if self.start_count >= self.start_window:
+                    self.start_voiced -= self.start_flags[slot]  # Frame falling out of the window
+                self.start_flags[slot] = is_speech
+                self.start_voiced += is_speech
+                offset = slot * self.frame_bytes
+                self.start_audio[offset:offset + self.frame_bytes] = audio_chunk
+                self.start_count += 1
                 
                 # Start collecting audio when enough voiced frames are detected
-                if num_voiced > 0.5 * self.ring_buffer.maxlen:
+                if self.start_voiced > 0.5 * self.start_window:
                     self.triggered = True
-                    self.voiced_frames = [f[0] for f in self.ring_buffer]
-                    self.ring_buffer.clear()
-                    return True, self.voiced_frames
+                    # Copy the frames written so far into the utterance, oldest first; slots past them
+                    # still hold audio from the previous utterance
+                    split = (slot + 1) * self.frame_bytes
+                    if self.start_count < self.start_window:
+                        self.utterance[:split] = self.start_audio[:split]
+                        self.utterance_frames = self.start_count
+                    else:
+                        head = len(self.start_audio) - split
+                        self.utterance[:head] = self.start_audio[split:]
+                        self.utterance[head:len(self.start_audio)] = self.start_audio[:split]
+                        self.utterance_frames = self.start_window
+                    return True, self.utterance_view[:self.utterance_frames * self.frame_bytes]
             else:
                 # Keep collecting audio until enough silence is detected
-                self.voiced_frames.append(audio_chunk)
-                self.ring_buffer.append((audio_chunk, is_speech))
-                num_unvoiced = len([f for f, speech in self.ring_buffer if not speech])
+                offset = self.utterance_frames * self.frame_bytes
+                self.utterance[offset:offset + self.frame_bytes] = audio_chunk
+                self.utterance_frames += 1
+                slot = self.hangover_count % self.hangover_window
+                if self.hangover_count >= self.hangover_window:
+                    self.hangover_unvoiced -= self.hangover_flags[slot]
+                self.hangover_flags[slot] = not is_speech
+                self.hangover_unvoiced += not is_speech
+                self.hangover_count += 1
                 
-                if num_unvoiced > 0.9 * self.ring_buffer.maxlen:
-                    self.triggered = False
-                    return False, self.voiced_frames
+                if (self.hangover_unvoiced >= 0.9 * self.hangover_window or
+                        self.utterance_frames >= self.max_utterance_frames):
+                    utterance = self.utterance_view[:self.utterance_frames * self.frame_bytes]
+                    self.clear()
+                    return False, utterance
             
-            return None, []
+            return None, None
         except Exception as e:
             print(f"Error processing audio in VAD: {str(e)}")
             if self.signal_emitter:
                 self.signal_emitter.status_changed.emit("⚠ Noise reduction error")
-            return None, []
+            return None, None
+
+    def process_batch(self, audio):
+        """Run every whole frame of audio through process_audio, stopping where an utterance ends
+
+        Returns (result, utterance, frames_used) for the last state change in the batch, so callers
+        can read several frames per call; frames after an ending belong to the next utterance.
+        """
+        view = memoryview(audio)
+        result, utterance = None, None
+        frames = len(view) // self.frame_bytes
+        for index in range(frames):
+            offset = index * self.frame_bytes
+            state, data = self.process_audio(view[offset:offset + self.frame_bytes])
+            if state is not None:
+                result, utterance = state, data
+                if state is False:
+                    return result, utterance, index + 1
+        return result, utterance, frames
+
+    def current_utterance(self):
+        """The audio collected so far for an utterance still in progress"""
+        return self.utterance_view[:self.utterance_frames * self.frame_bytes]
+
+    def clear(self):
+        """Forget any partial utterance before capturing a new one"""
+        self.triggered = False
+        self.start_count = 0
+        self.start_voiced = 0
+        self.hangover_count = 0
+        self.hangover_unvoiced = 0
+        self.utterance_frames = 0
 
     def reset(self):
         """Reset the VAD state"""
-        self.triggered = False
-        self.ring_buffer.clear()
-        self.voiced_frames = []
+        self.clear()
         if self.signal_emitter:
             self.signal_emitter.status_changed.emit("✓ Noise reduction active")
 
+def benchmark_vad(seconds=60, aggressiveness=1, frame_duration=30, repeats=5):
+    """Time VADManager per frame across one long utterance; the cost should not grow as it goes on"""
+    vad = VADManager(aggressiveness=aggressiveness, frame_duration=frame_duration,
+                     max_utterance_ms=(seconds + 1) * 1000)
+    # A voiced-sounding harmonic signal keeps the state machine inside one utterance
+    t = np.arange(vad.frame_size * int(seconds * 1000 / frame_duration)) / vad.sample_rate
+    signal = sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 15))
+    audio = (signal / np.abs(signal).max() * 9000).astype('<i2').tobytes()
+    frames = len(audio) // vad.frame_bytes
+    view = memoryview(audio)
+    bucket = max(1, frames // 10)
+    # One untimed pass so first-touch page faults in the utterance buffer are not measured
+    vad.process_batch(audio)
+    best = {}
+    for _ in range(repeats):
+        vad.clear()
+        for start in range(0, frames - bucket + 1, bucket):
+            started = time.perf_counter()
+            for index in range(start, start + bucket):
+                vad.process_audio(view[index * vad.frame_bytes:(index + 1) * vad.frame_bytes])
+            elapsed = time.perf_counter() - started
+            best[start] = min(best.get(start, elapsed), elapsed)
+    print(f"VADManager: {frames} frames of {frame_duration} ms ({seconds} s of continuous speech), "
+          f"best of {repeats} runs")
+    print(f"{'frames':>15} {'utterance':>10} {'us/frame':>9}")
+    for start, elapsed in best.items():
+        print(f"{start:>7}-{start + bucket:<7} {(start + bucket) * frame_duration / 1000:>9.1f}s "
+              f"{elapsed / bucket * 1e6:>9.2f}")
+    # The same frames again through the batch API
+    batch = float('inf')
+    for _ in range(repeats):
+        vad.clear()
+        started = time.perf_counter()
+        vad.process_batch(audio)
+        batch = min(batch, time.perf_counter() - started)
+    print(f"process_batch: {batch / frames * 1e6:.2f} us/frame")
+
 class BluetoothManager:
     def __init__(self):
         self.serial_port = None
@@ -484,6 +3242,7 @@ class ChatBubble(QFrame):
         
         message = QLabel(text)
         message.setWordWrap(True)
+        self.message_label = message
         message.setStyleSheet("""
             QLabel {
                 color: #ffffff;
@@ -516,6 +3275,14 @@ class ChatBubble(QFrame):
             }}
         """)
 
+    def append_text(self, text):
+        """Append streamed text to the bubble"""
+        self.message_label.setText(self.message_label.text() + text)
+
+    def set_text(self, text):
+        """Replace the bubble text"""
+        self.message_label.setText(text)
+
     def showEvent(self, event):
         super().showEvent(event)
         # Setup slide animation
@@ -543,6 +3310,9 @@ class ChatArea(QScrollArea):
         self.scroll_animation.setDuration(200)  # Faster scrolling
         self.scroll_animation.setEasingCurve(QEasingCurve.Type.OutCubic)
         
+        # Growing bubbles of the replies being streamed in, by stream id
+        self.streaming_bubbles = {}
+        
         # Setup UI
         self.setup_ui()
 
@@ -675,6 +3445,32 @@ class ChatArea(QScrollArea):
         # Animate scroll to bottom
         QTimer.singleShot(50, self._scroll_to_bottom)  # Small delay to ensure widget is properly laid out
 
+    def begin_stream(self, stream_id):
+        """Start an empty assistant bubble that grows while a reply is streamed in"""
+        bubble = ChatBubble("", False)
+        self.streaming_bubbles[stream_id] = bubble
+        self.layout.insertWidget(self.layout.count() - 1, bubble)
+        QTimer.singleShot(50, self._scroll_to_bottom)
+
+    def append_stream(self, stream_id, text):
+        """Append a streamed chunk to the bubble of its stream"""
+        if stream_id not in self.streaming_bubbles:
+            self.begin_stream(stream_id)
+        self.streaming_bubbles[stream_id].append_text(text)
+        QTimer.singleShot(50, self._scroll_to_bottom)
+
+    def finish_stream(self, stream_id, final_text):
+        """Finalize the bubble of a stream, dropping it if nothing arrived"""
+        bubble = self.streaming_bubbles.pop(stream_id, None)
+        if bubble is None:
+            return
+        if final_text.strip():
+            bubble.set_text(final_text)
+        else:
+            self.layout.removeWidget(bubble)
+            bubble.deleteLater()
+        QTimer.singleShot(50, self._scroll_to_bottom)
+
     def _scroll_to_bottom(self):
         target_value = self.verticalScrollBar().maximum()
         current_value = self.verticalScrollBar().value()
@@ -1142,14 +3938,46 @@ class DeviceManager(QFrame):
         with open('devices.json', 'w') as f:
             json.dump(self.devices, f, indent=4)
 
-    def process_command(self, command):
+    def matches_command(self, command):
+        """Check whether process_command would handle this command, without sending anything"""
         command = command.lower()
-        for device_name, device_data in self.devices.items():
-            # Only check for exact matches or very close matches to device commands
-            if (device_data["on_command"] == command or 
+        return any(self._is_device_command(device_data, command) for device_data in self.devices.values())
+
+    def tool_declaration(self):
+        """Function declaration letting the LLM switch a configured device on or off"""
+        if not self.devices:
+            return None
+        return {
+            'name': 'set_device_power',
+            'description': "Turn one of the user's Bluetooth-controlled devices on or off.",
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'device': {'type': 'string', 'enum': list(self.devices), 'description': "Device name"},
+                    'state': {'type': 'string', 'enum': ['on', 'off']},
+                },
+                'required': ['device', 'state'],
+            },
+        }
+
+    def call_tool(self, args):
+        device_data = self.devices.get(args.get('device'))
+        if device_data is None:
+            return f"I don't know a device called {args.get('device')}."
+        command = device_data["on_command"] if args.get('state') == 'on' else device_data["off_command"]
+        return self.process_command(command)
+
+    def _is_device_command(self, device_data, command):
+        # Only check for exact matches or very close matches to device commands
+        return (device_data["on_command"] == command or 
                 device_data["off_command"] == command or
                 f"turn {device_data['on_command']}" == command or
-                f"turn {device_data['off_command']}" == command):
+                f"turn {device_data['off_command']}" == command)
+
+    def process_command(self, command):
+        command = command.lower()
+        for device_name, device_data in self.devices.items():
+            if self._is_device_command(device_data, command):
                 
                 if self.bluetooth_manager.is_connected:
                     # Send the Bluetooth signal
@@ -1433,6 +4261,34 @@ class AppsManager(QFrame):
                     return f"Failed to open {app_name}: {str(e)}"
         return None
 
+    def matches_command(self, command):
+        """Check whether process_command would launch an app for this command, without launching it"""
+        command_words = command.lower().strip().split()
+        return any(self._check_sequence_match(command_words, app_data["command"].lower().strip().split())
+                   for app_data in self.apps.values())
+
+    def tool_declaration(self):
+        """Function declaration letting the LLM launch a configured application"""
+        if not self.apps:
+            return None
+        return {
+            'name': 'open_app',
+            'description': "Open one of the applications the user has configured on this computer.",
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'app': {'type': 'string', 'enum': list(self.apps), 'description': "Application name"},
+                },
+                'required': ['app'],
+            },
+        }
+
+    def call_tool(self, args):
+        app_data = self.apps.get(args.get('app'))
+        if app_data is None:
+            return f"I don't know an app called {args.get('app')}."
+        return self.process_command(app_data["command"])
+
     def _check_sequence_match(self, command_words, app_command_words):
         """
         Check if app_command_words appear in sequence within command_words
@@ -1921,6 +4777,53 @@ class ClickableImageLabel(QLabel):
             painter.drawRect(self.current_selection)
 
 class CameraAnalyzer(QFrame):
+    MODEL_NAME = 'gemini-1.5-flash'
+    SAFETY_SETTINGS = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    ]
+
+    # Camera opening commands
+    CAMERA_OPEN_TRIGGERS = (
+        "what am i looking at",
+        "open camera and tell me about",  # Base phrase
+        "open camera and tell me",        # Partial match
+        "open camera",                    # Basic command
+        "show me what you see",
+        "take a look at this"
+    )
+    
+    # Camera analysis commands
+    ANALYSIS_TRIGGERS = (
+        "what is this",
+        "what do you see",
+        "analyze this",
+        "describe what you see",
+        "tell me what this is"
+    )
+    
+    # Camera closing commands
+    CAMERA_CLOSE_TRIGGERS = (
+        "close camera",
+        "stop camera",
+        "turn off camera"
+    )
+    
+    # Specific object queries
+    SPECIFIC_OBJECT_PATTERNS = (
+        "is there a",
+        "do you see a",
+        "do you see any",
+        "can you see a",
+        "can you see any",
+        "where is the",
+        "where are the",
+        "find the",
+        "locate the"
+    )
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setup_ui()
@@ -1932,7 +4835,7 @@ class CameraAnalyzer(QFrame):
         self.last_analyzed_frame = None
         self.last_analysis_time = 0
         self.analysis_cooldown = 2  # Seconds between analyses
-        self.model = None  # Initialize model as None
+        self.model = None  # Name of the model used for analysis, set once the backend is ready
         
         # Get signal emitter from main window
         self.signal_emitter = None
@@ -1960,6 +4863,11 @@ class CameraAnalyzer(QFrame):
     def initialize_gemini_model(self):
         """Initialize or reinitialize the Gemini model with current settings"""
         try:
+            # Other backends do not need a Gemini API key
+            if not isinstance(llm_backend, GeminiBackend):
+                self.model = self.MODEL_NAME
+                return llm_backend.is_available()
+            
             # Get API key from settings
             api_key = None
             settings_found = False
@@ -2004,30 +4912,14 @@ class CameraAnalyzer(QFrame):
                 return False
             
             print("Debug: Configuring Gemini with API key")
-            # Configure Gemini with API key
-            genai.configure(api_key=api_key)
-            
-            # Hardcode model to gemini-1.5-flash
-            model_name = 'gemini-1.5-flash'
-            print(f"Debug: Creating model instance with {model_name}")
+            # Configure Gemini with API key (no-op if already configured with this key)
+            if not initialize_gemini(api_key):
+                self.model = None
+                return False
             
-            # Create model instance with hardcoded configuration
-            self.model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config={
-                    "temperature": 0.4,
-                    "top_p": 1,
-                    "top_k": 32,
-                    "max_output_tokens": 1024,
-                },
-                safety_settings=[
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                ]
-            )
-            print("Debug: Gemini model initialized successfully with gemini-1.5-flash")
+            # Hardcode model to gemini-1.5-flash; the pooled client is built on first use
+            self.model = self.MODEL_NAME
+            print(f"Debug: Gemini model initialized successfully with {self.model}")
             return True
         except Exception as e:
             print(f"Debug: Error initializing Gemini model: {str(e)}")
@@ -2070,10 +4962,56 @@ class CameraAnalyzer(QFrame):
         except Exception as e:
             print(f"Debug: Error in speak_text: {str(e)}")
 
+    @staticmethod
+    def encode_image_part(image, quality=85):
+        """Encode a PIL image to a JPEG blob once so it can be sent without re-encoding"""
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        return {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}
+
+    def parse_structured_analysis(self, text):
+        """Split a JSON description/answer/spoken reply, tolerating code fences, plain text or a cut-off object"""
+        match = re.search(r'\{.*\}', text, re.DOTALL)
+        if match:
+            try:
+                data = json.loads(match.group(0))
+                return (str(data.get('description', '')).strip(), str(data.get('answer', '')).strip(),
+                        str(data.get('spoken', '')).strip())
+            except ValueError:
+                pass
+        start = text.find('{')
+        if start == -1:
+            return text.strip(), "", ""
+        # The reply hit the token cap mid-object: keep the fields that made it, cutting a cut-off one to whole sentences
+        fields = {}
+        for name, value, closed in STRUCTURED_FIELD.findall(text, start):
+            # Drop an escape sequence the cut went through
+            value = re.sub(r'\\u[0-9a-fA-F]{0,3}$', '', value)
+            try:
+                value = json.loads('"' + value + '"').strip()
+            except ValueError:
+                continue
+            if not closed:
+                end = max(value.rfind(mark) for mark in '.!?')
+                value = value[:end + 1] if end > 0 else f"{value}..."
+            fields[name] = value
+        if not fields.get('description'):
+            return "", "", ""
+        return fields['description'], fields.get('answer', ''), fields.get('spoken', '')
+
+    def get_response_budget(self):
+        """Use the main window's answer budgets, or the defaults when running on its own"""
+        current = self
+        while current:
+            if isinstance(current, MainWindow):
+                return current.response_budget
+            current = current.parent()
+        return ResponseBudget()
+
     def analyze_image(self, image, prompt_text):
         """Analyze an image using Gemini"""
         try:
-            if not is_gemini_initialized():
+            if not llm_backend.is_available():
                 error_msg = "⚠️ API key not configured. Please add your Gemini API key in Settings to use image analysis."
                 self.emit_message(error_msg, False)
                 self.status_label.setText("API key required")
@@ -2101,79 +5039,74 @@ class CameraAnalyzer(QFrame):
                 print("Debug: Converting image to RGB")
                 image = image.convert('RGB')
             
-            print("Debug: Preparing to call Gemini API for general description")
-            # First, get a general description
+            # Encode the image once and reuse the same blob for the request
+            image_part = self.encode_image_part(image)
+            
+            description_prompt = [
+                "Describe what you see in this image in a natural, conversational way.",
+                "Focus on the main elements and interesting details.",
+                "Be concise but informative."
+            ]
+            has_question = prompt_text != "What do you see in this image?"
+            budget = self.get_response_budget()
+            # The chat gets the full description; speech gets a short summary within the spoken budget
+            spoken_instruction = (
+                f'"spoken": "<at most {budget.spoken_words} words to read aloud, plain sentences>"'
+                if budget.enabled else None
+            )
+            if budget.enabled:
+                # Keep the JSON within the token cap so it is not cut off mid-object
+                description_prompt.append(f"Keep the description and any answer to {budget.chat_words} words together.")
+            
             try:
-                description_prompt = [
-                    "Describe what you see in this image in a natural, conversational way.",
-                    "Focus on the main elements and interesting details.",
-                    "Be concise but informative."
-                ]
-                
-                # Set a timeout for the API call
-                print("Debug: Making first API call")
-                description_response = self.model.generate_content(
-                    ["\n".join(description_prompt), image],
-                    generation_config={
+                if has_question:
+                    # One structured request returns both the description and the answer
+                    print("Debug: Making single structured API call for description and question")
+                    fields = ['"description": "<description>"', '"answer": "<answer>"', spoken_instruction]
+                    structured_prompt = "\n".join(description_prompt + [
+                        f"Then answer this question about the image: {prompt_text}",
+                        "Reply with JSON only: {" + ", ".join(f for f in fields if f) + "}"
+                    ])
+                    max_output_tokens = 1024
+                else:
+                    print("Debug: Making API call for general description")
+                    fields = ['"description": "<description>"', spoken_instruction]
+                    structured_prompt = "\n".join(description_prompt + [
+                        "Reply with JSON only: {" + ", ".join(f for f in fields if f) + "}"
+                    ])
+                    max_output_tokens = 512
+                response = llm_generate_multimodal(
+                    [structured_prompt, image_part],
+                    model_name=self.model or self.MODEL_NAME,
+                    generation_config=budget.generation_config({
                         "temperature": 0.4,
                         "top_p": 1,
                         "top_k": 32,
-                        "max_output_tokens": 512,
-                    }
+                        "max_output_tokens": max_output_tokens,
+                        "response_mime_type": "application/json",
+                    }, extra_tokens=STRUCTURED_OVERHEAD_TOKENS),
+                    safety_settings=self.SAFETY_SETTINGS
                 )
-                print("Debug: Received response from first API call")
-                
-                if not description_response:
-                    raise ValueError("No response received from Gemini API")
-                
-                # Get the text from the response
-                description_text = description_response.text if hasattr(description_response, 'text') else str(description_response)
-                print(f"Debug: Description text length: {len(description_text)}")
-                print(f"Debug: Description text content: {description_text}")  # Added debug print
+                description_text, specific_text, spoken_summary = self.parse_structured_analysis(response.text)
+                print("Debug: Received response from API call")
+                print(f"Debug: Description text content: {description_text}")
                 
                 if not description_text.strip():
                     raise ValueError("Empty response from Gemini API")
                 
             except Exception as e:
-                print(f"Debug - Error in general description: {str(e)}")
+                print(f"Debug - Error in image analysis request: {str(e)}")
                 raise
             
-            # Handle specific question if provided
-            combined_response = ""
-            speak_text = ""
-            
-            try:
-                if prompt_text != "What do you see in this image?":
-                    print("Debug: Making second API call for specific question")
-                    specific_response = self.model.generate_content(
-                        [prompt_text, image],
-                        generation_config={
-                            "temperature": 0.4,
-                            "top_p": 1,
-                            "top_k": 32,
-                            "max_output_tokens": 512,
-                        }
-                    )
-                    print("Debug: Received response from second API call")
-                    
-                    specific_text = specific_response.text if hasattr(specific_response, 'text') else str(specific_response)
-                    print(f"Debug: Specific response text length: {len(specific_text)}")
-                    print(f"Debug: Specific response content: {specific_text}")  # Added debug print
-                    
-                    if not specific_text.strip():
-                        raise ValueError("Empty response for specific question")
-                        
-                    combined_response = f"Here's what I see:\n\n{description_text}\n\nAnswering your specific question:\n{specific_text}"
-                    speak_text = f"Let me tell you what I see, and then answer your question. {description_text} Now, to answer your specific question: {specific_text}"
-                else:
-                    combined_response = f"Here's what I see:\n\n{description_text}"
-                    speak_text = f"Let me tell you what I see. {description_text}"
-            
-            except Exception as e:
-                print(f"Debug - Error in specific question: {str(e)}")
-                # Fall back to just the general description
+            if specific_text.strip():
+                combined_response = f"Here's what I see:\n\n{description_text}\n\nAnswering your specific question:\n{specific_text}"
+                speak_text = f"Let me tell you what I see, and then answer your question. {description_text} Now, to answer your specific question: {specific_text}"
+            else:
+                # No question, or the model did not answer it: fall back to just the general description
                 combined_response = f"Here's what I see:\n\n{description_text}"
                 speak_text = f"Let me tell you what I see. {description_text}"
+            if spoken_summary:
+                speak_text = spoken_summary
             
             print("Debug: Preparing to emit response")
             print(f"Debug: Combined response: {combined_response}")  # Added debug print
@@ -2567,45 +5500,10 @@ class CameraAnalyzer(QFrame):
     def process_command(self, command):
         """Process camera-related voice commands"""
         command = command.lower().strip()
-        
-        # Camera opening commands
-        camera_open_triggers = [
-            "what am i looking at",
-            "open camera and tell me about",  # Base phrase
-            "open camera and tell me",        # Partial match
-            "open camera",                    # Basic command
-            "show me what you see",
-            "take a look at this"
-        ]
-        
-        # Camera analysis commands
-        analysis_triggers = [
-            "what is this",
-            "what do you see",
-            "analyze this",
-            "describe what you see",
-            "tell me what this is"
-        ]
-        
-        # Camera closing commands
-        camera_close_triggers = [
-            "close camera",
-            "stop camera",
-            "turn off camera"
-        ]
-        
-        # Handle specific object queries
-        specific_object_patterns = [
-            "is there a",
-            "do you see a",
-            "do you see any",
-            "can you see a",
-            "can you see any",
-            "where is the",
-            "where are the",
-            "find the",
-            "locate the"
-        ]
+        camera_open_triggers = self.CAMERA_OPEN_TRIGGERS
+        analysis_triggers = self.ANALYSIS_TRIGGERS
+        camera_close_triggers = self.CAMERA_CLOSE_TRIGGERS
+        specific_object_patterns = self.SPECIFIC_OBJECT_PATTERNS
         
         # Check for camera opening commands first - using startswith for better matching
         if any(command.startswith(trigger) for trigger in camera_open_triggers):
@@ -2670,6 +5568,41 @@ class CameraAnalyzer(QFrame):
         
         return None  # Return None if not a camera command
 
+    def matches_command(self, command):
+        """Check whether process_command would handle this command, without acting on it"""
+        command = command.lower().strip()
+        return (any(command.startswith(trigger) for trigger in self.CAMERA_OPEN_TRIGGERS) or
+                any(trigger in command for trigger in self.SPECIFIC_OBJECT_PATTERNS + self.ANALYSIS_TRIGGERS +
+                    self.CAMERA_CLOSE_TRIGGERS))
+
+    def tool_declaration(self):
+        """Function declaration letting the LLM open, analyze with or close the camera"""
+        return {
+            'name': 'use_camera',
+            'description': ("Use the computer's camera. 'look' describes what the camera sees or answers a question "
+                            "about it; 'open' and 'close' only start or stop the camera."),
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'action': {'type': 'string', 'enum': ['look', 'open', 'close']},
+                    'question': {'type': 'string', 'description': "What to look for or answer about the image"},
+                },
+                'required': ['action'],
+            },
+        }
+
+    def call_tool(self, args):
+        action = args.get('action', 'look')
+        if action == 'close':
+            return self.process_command("close camera")
+        if action == 'open' or not self.is_capturing:
+            return self.process_command("open camera")
+        if time.time() - self.last_analysis_time < self.analysis_cooldown:
+            return "Please wait a moment before requesting another analysis."
+        # Only starts the analysis; it runs on a command worker and posts its answer to the chat itself
+        self.analyze_current_view(args.get('question') or None)
+        return "Let me take a look at that..."
+
     def start_camera(self):
         print("Debug: Starting camera")  # Debug log
         if self.camera is None:
@@ -2770,45 +5703,76 @@ class CameraAnalyzer(QFrame):
             self.camera = None
 
     def analyze_current_view(self, custom_prompt=None):
-        """Analyze the current view from camera or uploaded image"""
-        print("Debug: Starting analyze_current_view")  # Debug log
-        try:
-            # Check if model is initialized
-            if not self.model:
-                if not self.initialize_gemini_model():
-                    error_msg = "Gemini API key not configured. Please add your API key in settings."
-                    print("Debug: " + error_msg)
-                    self.status_label.setText("API key missing")
-                    self.emit_message(error_msg, False)
-                    self.speak_text("Please configure your Gemini API key in settings before using image analysis.")
-                    return
+        """Analyze the current view from camera or uploaded image
 
-            if self.current_frame is None:
-                print("Debug: No current frame available")  # Debug log
-                message = "No image available. Please start the camera or upload an image."
-                self.status_label.setText("No image available")
-                self.emit_message(message, False)
-                self.speak_text(message)
+        Runs on the GUI thread: checks that an analysis can start, then hands the frame to a
+        command worker so the window stays responsive during the LLM call.
+        """
+        print("Debug: Starting analyze_current_view")  # Debug log
+        # Check if model is initialized
+        if not self.model:
+            if not self.initialize_gemini_model():
+                error_msg = "Gemini API key not configured. Please add your API key in settings."
+                print("Debug: " + error_msg)
+                self.status_label.setText("API key missing")
+                self.emit_message(error_msg, False)
+                self.speak_text("Please configure your Gemini API key in settings before using image analysis.")
                 return
 
-            # Check cooldown period
-            current_time = time.time()
-            if current_time - self.last_analysis_time < self.analysis_cooldown:
-                print("Debug: Analysis cooldown in effect")  # Debug log
-                message = "Please wait a moment before requesting another analysis."
-                self.status_label.setText(message)
-                self.emit_message(message, False)
-                self.speak_text(message)
-                return
+        if self.current_frame is None:
+            print("Debug: No current frame available")  # Debug log
+            message = "No image available. Please start the camera or upload an image."
+            self.status_label.setText("No image available")
+            self.emit_message(message, False)
+            self.speak_text(message)
+            return
 
-            print("Debug: Processing frame for analysis")  # Debug log
-            self.status_label.setText("Processing image...")
-            self.progress_bar.setRange(0, 0)  # Show indeterminate progress
-            self.progress_bar.show()
-            
-            with self.frame_lock:
-                frame_to_analyze = self.current_frame.copy()
-            
+        # Check cooldown period
+        current_time = time.time()
+        if current_time - self.last_analysis_time < self.analysis_cooldown:
+            print("Debug: Analysis cooldown in effect")  # Debug log
+            message = "Please wait a moment before requesting another analysis."
+            self.status_label.setText(message)
+            self.emit_message(message, False)
+            self.speak_text(message)
+            return
+        # Claim the cooldown now; the analysis itself finishes later on a worker
+        self.last_analysis_time = current_time
+
+        print("Debug: Processing frame for analysis")  # Debug log
+        self.status_label.setText("Processing image...")
+        self.progress_bar.setRange(0, 0)  # Show indeterminate progress
+        self.progress_bar.show()
+        
+        with self.frame_lock:
+            frame_to_analyze = self.current_frame.copy()
+        
+        if self.main_window:
+            try:
+                self.main_window.command_executor.submit(self._analyze_frame, frame_to_analyze, custom_prompt,
+                                                         supersede=False)
+            except RuntimeError as e:
+                print(f"Debug: {str(e)}")
+                self._finish_analysis("Analysis failed")
+                self.emit_message("I'm still working on your previous requests. Please wait a moment.", False)
+        else:
+            threading.Thread(target=self._analyze_frame, args=(frame_to_analyze, custom_prompt), daemon=True).start()
+
+    def _on_ui(self, fn, *args):
+        """Run a widget update on the GUI thread from the analysis worker"""
+        if self.main_window:
+            return self.main_window.call_on_ui(fn, *args)
+        return fn(*args)
+
+    def _finish_analysis(self, status):
+        self.status_label.setText(status)
+        self.progress_bar.hide()
+        self.progress_bar.setRange(0, 100)
+
+    def _analyze_frame(self, frame_to_analyze, custom_prompt=None, cancel_token=None):
+        """Encode a frame and describe it with the LLM; runs on a worker, widgets are updated through _on_ui"""
+        status = "Analysis failed"
+        try:
             print("Debug: Converting frame to RGB")  # Debug log
             # Convert frame to RGB
             if len(frame_to_analyze.shape) == 3:  # Color image
@@ -2818,6 +5782,7 @@ class CameraAnalyzer(QFrame):
                 
             print("Debug: Converting to PIL Image")  # Debug log
             pil_image = Image.fromarray(rgb_frame)
+            image_part = self.encode_image_part(pil_image)
             
             # Save debug image
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -2844,17 +5809,27 @@ class CameraAnalyzer(QFrame):
                 ]
                 prompt = "\n".join(prompt)
             
+            # Short spoken summary first, details for the chat after a --- line
+            budget = self.get_response_budget()
+            prompt = budget.shape_prompt(prompt)
+            
             print(f"Debug: Sending to Gemini with prompt: {prompt}")  # Debug log
             # Call Gemini for analysis
-            response = self.model.generate_content(
-                [prompt, pil_image],
-                generation_config={
+            response = llm_generate_multimodal(
+                [prompt, image_part],
+                model_name=self.model,
+                generation_config=budget.generation_config({
                     "temperature": 0.4,
                     "top_p": 1,
                     "top_k": 32,
                     "max_output_tokens": 1024,
-                }
+                }),
+                safety_settings=self.SAFETY_SETTINGS,
+                cancel_token=cancel_token
             )
+            if cancel_token and cancel_token.is_cancelled():
+                status = "Analysis cancelled"
+                return
             
             print("Debug: Received response from Gemini")  # Debug log
             if not response or not hasattr(response, 'text'):
@@ -2868,19 +5843,19 @@ class CameraAnalyzer(QFrame):
             
             # Store the analyzed frame
             with self.frame_lock:
-                self.last_analyzed_frame = self.current_frame.copy()
+                self.last_analyzed_frame = frame_to_analyze
             self.last_analysis_time = time.time()
             
-            # Emit and speak the response
+            # Emit the full response and speak the summary
+            spoken_text, response_text = budget.split(response_text)
             self.emit_message(response_text, False)
-            self.speak_text(response_text)
-            self.status_label.setText("Analysis complete")
+            self.speak_text(spoken_text)
+            status = "Analysis complete"
             print("Debug: Analysis complete and response emitted")  # Debug log
 
         except Exception as e:
             error_msg = f"Error during analysis: {str(e)}"
             print(f"Debug - Error in analyze_current_view: {error_msg}")  # Debug log
-            self.status_label.setText("Analysis failed")
             
             # Use helper methods for error feedback - only emit one error message
             error_response = (
@@ -2895,13 +5870,18 @@ class CameraAnalyzer(QFrame):
             self.speak_text("Sorry, I encountered an error while analyzing the image. Please try again in a moment.")
             
         finally:
-            self.progress_bar.hide()
-            self.progress_bar.setRange(0, 100)
+            self._on_ui(self._finish_analysis, status)
             # Reset animation state
-            if hasattr(self.parent(), 'signal_emitter'):
-                self.parent().signal_emitter.animation_trigger.emit("idle")
+            if self.signal_emitter:
+                self.signal_emitter.animation_trigger.emit("idle")
 
 class MainWindow(QMainWindow):
+    # Seconds of a voice turn kept back for the stages after capture and after STT
+    TURN_RESERVE_AFTER_CAPTURE = 8
+    TURN_RESERVE_AFTER_STT = 4
+    # pyttsx3 speaks at rate 150 (words per minute)
+    SPOKEN_WORDS_PER_SECOND = 2.5
+
     def __init__(self):
         super().__init__()
         self.setWindowFlags(Qt.WindowType.FramelessWindowHint)
@@ -2930,6 +5910,58 @@ class MainWindow(QMainWindow):
         # Load settings
         self.load_settings()
         
+        # Select the LLM backend (Gemini, local HTTP endpoint or offline fake)
+        configure_llm_backend(self.settings)
+        
+        # Restore the conversation session for this user
+        self.session_store = SessionStore()
+        self.conversation_session = self.session_store.load(
+            self.settings.get('user_name', 'default'),
+            token_budget=self.settings.get('context_token_budget', 2000)
+        )
+        
+        # Choose a Gemini tier per prompt
+        self.model_router = ModelRouter.from_settings(self.settings)
+        
+        # Optional JSONL log of per-request LLM telemetry
+        llm_telemetry.sink_path = self.settings.get('telemetry_log') or None
+        
+        # Retry and deadline policy for LLM calls
+        llm_caller.deadline = self.settings.get('llm_timeout', 30)
+        llm_caller.max_retries = self.settings.get('llm_max_retries', 3)
+        
+        # Duplicate slow chat requests to cut tail latency (off by default)
+        hedge_policy.configure(self.settings)
+        
+        # Worker pool so command processing never runs on the UI or audio threads
+        self.command_executor = CommandExecutor(max_workers=self.settings.get('command_workers', 2))
+        # Ids that keep each streamed reply in its own chat bubble
+        self.stream_ids = itertools.count(1)
+        
+        # Cache for repeated LLM prompts
+        self.response_cache = ResponseCache(
+            max_entries=self.settings.get('response_cache_size', 500),
+            ttl=self.settings.get('response_cache_ttl', 6 * 3600)
+        )
+        
+        # Short spoken summary plus full chat text for LLM answers
+        self.response_budget = ResponseBudget.from_settings(self.settings)
+        
+        # Chunk summaries of local documents, keyed by content hash
+        self.summary_cache = ResponseCache(path='summary_cache.json', max_entries=5000, ttl=30 * 24 * 3600)
+        
+        # BM25 index over the folders in document_folders, refreshed in the background
+        self.document_index = DocumentIndex.from_settings(self.settings)
+        self.document_index.start(self.settings.get('retrieval_refresh_seconds', 600))
+        
+        # Start LLM requests on stable partial transcripts while the user is still speaking
+        self.speculative_dispatcher = SpeculativeDispatcher(
+            self.speculate_llm_response,
+            is_eligible=lambda text: llm_backend.is_available() and not self.is_local_command(text),
+            min_words=self.settings.get('speculative_min_words', 3),
+            similarity=self.settings.get('speculative_similarity', 0.9)
+        )
+        
         # Create signal emitter
         self.signal_emitter = SignalEmitter()
         
@@ -2966,9 +5998,61 @@ class MainWindow(QMainWindow):
         self.initialize_speech_components()
         self.start_threads()
         
+        # Warm up the LLM, speech recognition and TTS clients once the window is up
+        self.warmup = StartupWarmup()
+        if self.settings.get('startup_warmup', True):
+            QTimer.singleShot(0, self.start_warmup)
+        
         # Schedule welcome message
         QTimer.singleShot(2000, self._show_welcome)
 
+    def start_warmup(self):
+        """Pay connection and driver setup costs in the background instead of on the first command"""
+        # Tool declarations come from the sidebar pages, so they are built here on the GUI thread
+        tools = self.get_llm_tools()
+        self.warmup.add('llm', lambda: self.warm_up_llm(tools))
+        self.warmup.add('stt', self.warm_up_stt)
+        self.warmup.add('tts', self.warm_up_tts)
+
+    def warm_up_llm(self, tools=None):
+        """Build the pooled clients and connect; tools are the declarations chat requests send"""
+        if not llm_backend.is_available():
+            raise RuntimeError("LLM backend not configured")
+        if llm_backend.name in ('fake', 'replay'):
+            return  # Nothing to connect to
+        # The generation config and tools of a chat request, so the pooled clients built here are the ones it reuses
+        generation_config = self.response_budget.generation_config()
+        if isinstance(llm_backend, GeminiBackend):
+            # Build the pooled clients for every routed tier
+            for model_name in set(self.model_router.models.values()):
+                model_registry.get_model(model_name, generation_config=generation_config, tools=tools)
+        # A short request on the fast tier's client sets up the connection to the service
+        model_name = self.model_router.models['fast']
+        llm_generate("Reply with OK.", model_name, generation_config, deadline=15, purpose='warmup', tools=tools)
+
+    def warm_up_stt(self):
+        # Recognizing a moment of silence sets up DNS and HTTP to the speech service; no speech is expected back
+        silence = sr.AudioData(bytes(16000 * 2 // 4), 16000, 2)
+        language = self.settings.get('speech_language', 'en-US')
+        if language == 'bilingual':
+            language = 'en-US'
+        try:
+            self.recognizer.recognize_google(silence, language=language)
+        except sr.UnknownValueError:
+            pass
+
+    def warm_up_tts(self):
+        # The speech worker owns the engine, so it runs the silent warm-up utterance itself
+        self.tts_warm_event = threading.Event()
+        self.tts_warm_error = None
+        with self.speech_lock:
+            self.speech_queue.insert(0, ('warmup', None))
+            self.speech_event.set()
+        if not self.tts_warm_event.wait(15):
+            raise TimeoutError("TTS warm-up did not finish")
+        if self.tts_warm_error:
+            raise self.tts_warm_error
+
     def _show_welcome(self):
         """Show welcome message when app starts"""
         if not self._welcome_shown:  # Only show welcome message if not shown before
@@ -3173,10 +6257,15 @@ class MainWindow(QMainWindow):
         bg_layout.addWidget(self.chat_area)
         
         # Connect chat area command processor
-        self.chat_area.set_command_processor(self.process_text_command)
+        self.chat_area.set_command_processor(self.submit_command)
         
         # Connect signal emitter to chat area
         self.signal_emitter.new_message.connect(self.chat_area.add_message)
+        self.signal_emitter.stream_started.connect(self.chat_area.begin_stream)
+        self.signal_emitter.stream_chunk.connect(self.chat_area.append_stream)
+        self.signal_emitter.stream_finished.connect(self.chat_area.finish_stream)
+        self.signal_emitter.command_submitted.connect(self.submit_command)
+        self.signal_emitter.ui_call.connect(self.run_ui_call)
         
         # Set window style
         self.setStyleSheet("""
@@ -3197,20 +6286,7 @@ class MainWindow(QMainWindow):
                 pass
             self.porcupine = None
             
-        if hasattr(self, 'audio'):
-            try:
-                self.audio.terminate()
-            except:
-                pass
-            self.audio = None
-            
-        if hasattr(self, 'wake_word_stream'):
-            try:
-                self.wake_word_stream.stop_stream()
-                self.wake_word_stream.close()
-            except:
-                pass
-            self.wake_word_stream = None
+        self.cleanup_audio_resources()
         
         # Initialize speech recognition
         self.recognizer = sr.Recognizer()
@@ -3226,7 +6302,8 @@ class MainWindow(QMainWindow):
         print("\nSetting up noise reduction...")
         try:
             vad_level = self.settings.get('vad_aggressiveness', 1)
-            self.vad_manager = VADManager(aggressiveness=vad_level, signal_emitter=self.signal_emitter)
+            self.vad_manager = VADManager(aggressiveness=vad_level, hangover_ms=self.settings.get('vad_hangover_ms', 300),
+                                          signal_emitter=self.signal_emitter)
             print("Voice activity detection system is ready")
         except Exception as e:
             print(f"Warning: Could not initialize noise reduction: {str(e)}")
@@ -3237,6 +6314,9 @@ class MainWindow(QMainWindow):
         
         self.initialize_tts_engine()
         
+        # One microphone stream shared by wake word detection and command capture
+        self.start_microphone_capture()
+        
         # Initialize wake word detection
         print("\nInitializing wake word detection...")
         try:
@@ -3255,22 +6335,9 @@ class MainWindow(QMainWindow):
                 keywords=['computer']
             )
             
-            # Initialize PyAudio
-            self.audio = pyaudio.PyAudio()
-            
-            # Test audio input devices
-            input_device_info = None
-            for i in range(self.audio.get_device_count()):
-                device_info = self.audio.get_device_info_by_index(i)
-                if device_info['maxInputChannels'] > 0:
-                    print(f"Found input device: {device_info['name']}")
-                    input_device_info = device_info
-                    break
-            
-            if not input_device_info:
+            # Porcupine reads its frames from the shared capture stream
+            if not self.microphone:
                 raise Exception("No input device found")
-                
-            print(f"Using audio device: {input_device_info['name']}")
             print("Wake word detection initialized successfully")
             print("Wake word set to 'computer'")
             
@@ -3293,6 +6360,74 @@ class MainWindow(QMainWindow):
             self.signal_emitter.status_changed.emit("⚠ Wake word detection failed")
             self.signal_emitter.new_message.emit(f"Could not initialize wake word detection: {str(e)}", False)
 
+    def start_microphone_capture(self):
+        """Open the long-lived input stream; without it, commands open their own microphone"""
+        self.microphone = None
+        try:
+            # Initialize PyAudio
+            self.audio = pyaudio.PyAudio()
+            
+            # Test audio input devices
+            input_device_info = None
+            for i in range(self.audio.get_device_count()):
+                device_info = self.audio.get_device_info_by_index(i)
+                if device_info['maxInputChannels'] > 0:
+                    print(f"Found input device: {device_info['name']}")
+                    input_device_info = device_info
+                    break
+            
+            if not input_device_info:
+                raise Exception("No input device found")
+            
+            print(f"Using audio device: {input_device_info['name']}")
+            self.microphone = MicrophoneCapture(self.audio, ring_seconds=self.settings.get('audio_ring_seconds', 10))
+        except Exception as e:
+            print(f"Error opening microphone: {str(e)}")
+
+    def listen_for_command(self, start=None, timeout=5, phrase_time_limit=10, partials=None):
+        """Capture one spoken command, from ring position start when the shared microphone is available
+
+        With VAD, the utterance ends as soon as the hangover confirms trailing silence; otherwise
+        recognizer.listen's energy threshold and pause_threshold decide.
+        """
+        if self.microphone and self.vad_manager:
+            return self.capture_with_vad(self.microphone.reader(start), timeout, phrase_time_limit, partials)
+        with (self.microphone.source(start) if self.microphone else sr.Microphone()) as source:
+            if partials:
+                partials.attach(source)
+            return self.recognizer.listen(source, timeout=timeout, phrase_time_limit=phrase_time_limit)
+
+    def capture_with_vad(self, reader, timeout, phrase_time_limit, partials=None):
+        """Run 30 ms frames from the capture ring through WebRTC VAD and return the utterance as AudioData"""
+        vad = self.vad_manager
+        vad.clear()
+        wait_frames = int(timeout * 1000 / vad.frame_duration)
+        max_frames = int(phrase_time_limit * 1000 / vad.frame_duration)
+        waited = 0
+        # Frames are read into one reused buffer; the VAD copies the ones it keeps into its utterance buffer
+        frame = memoryview(bytearray(vad.frame_bytes))
+        while True:
+            if not reader.readinto(frame, timeout=2.0):
+                raise IOError("Microphone capture stopped")
+            started, utterance = vad.process_audio(frame)
+            if started is False:
+                break  # Trailing silence confirmed, or the utterance reached its cap
+            if started and partials:
+                partials.feed(utterance)
+            elif vad.triggered:
+                if partials:
+                    partials.feed(frame)
+                if vad.utterance_frames >= max_frames:
+                    utterance = vad.current_utterance()
+                    break
+            else:
+                waited += 1
+                if waited >= wait_frames:
+                    raise sr.WaitTimeoutError("listening timed out while waiting for phrase to start")
+        audio = sr.AudioData(bytes(utterance), vad.sample_rate, 2)
+        vad.clear()
+        return audio
+
     def start_threads(self):
         """Start all background threads"""
         print("\nStarting background threads...")
@@ -3306,10 +6441,10 @@ class MainWindow(QMainWindow):
         self.speech_thread.start()
         print("Speech processing thread started")
         
-        # Check API key and initialize Gemini
+        # Check API key and initialize Gemini (other backends need no key)
         api_key = self.settings.get('gemini_api_key', '').strip()
-        if api_key:
-            if initialize_gemini(api_key):
+        if api_key or not isinstance(llm_backend, GeminiBackend):
+            if llm_backend.is_available():
                 print("API key validated, starting voice features...")
                 # Initialize speech components if needed
                 if not hasattr(self, 'recognizer'):
@@ -3373,6 +6508,20 @@ class MainWindow(QMainWindow):
                             pass
                         continue
                 
+                if speech_type == 'warmup':
+                    # Silent utterance so the driver is initialized before the first real one
+                    try:
+                        volume = self.engine.getProperty('volume')
+                        self.engine.setProperty('volume', 0.0)
+                        self.engine.say(" ")
+                        self.engine.runAndWait()
+                        self.engine.setProperty('volume', volume)
+                    except Exception as e:
+                        self.tts_warm_error = e
+                    finally:
+                        self.tts_warm_event.set()
+                    continue
+                
                 if not self.is_suspended and not self.stop_speech.is_set():
                     self.is_speaking = True
                     try:
@@ -3418,14 +6567,11 @@ class MainWindow(QMainWindow):
     def wake_word_listener(self):
         """Background thread for wake word detection using Porcupine"""
         try:
-            self.wake_word_stream = self.audio.open(
-                rate=self.porcupine.sample_rate,
-                channels=1,
-                format=pyaudio.paInt16,
-                input=True,
-                frames_per_buffer=self.porcupine.frame_length,
-                stream_callback=None
-            )
+            # Porcupine's own cursor into the shared capture ring
+            wake_reader = self.microphone.reader()
+            # Every frame is copied into the same buffer; pcm is an int16 view of it, so nothing is unpacked
+            frame_buffer = bytearray(self.porcupine.frame_length * 2)
+            pcm = memoryview(frame_buffer).cast('h')
             
             # Get speech language from settings
             speech_language = self.settings.get('speech_language', 'en-US')
@@ -3433,15 +6579,25 @@ class MainWindow(QMainWindow):
             while not self.stop_wake_word.is_set():
                 if self.is_suspended:
                     time.sleep(0.1)
+                    wake_reader.seek_to_end()
                     continue
                 
                 try:
-                    pcm = self.wake_word_stream.read(self.porcupine.frame_length, exception_on_overflow=False)
-                    pcm = struct.unpack_from("h" * self.porcupine.frame_length, pcm)
+                    if not wake_reader.readinto(frame_buffer, timeout=1.0):
+                        # No audio yet, or the capture stream was rebuilt: follow the current one
+                        if self.microphone and wake_reader.ring is not self.microphone.ring:
+                            wake_reader = self.microphone.reader()
+                        else:
+                            time.sleep(0.1)
+                        continue
                     
                     result = self.porcupine.process(pcm)
                     if result >= 0:  # Wake word detected
                         print("Wake word detected!")
+                        # Every stage of this turn draws from one time budget
+                        turn = self.new_turn_deadline()
+                        # The command starts where the wake word ended; that audio is already in the capture ring
+                        command_start = wake_reader.position
                         
                         # Get current language setting
                         speech_language = self.settings.get('speech_language', 'en-US')
@@ -3457,80 +6613,85 @@ class MainWindow(QMainWindow):
                         # Stop current speech if any
                         self.stop_speaking()
                         
-                        # Update UI and play acknowledgment based on language
+                        # Update UI and pick the acknowledgment based on language
                         if recognition_language == 'ar-AR':
                             self.status_label.setText("جاري الاستماع...")
-                            self.speak("نعم؟")
+                            acknowledgment = "نعم؟"
                         elif recognition_language == 'bilingual':
                             self.status_label.setText("Listening...")
-                            self.speak("Yes? / نعم؟")
+                            acknowledgment = "Yes? / نعم؟"
                         else:
                             self.status_label.setText("Listening...")
-                            self.speak("Yes?")
-                        
-                        time.sleep(0.5)  # Wait for acknowledgment
+                            acknowledgment = "Yes?"
                         
-                        # Temporarily stop wake word detection
-                        self.wake_word_stream.stop_stream()
+                        if self.settings.get('wake_acknowledgment', False):
+                            self.speak(acknowledgment)
+                            time.sleep(turn.take(0.5))  # Wait for acknowledgment
+                            # Capture after the spoken acknowledgment so it is not transcribed as part of the command
+                            command_start = None
                         
-                        # Listen for command using Google Speech Recognition
-                        with sr.Microphone() as source:
+                        # Capture the command from the shared stream, then recognize it with Google Speech Recognition
+                        partials = None
+                        try:
+                            if self.settings.get('speculative_dispatch', False):
+                                # Transcribe while the user is still speaking so the LLM can start early
+                                self.speculative_dispatcher.begin()
+                                partials = PartialTranscriber(
+                                    'en-US' if speech_language == 'bilingual' else speech_language,
+                                    self.speculative_dispatcher.offer_partial
+                                )
+                                partials.start()
                             try:
-                                audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=10)
-                                
-                                # Get the current language setting
-                                speech_language = self.settings.get('speech_language', 'en-US')
-                                
-                                # Try to recognize command in the appropriate language
-                                if speech_language == 'bilingual':
-                                    # Try both languages and use the one that gives a result
-                                    try:
-                                        command = self.recognizer.recognize_google(
-                                            audio,
-                                            language="en-US",
-                                            show_all=False
-                                        )
-                                    except sr.UnknownValueError:
-                                        command = self.recognizer.recognize_google(
-                                            audio,
-                                            language="ar-SA",
-                                            show_all=False
-                                        )
-                                else:
-                                    command = self.recognizer.recognize_google(
-                                        audio,
-                                        language=speech_language,
-                                        show_all=False
-                                    )
-                                
-                                print(f"Received command: {command}")
-                                self.signal_emitter.animation_trigger.emit("listening")
-                                
-                                # Add user message to chat
-                                self.signal_emitter.new_message.emit(command, True)
-                                
-                                # Process command through existing logic
-                                self.process_text_command(command)
-                            
-                            except sr.UnknownValueError:
-                                error_msg = "عذراً، لم أفهم ذلك" if speech_language == "ar-SA" else "Sorry, I didn't catch that. Could you please repeat?"
-                                self.signal_emitter.new_message.emit(error_msg, False)
-                                self.speak(error_msg)
-                            except sr.RequestError as e:
-                                error_msg = "عذراً، حدث خطأ في خدمة التعرف على الكلام" if speech_language == "ar-SA" else f"Sorry, there was an error with the speech recognition service: {str(e)}"
-                                self.signal_emitter.new_message.emit(error_msg, False)
-                                self.speak(error_msg)
+                                # Waiting for speech and the phrase itself must leave time for STT, LLM and TTS
+                                listen_timeout = turn.take(5, reserve=self.TURN_RESERVE_AFTER_CAPTURE, minimum=1)
+                                phrase_limit = turn.take(10, reserve=self.TURN_RESERVE_AFTER_CAPTURE + listen_timeout,
+                                                         minimum=2)
+                                audio = self.listen_for_command(command_start, listen_timeout, phrase_limit, partials)
                             finally:
-                                # Resume wake word detection
-                                self.wake_word_stream.start_stream()
-                                self.signal_emitter.animation_trigger.emit("idle")
-                                
-                                # Reset UI state
-                                if self.vad_manager:
-                                    status_msg = "Waiting for 'Computer' (Noise reduction active)"
-                                else:
-                                    status_msg = "Waiting for 'Computer'"
-                                self.status_label.setText(status_msg)
+                                if partials:
+                                    partials.stop()
+                            turn.mark('capture')
+                            
+                            # Get the current language setting
+                            speech_language = self.settings.get('speech_language', 'en-US')
+                            
+                            # Try to recognize command in the appropriate language
+                            command = self.recognize_command(audio, speech_language, turn)
+                            turn.mark('stt')
+                            
+                            print(f"Received command: {command}")
+                            if partials:
+                                self.speculative_dispatcher.settle(command, allowed=not self.is_local_command(command))
+                            self.signal_emitter.animation_trigger.emit("listening")
+                            
+                            # Add user message to chat
+                            self.signal_emitter.new_message.emit(command, True)
+                            
+                            # Process command on the worker pool so the microphone stays live
+                            self.submit_command(command, voice=True, turn=turn)
+                        
+                        except sr.UnknownValueError:
+                            error_msg = "عذراً، لم أفهم ذلك" if speech_language == "ar-SA" else "Sorry, I didn't catch that. Could you please repeat?"
+                            self.signal_emitter.new_message.emit(error_msg, False)
+                            self.speak(error_msg)
+                        except sr.RequestError as e:
+                            error_msg = "عذراً، حدث خطأ في خدمة التعرف على الكلام" if speech_language == "ar-SA" else f"Sorry, there was an error with the speech recognition service: {str(e)}"
+                            self.signal_emitter.new_message.emit(error_msg, False)
+                            self.speak(error_msg)
+                        finally:
+                            if partials:
+                                # Drops the speculation if no final transcript came back
+                                self.speculative_dispatcher.abandon()
+                            # Resume wake word detection on live audio rather than the command just heard
+                            wake_reader.seek_to_end()
+                            self.signal_emitter.animation_trigger.emit("idle")
+                            
+                            # Reset UI state
+                            if self.vad_manager:
+                                status_msg = "Waiting for 'Computer' (Noise reduction active)"
+                            else:
+                                status_msg = "Waiting for 'Computer'"
+                            self.status_label.setText(status_msg)
                 except Exception as e:
                     print(f"Error in wake word processing: {str(e)}")
                     time.sleep(0.1)
@@ -3538,10 +6699,6 @@ class MainWindow(QMainWindow):
                     
         except Exception as e:
             print(f"Error in wake word listener: {str(e)}")
-        finally:
-            if self.wake_word_stream:
-                self.wake_word_stream.stop_stream()
-                self.wake_word_stream.close()
 
     def toggle_maximize(self):
         if self.isMaximized():
@@ -3566,6 +6723,8 @@ class MainWindow(QMainWindow):
             
             # Clear the speech queue
             with self.speech_lock:
+                if ('warmup', None) in self.speech_queue and hasattr(self, 'tts_warm_event'):
+                    self.tts_warm_event.set()  # The warm-up utterance was dropped; don't leave warm_up_tts waiting
                 self.speech_queue.clear()
                 self.speech_event.clear()
             
@@ -3748,58 +6907,17 @@ class MainWindow(QMainWindow):
             return False
 
     def cleanup_audio_resources(self):
-        """Clean up audio resources before switching between wake word and command listening"""
-        if hasattr(self, 'wake_word_stream') and self.wake_word_stream:
-            try:
-                if self.wake_word_stream.is_active():
-                    self.wake_word_stream.stop_stream()
-                self.wake_word_stream.close()
-                self.wake_word_stream = None
-            except Exception as e:
-                print(f"Error stopping wake word stream: {str(e)}")
+        """Close the shared capture stream and PyAudio before the speech components are rebuilt"""
+        if getattr(self, 'microphone', None):
+            self.microphone.close()
+            self.microphone = None
             
-        # Ensure PyAudio instance is clean
-        if hasattr(self, 'audio'):
+        if getattr(self, 'audio', None):
             try:
                 self.audio.terminate()
-                self.audio = pyaudio.PyAudio()
             except Exception as e:
-                print(f"Error resetting PyAudio: {str(e)}")
-
-    def resume_wake_word_detection(self):
-        """Resume wake word detection after command processing"""
-        try:
-            # Clean up any existing stream
-            if hasattr(self, 'wake_word_stream') and self.wake_word_stream:
-                if self.wake_word_stream.is_active():
-                    self.wake_word_stream.stop_stream()
-                self.wake_word_stream.close()
-                self.wake_word_stream = None
-            
-            # Ensure we have a fresh PyAudio instance
-            if not hasattr(self, 'audio') or self.audio is None:
-                self.audio = pyaudio.PyAudio()
-            
-            # Create new stream
-            self.wake_word_stream = self.audio.open(
-                rate=self.porcupine.sample_rate,
-                channels=1,
-                format=pyaudio.paInt16,
-                input=True,
-                frames_per_buffer=self.porcupine.frame_length,
-                stream_callback=None
-            )
-            
-            # Start the stream
-            self.wake_word_stream.start_stream()
-            
-        except Exception as e:
-            print(f"Error resuming wake word detection: {str(e)}")
-            # If we fail to resume, try to reinitialize everything
-            try:
-                self.initialize_speech_components()
-            except Exception as e2:
-                print(f"Error reinitializing speech components: {str(e2)}")
+                print(f"Error terminating PyAudio: {str(e)}")
+            self.audio = None
 
     def load_settings(self):
         """Load settings from file"""
@@ -3841,9 +6959,16 @@ class MainWindow(QMainWindow):
             new_porcupine_key = self.porcupine_key_input.text().strip()
             old_porcupine_key = self.settings.get('porcupine_key', '')
             
+            old_model = self.settings.get('gemini_model', 'gemini-2.0-flash')
+            
             # Update settings from UI
             self.settings['gemini_api_key'] = new_api_key
-            self.settings['gemini_model'] = self.model_selector.currentData()
+            new_model = self.model_selector.currentData()
+            self.settings['gemini_model'] = model_registry.switch_model(old_model, new_model)
+            if self.settings['gemini_model'] != new_model:
+                QMessageBox.warning(self, "Model Not Changed",
+                                    f"Could not switch to '{new_model}'. Still using {old_model}.")
+            self.model_router = ModelRouter.from_settings(self.settings)
             self.settings['porcupine_key'] = new_porcupine_key
             self.settings['voice_gender'] = 'male' if self.voice_gender_selector.currentText() == "Male Voice" else 'female'
             
@@ -3945,15 +7070,76 @@ class MainWindow(QMainWindow):
     def process_device_command(self, command):
         return self.sidebar.device_page.process_command(command)
 
-    def process_text_command(self, command):
-        """Process commands from text input"""
+    def submit_command(self, command, voice=False, turn=None):
+        """Run a local command on the GUI thread and queue LLM work on the worker pool
+
+        Stop commands cancel everything in flight. Commands from the voice listener
+        threads are first handed over to the GUI thread, since the local commands
+        drive widgets.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            self.signal_emitter.command_submitted.emit(command, voice, turn)
+            return None
+        if command.lower().strip(" .!?،") in STOP_COMMANDS:
+            cancelled = self.command_executor.cancel_all()
+            self.stop_speaking()
+            print(f"Debug: Stop command cancelled {cancelled} request(s)")
+            self.signal_emitter.status_changed.emit("Stopped")
+            return None
+        if self.process_local_command(command):
+            return None
+        try:
+            return self.command_executor.submit(
+                self.process_text_command, command, voice, turn,
+                supersede=self.settings.get('supersede_commands', True)
+            )
+        except RuntimeError as e:
+            print(f"Debug: {str(e)}")
+            self.signal_emitter.new_message.emit("I'm still working on your previous requests. Please wait a moment.", False)
+            return None
+
+    def run_ui_call(self, fn, future):
+        """Slot for ui_call: run fn here on the GUI thread and hand its result to the waiting worker"""
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+
+    def call_on_ui(self, fn, *args):
+        """Call fn on the GUI thread from a worker and wait for its result
+
+        The actions are quick widget updates (LLM work stays on the workers), but the wait outlasts
+        an LLM call so a GUI thread busy with one never makes a worker report a failure early.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return fn(*args)
+        future = concurrent.futures.Future()
+        self.signal_emitter.ui_call.emit(lambda: fn(*args), future)
+        try:
+            return future.result(llm_caller.deadline + UI_CALL_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def closeEvent(self, event):
+        self.cleanup_audio_resources()
+        self.document_index.stop()
+        self.command_executor.shutdown()
+        self.speculative_dispatcher.shutdown()
+        self.response_cache.save()
+        super().closeEvent(event)
+
+    def process_local_command(self, command):
+        """Handle camera, device, app, code, stats and reset commands on the GUI thread; True when handled"""
         try:
             # Check for camera commands first
             camera_response = self.sidebar.camera_page.process_command(command.lower())
             if camera_response:
                 self.signal_emitter.new_message.emit(str(camera_response), False)
                 self.speak(camera_response)
-                return
+                return True
 
             # Check for device commands
             device_response = self.process_device_command(command)
@@ -3961,41 +7147,158 @@ class MainWindow(QMainWindow):
                 # If it is a device command, handle it
                 self.signal_emitter.new_message.emit(str(device_response), False)
                 self.speak(device_response)
-                return
+                return True
 
             # Check for app commands
             app_response = self.sidebar.apps_page.process_command(command)
             if app_response:
                 self.signal_emitter.new_message.emit(str(app_response), False)
                 self.speak(app_response)
-                return
-                
+                return True
+
             # Check for code generation commands
             code_response = self.sidebar.code_page.process_command(command)
             if code_response:
                 self.signal_emitter.new_message.emit(str(code_response), False)
                 self.speak(code_response)
+                return True
+
+            # Report LLM latency, token and cost telemetry
+            if command.lower().strip(" .?!") in STATS_COMMANDS:
+                self.signal_emitter.new_message.emit(self.format_llm_stats(), False)
+                return True
+
+            # Conversation reset commands
+            if command.lower().strip() in RESET_COMMANDS:
+                self.conversation_session.clear()
+                self.session_store.save(self.conversation_session)
+                reply = "Okay, starting a new conversation."
+                self.signal_emitter.new_message.emit(reply, False)
+                self.speak(reply)
+                return True
+        except Exception as e:
+            print(f"Error processing text command: {str(e)}")
+            self.signal_emitter.new_message.emit(f"Error: {str(e)}", False)
+            return True
+        return False
+
+    def process_text_command(self, command, voice=False, turn=None, cancel_token=None):
+        """Answer document and LLM commands on the worker pool; voice marks commands that were spoken
+
+        turn is the TurnDeadline of a spoken command; when it runs low the LLM step
+        falls back to the fast model, any cached answer and a shorter reply.
+        """
+        if cancel_token is None:
+            cancel_token = CancelToken()
+        try:
+            # Summarize or answer questions about local files and folders
+            document_request = self.parse_document_command(command)
+            if document_request:
+                self.answer_about_document(command, *document_request, cancel_token)
                 return
                 
             # If it's not a device, camera, app, or code command, process with Gemini
             try:
                 self.signal_emitter.status_changed.emit("Processing your request...")
-                # Configure Gemini with API key from settings
-                api_key = self.settings.get('gemini_api_key', '').strip()
-                if initialize_gemini(api_key):
-                    # Get validated model name
-                    model_name = get_valid_model_name(self.settings.get('gemini_model', 'gemini-2.0-flash'))
-                    model = genai.GenerativeModel(model_name)
-                    response = model.generate_content(command)
-                    response_text = response.text if response and hasattr(response, 'text') else "Sorry, I couldn't process that request."
+                # Make sure the active backend is configured (Gemini needs its API key)
+                if llm_backend.is_available():
+                    # Pick the model tier for this prompt
+                    model_name, route = self.model_router.route(command, voice)
+                    low_budget = turn is not None and turn.is_low()
+                    if low_budget:
+                        # Little of the turn is left: take the fastest model and a shorter answer
+                        model_name, route = self.model_router.models['fast'], 'deadline'
+                    budget = self.response_budget.scaled(0.5) if low_budget else self.response_budget
+                    print(f"Debug: Routing to {model_name} ({route})")
+                    # A request started on the partial transcript that matched this final one
+                    speculation = self.speculative_dispatcher.claim(command) if voice else None
+                    # Passages from the user's indexed documents; grounded answers follow the files, not the cache
+                    grounded_prompt = self.ground_prompt(command)
+                    # Answer repeated stand-alone prompts straight from the cache
+                    use_cache = (grounded_prompt is None and self.settings.get('response_cache', True) and
+                                 self.response_cache.is_cacheable(command))
+                    if use_cache:
+                        cached_text = self.cached_answer(command, model_name, low_budget)
+                        if cached_text:
+                            if speculation:
+                                speculation.cancel()
+                            print(f"Debug: Response cache hit {self.response_cache.stats()}")
+                            spoken_text, response_text = self.response_budget.split(cached_text)
+                            self.signal_emitter.new_message.emit(response_text, False)
+                            self.speak_within(spoken_text, turn)
+                            self.record_conversation_turn(command, response_text)
+                            return
+                    
+                    # Send the bounded conversation history along with the new prompt,
+                    # shaped so the spoken part stays short and the whole reply fits the budget
+                    contents = self.conversation_session.build_contents(budget.shape_prompt(grounded_prompt or command))
+                    generation_config = budget.generation_config()
+                    # The LLM call may use what is left of the turn, minus a moment to start speaking
+                    deadline = turn.take(llm_caller.deadline, reserve=1, minimum=1) if turn else None
+                    # Device, app and camera actions the model can call instead of replying
+                    tools = self.get_llm_tools()
+                    function_calls = []
+                    response = self.await_speculative_response(speculation, cancel_token) if speculation else None
+                    if cancel_token.is_cancelled():
+                        return
+                    if response and (response.text or response.function_calls):
+                        print("Debug: Using the speculative response")
+                        raw_text, function_calls = response.text, response.function_calls
+                        if raw_text and not function_calls:
+                            spoken_text, response_text = self.response_budget.split(raw_text)
+                            self.signal_emitter.new_message.emit(response_text, False)
+                            self.speak_within(spoken_text, turn)
+                    elif self.settings.get('stream_responses', True):
+                        # Show partial text and speak each sentence as soon as it is complete
+                        raw_text, function_calls = self.stream_llm_response(
+                            contents, model_name, cancel_token, generation_config, tools, deadline, turn
+                        )
+                        if cancel_token.is_cancelled():
+                            print("Debug: Request was superseded, discarding the rest of the reply")
+                            return
+                        if not raw_text.strip():
+                            raw_text = None
+                    else:
+                        response = llm_generate(contents, model_name, generation_config, cancel_token=cancel_token,
+                                                deadline=deadline, tools=tools)
+                        if cancel_token.is_cancelled():
+                            print("Debug: Request was superseded, discarding the reply")
+                            return
+                        raw_text = response.text if response else None
+                        function_calls = response.function_calls if response else []
+                        if raw_text and not function_calls:
+                            # Full answer in the chat, only the short summary spoken
+                            spoken_text, response_text = self.response_budget.split(raw_text)
+                            self.signal_emitter.new_message.emit(response_text, False)
+                            self.speak_within(spoken_text, turn)
+                    if turn:
+                        turn.mark('llm')
+                        print(f"Debug: Turn {turn.summary()}")
                     
-                    # Add assistant message to chat
-                    self.signal_emitter.new_message.emit(str(response_text), False)
-                    self.speak(response_text)
+                    if function_calls:
+                        # The model asked for local actions: run them and report like the command cascade does
+                        response_text = self.execute_tool_calls(function_calls)
+                        self.signal_emitter.new_message.emit(response_text, False)
+                        self.speak(response_text)
+                        self.record_conversation_turn(command, response_text)
+                    elif raw_text:
+                        _, response_text = self.response_budget.split(raw_text)
+                        self.record_conversation_turn(command, response_text)
+                        if use_cache:
+                            self.response_cache.put(command, model_name, raw_text)
+                    else:
+                        response_text = "Sorry, I couldn't process that request."
+                        self.signal_emitter.new_message.emit(response_text, False)
+                        self.speak(response_text)
                 else:
                     error_msg = "Gemini API key not configured. Please add your API key in settings."
                     self.signal_emitter.new_message.emit(error_msg, False)
                     self.speak(error_msg)
+            except CircuitOpenError as e:
+                print(f"Debug: {str(e)} {llm_caller.metrics()}")
+                error_msg = "The AI service is having trouble right now. I'll try again automatically in a little while."
+                self.signal_emitter.new_message.emit(error_msg, False)
+                self.speak(error_msg)
             except Exception as e:
                 error_msg = f"Error processing with Gemini: {str(e)}"
                 print(error_msg)
@@ -4006,6 +7309,257 @@ class MainWindow(QMainWindow):
             print(f"Error processing text command: {str(e)}")
             self.signal_emitter.new_message.emit(f"Error: {str(e)}", False)
 
+    def cached_answer(self, command, model_name, low_budget=False):
+        """Cached reply from model_name; a turn that is low on time also takes any other model's earlier answer"""
+        cached_text = self.response_cache.get(command, model_name)
+        if cached_text or not low_budget:
+            return cached_text
+        # Configured router models first, then the built-in tiers, fastest first
+        models = dict.fromkeys((*self.model_router.models.values(), *ModelRouter.TIERS))
+        models.pop(model_name, None)
+        return next(filter(None, (self.response_cache.get(command, model) for model in models)), None)
+
+    def get_llm_tools(self):
+        """Tool declarations for the device, app and camera actions, or None when function calling is off"""
+        if not self.settings.get('function_calling', True):
+            return None
+        declarations = []
+        tool_handlers = {}
+        for page in (self.sidebar.device_page, self.sidebar.apps_page, self.sidebar.camera_page):
+            declaration = page.tool_declaration()
+            if declaration:
+                declarations.append(declaration)
+                tool_handlers[declaration['name']] = page.call_tool
+        # Swapped in whole, so a request running tool calls never sees a half-built table
+        self.tool_handlers = tool_handlers
+        return [{'function_declarations': declarations}] if declarations else None
+
+    def execute_tool_calls(self, function_calls):
+        """Run the actions the model asked for and return the combined reply"""
+        replies = []
+        for name, args in function_calls:
+            print(f"Debug: Model called {name}({args})")
+            handler = getattr(self, 'tool_handlers', {}).get(name)
+            if handler is None:
+                replies.append(f"Sorry, I can't do '{name}' here.")
+                continue
+            try:
+                # The handlers drive widgets, so they run on the GUI thread
+                replies.append(str(self.call_on_ui(handler, args) or "Done."))
+            except Exception as e:
+                print(f"Debug: Error running {name}: {str(e)}")
+                replies.append(f"Sorry, something went wrong while running {name}.")
+        return " ".join(replies)
+
+    def is_local_command(self, command):
+        """Check whether the command cascade would handle this command without the LLM"""
+        normalized = command.lower().strip(" .?!،")
+        if normalized in STOP_COMMANDS or normalized in RESET_COMMANDS or normalized in STATS_COMMANDS:
+            return True
+        return (self.parse_document_command(command) is not None or
+                self.sidebar.camera_page.matches_command(command) or
+                self.sidebar.device_page.matches_command(command) or
+                self.sidebar.apps_page.matches_command(command) or
+                self.sidebar.code_page.matches_command(command))
+
+    def parse_document_command(self, command):
+        """(path, question) for "summarize <path>" or "analyze <path>: <question>" on an existing path, else None"""
+        match = DOCUMENT_COMMAND.match(command.strip())
+        if not match:
+            return None
+        path = os.path.expanduser(match.group('path').strip().strip('"\''))
+        if not os.path.exists(path):
+            return None
+        return path, match.group('question')
+
+    def answer_about_document(self, command, path, question, cancel_token):
+        """Map-reduce a local document or folder through the LLM and reply like a normal answer"""
+        if not llm_backend.is_available():
+            error_msg = "Gemini API key not configured. Please add your API key in settings."
+            self.signal_emitter.new_message.emit(error_msg, False)
+            self.speak(error_msg)
+            return
+        self.signal_emitter.status_changed.emit(f"Reading {os.path.basename(os.path.normpath(path))}...")
+        summarizer = DocumentSummarizer.from_settings(self.settings, self.model_router.models['default'],
+                                                      cache=self.summary_cache)
+        try:
+            raw_text = summarizer.summarize(path, question, cancel_token)
+        except Exception as e:
+            if cancel_token.is_cancelled():
+                return
+            print(f"Debug: Error summarizing {path}: {str(e)}")
+            error_msg = f"Sorry, I couldn't read that document: {str(e)}"
+            self.signal_emitter.new_message.emit(error_msg, False)
+            self.speak("Sorry, I couldn't read that document.")
+            return
+        if cancel_token.is_cancelled():
+            return
+        spoken_text, response_text = self.response_budget.split(raw_text)
+        self.signal_emitter.new_message.emit(response_text, False)
+        self.speak(spoken_text)
+        self.record_conversation_turn(command, response_text)
+
+    def ground_prompt(self, prompt):
+        """The prompt with the best-matching passages from the indexed documents, or None when nothing matches"""
+        if not self.document_index.folders:
+            return None
+        started = time.monotonic()
+        results = self.document_index.search(prompt, self.settings.get('retrieval_top_k', 4),
+                                             self.settings.get('retrieval_min_score', 1.0))
+        if not results:
+            return None
+        print(f"Debug: Retrieved {len(results)} passages in {(time.monotonic() - started) * 1000:.1f} ms")
+        excerpts = "\n\n".join(f"[{i}] {os.path.basename(path)}: {text}" for i, (_, path, text) in enumerate(results, 1))
+        return (
+            "Use these excerpts from the user's documents if they are relevant, and name the files you used.\n\n"
+            f"{excerpts}\n\nQuestion: {prompt}"
+        )
+
+    def speculate_llm_response(self, prompt, cancel_token):
+        """Generate a reply for a partial transcript; runs off the UI and shows nothing until adopted"""
+        model_name, route = self.model_router.route(prompt, True)
+        contents = self.conversation_session.build_contents(
+            self.response_budget.shape_prompt(self.ground_prompt(prompt) or prompt)
+        )
+        # Tool calls are only returned here; they run once the final transcript adopts the speculation
+        response = llm_generate(contents, model_name, self.response_budget.generation_config(),
+                                cancel_token=cancel_token, purpose='speculative', tools=self.get_llm_tools())
+        if cancel_token.is_cancelled():
+            return None
+        return response
+
+    def await_speculative_response(self, future, cancel_token):
+        """Wait for an adopted speculation's LLMResponse; None means fall back to a normal request"""
+        while not future.done():
+            if cancel_token.wait(0.05):
+                future.cancel()
+                return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Debug: Speculative request failed: {str(e)}")
+            return None
+
+    def format_llm_stats(self):
+        """Summarize LLM telemetry per model for the chat"""
+        lines = ["LLM performance:"]
+        for model_name, summary in llm_telemetry.summary_by_model().items():
+            lines.append(
+                f"• {model_name}: {summary['requests']} requests, {summary['errors']} errors, "
+                f"p50/p90 {summary['total_ms'][50]}/{summary['total_ms'][90]} ms, "
+                f"first chunk p50 {summary['ttfb_ms'][50]} ms, "
+                f"{summary['prompt_tokens']}+{summary['response_tokens']} tokens, ${summary['cost_usd']:.4f}"
+            )
+        if len(lines) == 1:
+            lines.append("No LLM requests recorded yet.")
+        cache_stats = self.response_cache.stats()
+        lines.append(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+        if self.warmup.status:
+            lines.append(f"Warm-up: {self.warmup.summary()}")
+        if hedge_policy.enabled:
+            hedge_stats = hedge_policy.metrics()
+            lines.append(f"Hedging: {hedge_stats.get('hedged', 0)} of {hedge_stats.get('requests', 0)} requests "
+                         f"({hedge_stats['hedge_rate']:.0%} recent), {hedge_stats.get('hedge_wins', 0)} won by the hedge, "
+                         f"extra cost ${hedge_stats['extra_cost_usd']:.4f}")
+        return "\n".join(lines)
+
+    def record_conversation_turn(self, command, response_text):
+        """Add an exchange to the session, persist it and compact old turns in the background"""
+        session = self.conversation_session
+        session.add_exchange(command, response_text)
+        self.session_store.save(session)
+        if session.needs_compaction():
+            def compact_worker():
+                if session.compact(self.summarize_conversation):
+                    self.session_store.save(session)
+            threading.Thread(target=compact_worker, daemon=True).start()
+
+    def summarize_conversation(self, previous_summary, turns):
+        """Summarize older conversation turns with Gemini so they can be dropped from the history"""
+        if not llm_backend.is_available():
+            return None
+        transcript = "\n".join(f"{'User' if t['role'] == 'user' else 'Assistant'}: {t['text']}" for t in turns)
+        prompt = (
+            "Update the running summary of a conversation between a user and a voice assistant. "
+            "Keep names, facts, preferences and open questions; drop small talk. "
+            "Answer with the summary only, in at most 120 words.\n\n"
+            f"Current summary: {previous_summary or 'None'}\n\nNew turns:\n{transcript}"
+        )
+        model_name = get_valid_model_name(self.settings.get('gemini_model', 'gemini-2.0-flash'))
+        response = llm_generate(prompt, model_name, generation_config={"max_output_tokens": 256, "temperature": 0.2},
+                                purpose='summary')
+        return response.text.strip() or None
+
+    def stream_llm_response(self, contents, model_name, cancel_token=None, generation_config=None, tools=None,
+                            deadline=None, turn=None):
+        """Stream a Gemini reply into a growing chat bubble and queue each finished sentence for speech
+
+        Only the spoken summary before the --- line is spoken; the details go to the chat bubble alone.
+        With a turn, sentences stop being queued once they would not fit in what is left of it.
+        Returns the raw reply including the delimiter, and any function calls the model made.
+        """
+        splitter = SentenceSplitter()
+        full_text = ""
+        function_calls = []
+        spoken_upto = 0
+        summary_done = False
+        spoken_sentences = []
+        spoken_words = 0
+        word_allowance = None
+
+        def speak_sentence(sentence):
+            nonlocal spoken_words, word_allowance
+            if turn:
+                if word_allowance is None:
+                    word_allowance = max(8, int(turn.remaining() * self.SPOKEN_WORDS_PER_SECOND))
+                if spoken_words and spoken_words + len(sentence.split()) > word_allowance:
+                    return  # Out of time for this turn; the chat bubble still gets the whole reply
+            spoken_words += len(sentence.split())
+            self.speak(sentence)
+
+        stream_id = next(self.stream_ids)
+        self.signal_emitter.stream_started.emit(stream_id)
+        try:
+            for chunk in llm_stream_hedged(contents, model_name, generation_config, cancel_token=cancel_token,
+                                           deadline=deadline, tools=tools):
+                if cancel_token and cancel_token.is_cancelled():
+                    return full_text, []  # Superseded: stop reading and speaking
+                function_calls.extend(chunk.function_calls)
+                text = chunk.text
+                if not text:
+                    continue
+                full_text += text
+                self.signal_emitter.stream_chunk.emit(stream_id, text)
+                if summary_done:
+                    continue
+                boundary, summary_done = self.response_budget.speakable_prefix(full_text)
+                if boundary > spoken_upto:
+                    spoken_sentences.extend(splitter.feed(full_text[spoken_upto:boundary]))
+                    spoken_upto = boundary
+                if summary_done:
+                    spoken_sentences.extend(splitter.flush())
+                # Arabic goes through gTTS, which synthesizes each call on its own thread,
+                # so it is spoken in one piece at the end to keep sentences in order
+                if not self.contains_arabic(full_text):
+                    for sentence in spoken_sentences:
+                        speak_sentence(sentence)
+                    spoken_sentences = []
+            if not summary_done:
+                spoken_sentences.extend(splitter.feed(full_text[spoken_upto:]))
+                spoken_sentences.extend(splitter.flush())
+            if self.contains_arabic(full_text):
+                self.speak_within(" ".join(spoken_sentences), turn)
+            else:
+                for sentence in spoken_sentences:
+                    speak_sentence(sentence)
+        finally:
+            self.signal_emitter.stream_finished.emit(stream_id, self.response_budget.split(full_text)[1])
+        return full_text, function_calls
+
+    def contains_arabic(self, text):
+        """Check if text contains Arabic characters"""
+        return any(ord(char) in range(0x0600, 0x06FF) for char in text)
+
     def mousePressEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
             # Get the position of the mouse relative to the window
@@ -4070,7 +7624,7 @@ class MainWindow(QMainWindow):
             cleaned_text = self.clean_text_for_tts(text)
             
             # Check if text contains Arabic characters
-            if any(ord(char) in range(0x0600, 0x06FF) for char in cleaned_text):
+            if self.contains_arabic(cleaned_text):
                 def tts_worker():
                     temp_file = None
                     mixer_initialized = False
@@ -4173,6 +7727,8 @@ class MainWindow(QMainWindow):
             
             # Clear the speech queue
             with self.speech_lock:
+                if ('warmup', None) in self.speech_queue and hasattr(self, 'tts_warm_event'):
+                    self.tts_warm_event.set()  # The warm-up utterance was dropped; don't leave warm_up_tts waiting
                 self.speech_queue.clear()
                 self.speech_event.clear()
             
@@ -4183,6 +7739,42 @@ class MainWindow(QMainWindow):
         except Exception as e:
             print(f"Error stopping speech: {str(e)}")
 
+    def new_turn_deadline(self):
+        return TurnDeadline(self.settings.get('turn_budget', 25), self.settings.get('turn_low_budget', 6))
+
+    def recognize_command(self, audio, speech_language, turn=None):
+        """Transcribe a captured command, bounding the STT request by the turn's remaining budget"""
+        if turn:
+            self.recognizer.operation_timeout = turn.take(8, reserve=self.TURN_RESERVE_AFTER_STT, minimum=1.5)
+        try:
+            if speech_language == 'bilingual':
+                # Try both languages and use the one that gives a result
+                try:
+                    return self.recognizer.recognize_google(audio, language="en-US", show_all=False)
+                except sr.UnknownValueError:
+                    if turn and turn.is_low():
+                        raise  # No time for a second recognition pass
+                    return self.recognizer.recognize_google(audio, language="ar-SA", show_all=False)
+            return self.recognizer.recognize_google(audio, language=speech_language, show_all=False)
+        finally:
+            self.recognizer.operation_timeout = None
+
+    def speak_within(self, text, turn=None):
+        """Speak text, keeping only the sentences that fit in what is left of the turn"""
+        if turn is None:
+            self.speak(text)
+            return
+        splitter = SentenceSplitter()
+        sentences = splitter.feed(text) + splitter.flush()
+        allowance = max(8, int(turn.remaining() * self.SPOKEN_WORDS_PER_SECOND))
+        kept, words = [], 0
+        for sentence in sentences:
+            words += len(sentence.split())
+            if kept and words > allowance:
+                break
+            kept.append(sentence)
+        self.speak(" ".join(kept))
+
     def background_listening(self):
         """Basic listening method when wake word detection is not available"""
         print("Starting basic listening mode...")
@@ -4193,53 +7785,36 @@ class MainWindow(QMainWindow):
                 continue
                 
             try:
-                with sr.Microphone() as source:
-                    print("Listening for commands...")
-                    audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=10)
+                print("Listening for commands...")
+                audio = self.listen_for_command(timeout=5, phrase_time_limit=10)
+                # Without a wake word, the turn starts once a phrase has been captured
+                turn = self.new_turn_deadline()
+                
+                try:
+                    # Get current language setting
+                    speech_language = self.settings.get('speech_language', 'en-US')
                     
-                    try:
-                        # Get current language setting
-                        speech_language = self.settings.get('speech_language', 'en-US')
-                        
-                        # Try to recognize command in the appropriate language
-                        if speech_language == 'bilingual':
-                            # Try both languages and use the one that gives a result
-                            try:
-                                command = self.recognizer.recognize_google(
-                                    audio,
-                                    language="en-US",
-                                    show_all=False
-                                )
-                            except sr.UnknownValueError:
-                                command = self.recognizer.recognize_google(
-                                    audio,
-                                    language="ar-SA",
-                                    show_all=False
-                                )
-                        else:
-                            command = self.recognizer.recognize_google(
-                                audio,
-                                language=speech_language,
-                                show_all=False
-                            )
-                        
-                        print(f"Received command: {command}")
-                        self.signal_emitter.animation_trigger.emit("listening")
-                        
-                        # Add user message to chat
-                        self.signal_emitter.new_message.emit(command, True)
-                        
-                        # Process command through existing logic
-                        self.process_text_command(command)
-                        
-                    except sr.UnknownValueError:
-                        # No speech detected, continue listening
-                        pass
-                    except sr.RequestError as e:
-                        error_msg = "عذراً، حدث خطأ في خدمة التعرف على الكلام" if speech_language == "ar-SA" else f"Sorry, there was an error with the speech recognition service: {str(e)}"
-                        self.signal_emitter.new_message.emit(error_msg, False)
-                        self.speak(error_msg)
-                        time.sleep(2)  # Wait before retrying
+                    # Try to recognize command in the appropriate language
+                    command = self.recognize_command(audio, speech_language, turn)
+                    turn.mark('stt')
+                    
+                    print(f"Received command: {command}")
+                    self.signal_emitter.animation_trigger.emit("listening")
+                    
+                    # Add user message to chat
+                    self.signal_emitter.new_message.emit(command, True)
+                    
+                    # Process command on the worker pool so the microphone stays live
+                    self.submit_command(command, voice=True, turn=turn)
+                    
+                except sr.UnknownValueError:
+                    # No speech detected, continue listening
+                    pass
+                except sr.RequestError as e:
+                    error_msg = "عذراً، حدث خطأ في خدمة التعرف على الكلام" if speech_language == "ar-SA" else f"Sorry, there was an error with the speech recognition service: {str(e)}"
+                    self.signal_emitter.new_message.emit(error_msg, False)
+                    self.speak(error_msg)
+                    time.sleep(2)  # Wait before retrying
                         
             except Exception as e:
                 print(f"Error in background listening: {str(e)}")
@@ -4253,6 +7828,18 @@ class CodeGeneratorManager(QFrame):
     show_requested = pyqtSignal()
     status_update = pyqtSignal(str)
     
+    # Keywords that indicate a code generation request
+    CODE_TRIGGERS = (
+        "generate code for",
+        "create code for",
+        "write code for",
+        "make code for",
+        "code a",
+        "generate a",
+        "create a",
+        "write a"
+    )
+    
     def __init__(self, parent=None):
         super().__init__(parent)
         self.editor_config = {}
@@ -4702,11 +8289,8 @@ class CodeGeneratorManager(QFrame):
                 if isinstance(main_window, MainWindow) and hasattr(main_window, 'gemini_model'):
                     model_name = main_window.gemini_model
 
-            # Create model instance with settings
-            model = genai.GenerativeModel(model_name)
-            
-            # Generate code using Gemini
-            response = model.generate_content(enhanced_prompt)
+            # Generate code through the active LLM backend
+            response = llm_generate(enhanced_prompt, model_name, purpose='code')
             if not response or not response.text:
                 return "Sorry, I couldn't generate the code. Please try again."
 
@@ -4755,22 +8339,8 @@ class CodeGeneratorManager(QFrame):
 
     def process_command(self, command):
         """Process code generation commands"""
-        command_lower = command.lower()
-        
-        # Keywords that indicate a code generation request
-        code_triggers = [
-            "generate code for",
-            "create code for",
-            "write code for",
-            "make code for",
-            "code a",
-            "generate a",
-            "create a",
-            "write a"
-        ]
-        
         # Check if this is a code generation command
-        if any(trigger in command_lower for trigger in code_triggers):
+        if self.matches_command(command):
             # Initial feedback
             if hasattr(self, 'parent') and hasattr(self.parent, 'signal_emitter'):
                 self.parent.signal_emitter.new_message.emit("I'll help you generate that code and type it out.", False)
@@ -4791,6 +8361,10 @@ class CodeGeneratorManager(QFrame):
             
         return None  # Not a code generation command
 
+    def matches_command(self, command):
+        command_lower = command.lower()
+        return any(trigger in command_lower for trigger in self.CODE_TRIGGERS)
+
 class SettingsManager(QFrame):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -4997,9 +8571,15 @@ class SettingsManager(QFrame):
             new_porcupine_key = self.porcupine_key_input.text().strip()
             old_porcupine_key = self.settings.get('porcupine_key', '')
             
+            old_model = self.settings.get('gemini_model', 'gemini-2.0-flash')
+            
             # Update settings from UI
             self.settings['gemini_api_key'] = new_api_key
-            self.settings['gemini_model'] = self.model_selector.currentData()
+            new_model = self.model_selector.currentData()
+            self.settings['gemini_model'] = model_registry.switch_model(old_model, new_model)
+            if self.settings['gemini_model'] != new_model:
+                QMessageBox.warning(self, "Model Not Changed",
+                                    f"Could not switch to '{new_model}'. Still using {old_model}.")
             self.settings['porcupine_key'] = new_porcupine_key
             self.settings['voice_gender'] = 'male' if self.voice_gender_selector.currentText() == "Male Voice" else 'female'
             
@@ -5067,8 +8647,16 @@ class SettingsManager(QFrame):
             while parent and not isinstance(parent, QMainWindow):
                 parent = parent.parent()
             
+            # Rebuild the LLM backend so key and backend changes take effect
+            configure_llm_backend(self.settings)
+            
             # Update main window if found
             if parent:
+                # Keep the main window's copy of the settings in sync
+                if hasattr(parent, 'settings'):
+                    parent.settings.update(self.settings)
+                    parent.model_router = ModelRouter.from_settings(parent.settings)
+                
                 # Reinitialize TTS engine with new voice settings
                 if parent.initialize_tts_engine():
                     parent.speak("Settings saved successfully")
@@ -5086,6 +8674,22 @@ class SettingsManager(QFrame):
     def get_setting(self, key, default=None):
         return self.settings.get(key, default)
 
+# Utterances that cancel whatever the assistant is doing
+STOP_COMMANDS = ("stop", "cancel", "never mind", "nevermind", "stop talking", "be quiet", "توقف", "اسكت")
+RESET_COMMANDS = ("new conversation", "forget our conversation", "clear conversation")
+STATS_COMMANDS = ("show llm stats", "llm stats", "show performance stats")
+# A string field of the camera's JSON analysis; the closing quote is missing when the reply was cut off
+STRUCTURED_FIELD = re.compile(r'"(description|answer|spoken)"\s*:\s*"((?:[^"\\]|\\.)*)(")?', re.DOTALL)
+# Output tokens a structured camera reply needs beyond its answer text, for the JSON keys, quotes and escapes
+STRUCTURED_OVERHEAD_TOKENS = 64
+# Seconds beyond the LLM deadline a worker waits for a widget action it handed to the GUI thread
+UI_CALL_TIMEOUT = 10
+# "summarize docs/papers/research.pdf" or "analyze ~/project: what does it do?"
+DOCUMENT_COMMAND = re.compile(
+    r'^(?:summari[sz]e|analy[sz]e)\s+(?:the\s+)?(?:document|file|folder|pdf)?\s*(?P<path>.+?)(?::\s+(?P<question>.+))?$',
+    re.IGNORECASE
+)
+
 def get_valid_model_name(model_name):
     """Validate and return correct Gemini model name"""
     valid_models = {
@@ -5100,12 +8704,50 @@ def get_valid_model_name(model_name):
 initialize_gemini("")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AI Assistant")
+    parser.add_argument('--serve-fake-llm', type=int, metavar='PORT',
+                        help="run the offline OpenAI-compatible stand-in LLM server instead of the UI")
+    parser.add_argument('--fake-llm-latency', type=float, default=0.2,
+                        help="seconds before the stand-in server sends its first token")
+    parser.add_argument('--batch', metavar='PROMPTS',
+                        help="run prompts from a text or JSONL file through the LLM pipeline instead of the UI")
+    parser.add_argument('--output', default='batch_results.jsonl', help="JSONL file for --batch results")
+    parser.add_argument('--concurrency', type=int, default=4, help="prompts in flight at once for --batch")
+    parser.add_argument('--no-cache', action='store_true', help="bypass the response cache for --batch")
+    parser.add_argument('--benchmark-vad', type=int, metavar='SECONDS', nargs='?', const=60,
+                        help="time the VAD state machine per frame over one long utterance instead of running the UI")
+    args, qt_args = parser.parse_known_args()
+    
+    if args.serve_fake_llm:
+        serve_fake_llm(args.serve_fake_llm, first_token_latency=args.fake_llm_latency)
+        sys.exit(0)
+    
+    if args.benchmark_vad:
+        benchmark_vad(args.benchmark_vad)
+        sys.exit(0)
+    
+    if args.batch:
+        batch_settings = {}
+        if os.path.exists('settings.json'):
+            with open('settings.json', 'r') as f:
+                batch_settings = json.load(f)
+        configure_llm_backend(batch_settings)
+        llm_telemetry.sink_path = batch_settings.get('telemetry_log') or None
+        llm_caller.deadline = batch_settings.get('llm_timeout', 30)
+        llm_caller.max_retries = batch_settings.get('llm_max_retries', 3)
+        if not llm_backend.is_available():
+            print("LLM backend is not configured; set gemini_api_key or llm_backend in settings.json")
+            sys.exit(1)
+        runner = BatchRunner(batch_settings, concurrency=args.concurrency, use_cache=not args.no_cache)
+        _, batch_errors = runner.run(args.batch, args.output)
+        sys.exit(1 if batch_errors else 0)
+    
     try:
         ctypes.windll.shcore.SetProcessDpiAwareness(2)  # PROCESS_PER_MONITOR_DPI
     except Exception:
         pass  # Qt will handle DPI awareness by default
 
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1] + qt_args)
     window = MainWindow()
     window.show()
     sys.exit(app.exec()) 
\ No newline at end of file
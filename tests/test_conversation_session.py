@@ -0,0 +1,79 @@
+import threading
+
+from AI_Assistant import ConversationSession
+
+
+def make_session():
+    """A session already past its token budget"""
+    session = ConversationSession(token_budget=200, keep_recent_turns=1)
+    for i in range(6):
+        session.add_exchange(f"question {i} " + "word " * 30, f"answer {i} " + "word " * 30)
+    assert session.needs_compaction()
+    return session
+
+
+def blocking_summarizer(started, release):
+    def summarizer(previous_summary, turns):
+        started.set()
+        release.wait(5)
+        return "summary"
+    return summarizer
+
+
+def run_compaction(session, summarizer):
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(compacted=session.compact(summarizer)))
+    worker.start()
+    return worker, result
+
+
+def test_compact_keeps_recent_turns_and_summarizes_the_rest():
+    session = make_session()
+
+    assert session.compact(lambda previous_summary, turns: "summary")
+    assert session.summary == "summary"
+    assert [t['text'].split()[:2] for t in session.turns] == [['question', '5'], ['answer', '5']]
+
+
+def test_exchange_added_while_summarizing_is_kept():
+    session = make_session()
+    started, release = threading.Event(), threading.Event()
+    worker, result = run_compaction(session, blocking_summarizer(started, release))
+    assert started.wait(5)
+
+    session.add_exchange("late question", "late answer")
+    release.set()
+    worker.join(5)
+
+    assert result['compacted']
+    assert [t['text'] for t in session.turns[-2:]] == ["late question", "late answer"]
+
+
+def test_only_one_compaction_runs_at_a_time():
+    session = make_session()
+    started, release = threading.Event(), threading.Event()
+    worker, result = run_compaction(session, blocking_summarizer(started, release))
+    assert started.wait(5)
+
+    assert not session.compact(lambda previous_summary, turns: "other summary")
+    release.set()
+    worker.join(5)
+
+    assert result['compacted']
+    assert session.summary == "summary"
+
+
+def test_clear_while_summarizing_discards_the_compaction():
+    session = make_session()
+    started, release = threading.Event(), threading.Event()
+    worker, result = run_compaction(session, blocking_summarizer(started, release))
+    assert started.wait(5)
+
+    session.clear()
+    session.add_exchange("fresh question", "fresh answer")
+    release.set()
+    worker.join(5)
+
+    assert not result['compacted']
+    assert session.summary == ""
+    assert [t['text'] for t in session.turns] == ["fresh question", "fresh answer"]
@@ -0,0 +1,33 @@
+import threading
+import time
+
+import pytest
+
+import AI_Assistant
+from AI_Assistant import DocumentSummarizer, LLMResponse, ResponseCache
+
+
+def test_failed_chunk_cancels_the_remaining_requests(tmp_path, monkeypatch):
+    document = tmp_path / 'notes.txt'
+    document.write_text(" ".join(f"word{i}" for i in range(200)))
+    calls = []
+    lock = threading.Lock()
+
+    def fake_generate(prompt, model_name=None, generation_config=None, cancel_token=None, purpose='chat'):
+        with lock:
+            calls.append(prompt)
+            first = len(calls) == 1
+        if first:
+            raise ValueError("bad chunk")
+        time.sleep(0.05)
+        return LLMResponse("summary")
+
+    monkeypatch.setattr(AI_Assistant, 'llm_generate', fake_generate)
+    summarizer = DocumentSummarizer('fake', concurrency=2, chunk_words=10,
+                                    cache=ResponseCache(path=str(tmp_path / 'cache.json')))
+
+    with pytest.raises(ValueError):
+        summarizer.summarize(str(document))
+
+    # 20 chunks; only the ones already running when the first one failed were sent
+    assert len(calls) <= 3
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import AI_Assistant
+from AI_Assistant import CancelToken, FakeBackend, HedgePolicy, LLMResponse, llm_stream_hedged
+
+
+class StuckPrimaryBackend(FakeBackend):
+    """The first stream never produces a chunk until it is cancelled; later streams answer right away"""
+    def __init__(self):
+        super().__init__(first_token_latency=0, token_latency=0)
+        self.calls = 0
+        self.timeouts = []
+        self.primary_released = threading.Event()
+
+    def stream(self, contents, model_name=None, generation_config=None, safety_settings=None, timeout=None, tools=None,
+               cancel_token=None):
+        self.calls += 1
+        self.timeouts.append(timeout)
+        if self.calls == 1:
+            cancel_token.wait(10)
+            self.primary_released.set()
+            raise ConnectionError("stream closed")
+        yield LLMResponse("hedged answer", model_name=model_name)
+
+
+def hedge_policy():
+    return HedgePolicy(enabled=True, default_delay=0.05, max_hedge_rate=1.0)
+
+
+def test_loser_is_cancelled_as_soon_as_the_hedge_wins(monkeypatch):
+    backend = StuckPrimaryBackend()
+    monkeypatch.setattr(AI_Assistant, 'llm_backend', backend)
+    policy = hedge_policy()
+
+    chunks = list(llm_stream_hedged("hello", 'gemini-2.0-flash', deadline=5, policy=policy))
+
+    assert [chunk.text for chunk in chunks] == ["hedged answer"]
+    assert backend.primary_released.wait(1)
+    assert policy.counts['hedge_wins'] == 1
+
+
+def test_hedge_shares_the_primary_deadline(monkeypatch):
+    backend = StuckPrimaryBackend()
+    monkeypatch.setattr(AI_Assistant, 'llm_backend', backend)
+
+    list(llm_stream_hedged("hello", 'gemini-2.0-flash', deadline=2, policy=hedge_policy()))
+
+    primary_timeout, hedge_timeout = backend.timeouts
+    assert hedge_timeout < primary_timeout <= 2
+
+
+def test_outer_cancel_stops_waiting_without_polling(monkeypatch):
+    monkeypatch.setattr(AI_Assistant, 'llm_backend', FakeBackend(first_token_latency=10))
+    policy = HedgePolicy(enabled=True, default_delay=5, max_hedge_rate=1.0)
+    cancel_token = CancelToken()
+    threading.Timer(0.05, cancel_token.cancel).start()
+
+    started = time.monotonic()
+    assert list(llm_stream_hedged("hello", 'gemini-2.0-flash', cancel_token=cancel_token, deadline=30,
+                                  policy=policy)) == []
+    assert time.monotonic() - started < 1
@@ -0,0 +1,200 @@
+import time
+
+import pytest
+
+from AI_Assistant import CircuitBreaker, CircuitOpenError, FakeBackend, ResilientCaller
+
+
+class ApiError(Exception):
+    """Stand-in for a google.api_core error carrying an HTTP code"""
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def make_caller(**kwargs):
+    kwargs.setdefault('base_delay', 0.001)
+    kwargs.setdefault('max_delay', 0.002)
+    return ResilientCaller(**kwargs)
+
+
+def flaky(*outcomes):
+    """fn(timeout) that raises or returns each outcome in turn, and records the timeouts it was given"""
+    outcomes = list(outcomes)
+
+    def fn(timeout):
+        fn.timeouts.append(timeout)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    fn.timeouts = []
+    return fn
+
+
+@pytest.mark.parametrize('code', [429, 503])
+def test_retries_server_errors_with_backoff(code):
+    caller = make_caller(max_retries=3)
+    fn = flaky(ApiError(code), ApiError(code), "ok")
+
+    assert caller.call(fn) == "ok"
+    assert len(fn.timeouts) == 3
+    assert caller.metrics()['retries'] == 2
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_backoff_delay_is_capped():
+    caller = ResilientCaller(base_delay=0.5, max_delay=2.0)
+    assert all(0 <= caller.backoff_delay(attempt) <= 2.0 for attempt in range(10))
+
+
+def test_client_error_is_not_retried_and_does_not_open_the_circuit():
+    caller = make_caller(max_retries=3, breaker=CircuitBreaker(failure_threshold=1))
+    fn = flaky(ApiError(400), "ok")
+
+    with pytest.raises(ApiError):
+        caller.call(fn)
+    assert len(fn.timeouts) == 1
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+    assert caller.breaker.failures == 0
+
+
+def test_gives_up_after_max_retries():
+    caller = make_caller(max_retries=2)
+    fn = flaky(ApiError(503), ApiError(503), ApiError(503), "ok")
+
+    with pytest.raises(ApiError):
+        caller.call(fn)
+    assert len(fn.timeouts) == 3
+
+
+def test_deadline_exceeded():
+    caller = make_caller(max_retries=5)
+
+    def slow_failure(timeout):
+        slow_failure.timeouts.append(timeout)
+        time.sleep(0.03)
+        raise TimeoutError("backend timed out")
+    slow_failure.timeouts = []
+
+    with pytest.raises(TimeoutError, match="deadline exceeded"):
+        caller.call(slow_failure, deadline=0.05)
+    assert slow_failure.timeouts[0] <= 0.05
+    assert len(slow_failure.timeouts) < 6
+    assert caller.metrics()['deadline_exceeded'] == 1
+
+
+def test_breaker_opens_then_half_opens_then_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    caller = make_caller(max_retries=0, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(ApiError):
+            caller.call(flaky(ApiError(503)))
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        caller.call(flaky("ok"))
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # Only one trial call at a time
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert caller.call(flaky("ok")) == "ok"
+
+
+def test_failed_half_open_trial_reopens_the_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    caller = make_caller(max_retries=0, breaker=breaker)
+
+    with pytest.raises(ApiError):
+        caller.call(flaky(ApiError(503)))
+    time.sleep(0.06)
+    with pytest.raises(ApiError):
+        caller.call(flaky(ApiError(503)))
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        caller.call(flaky("ok"))
+
+
+def test_stream_retries_until_the_first_chunk():
+    caller = make_caller(max_retries=3)
+    backend = FakeBackend(first_token_latency=0, token_latency=0)
+    attempts = []
+
+    def fn(timeout):
+        attempts.append(timeout)
+        if len(attempts) == 1:
+            raise ApiError(503)
+        return backend.stream("hello there")
+
+    text = "".join(chunk.text for chunk in caller.call_stream(fn))
+
+    assert len(attempts) == 2
+    assert text.startswith("You asked: hello there.")
+
+
+def test_stream_is_not_retried_after_the_first_chunk():
+    caller = make_caller(max_retries=3)
+    attempts = []
+
+    def fn(timeout):
+        attempts.append(timeout)
+
+        def chunks():
+            yield "first "
+            raise ApiError(503)
+        return chunks()
+
+    received = []
+    with pytest.raises(ApiError):
+        for chunk in caller.call_stream(fn):
+            received.append(chunk)
+
+    assert received == ["first "]
+    assert len(attempts) == 1
+    assert caller.metrics()['stream_failures'] == 1
+
+
+def test_non_retryable_error_does_not_clear_accumulated_failures():
+    breaker = CircuitBreaker(failure_threshold=3)
+    caller = make_caller(max_retries=0, breaker=breaker)
+
+    for error in (ApiError(503), ApiError(400), TypeError("garbage response"), ApiError(503)):
+        with pytest.raises(type(error)):
+            caller.call(flaky(error))
+
+    # The client error left the count alone; the malformed-response error counted
+    assert breaker.failures == 3
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_client_error_during_half_open_trial_allows_the_next_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    caller = make_caller(max_retries=0, breaker=breaker)
+
+    with pytest.raises(ApiError):
+        caller.call(flaky(ApiError(503)))
+    time.sleep(0.06)
+    with pytest.raises(ApiError):
+        caller.call(flaky(ApiError(400)))
+
+    assert breaker.failures == 1
+    assert caller.call(flaky("ok")) == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_spent_deadline_does_not_leave_the_breaker_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    caller = make_caller(max_retries=0, breaker=breaker)
+
+    with pytest.raises(ApiError):
+        caller.call(flaky(ApiError(503)))
+    time.sleep(0.06)
+    with pytest.raises(TimeoutError):
+        caller.call(flaky("ok"), deadline=0)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert caller.call(flaky("ok")) == "ok"
@@ -0,0 +1,17 @@
+from AI_Assistant import ModelRegistry
+
+
+def test_switch_to_unknown_model_keeps_the_old_clients():
+    registry = ModelRegistry()
+    old_client = registry.get_model('gemini-2.0-flash')
+
+    assert registry.switch_model('gemini-2.0-flash', 'gemini-2.0-flsh') == 'gemini-2.0-flash'
+    assert registry.get_model('gemini-2.0-flash') is old_client
+
+
+def test_switch_to_known_model_drops_the_old_clients():
+    registry = ModelRegistry()
+    old_client = registry.get_model('gemini-2.0-flash')
+
+    assert registry.switch_model('gemini-2.0-flash', 'gemini-1.5-pro') == 'gemini-1.5-pro'
+    assert registry.get_model('gemini-2.0-flash') is not old_client
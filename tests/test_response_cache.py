@@ -0,0 +1,31 @@
+import threading
+
+from AI_Assistant import ResponseCache
+
+
+def test_concurrent_saves_leave_a_readable_cache(tmp_path):
+    path = tmp_path / 'cache.json'
+    cache = ResponseCache(path=str(path))
+    for i in range(200):
+        cache.put(f"question {i}", 'gemini-2.0-flash', f"answer {i} " * 20)
+
+    threads = [threading.Thread(target=cache.save) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reloaded = ResponseCache(path=str(path))
+    assert reloaded.get("question 199", 'gemini-2.0-flash') == "answer 199 " * 20
+    assert [p.name for p in tmp_path.iterdir()] == ['cache.json']
+
+
+def test_put_saves_once_per_interval(tmp_path, monkeypatch):
+    cache = ResponseCache(path=str(tmp_path / 'cache.json'))
+    saves = []
+    monkeypatch.setattr(cache, 'save', lambda: saves.append(1))
+
+    for i in range(5):
+        cache.put(f"question {i}", 'gemini-2.0-flash', "answer")
+
+    assert len(saves) == 1
@@ -0,0 +1,33 @@
+from AI_Assistant import CameraAnalyzer, ResponseBudget
+
+
+def parse(text):
+    return CameraAnalyzer.parse_structured_analysis(None, text)
+
+
+def test_complete_object():
+    assert parse('{"description": "A desk.", "answer": "Yes.", "spoken": "A desk."}') == ("A desk.", "Yes.", "A desk.")
+
+
+def test_plain_text_is_used_as_the_description():
+    assert parse("A desk with a laptop.") == ("A desk with a laptop.", "", "")
+
+
+def test_cut_off_object_keeps_whole_sentences():
+    text = '```json\n{"description": "A desk with a laptop. A mug sits to the le'
+    assert parse(text) == ("A desk with a laptop.", "", "")
+
+
+def test_cut_off_answer_keeps_the_finished_fields():
+    text = '{"description": "A cat on a sofa.", "answer": "It is orange. It looks asl'
+    assert parse(text) == ("A cat on a sofa.", "It is orange.", "")
+
+
+def test_cut_off_before_the_description_is_empty_not_the_raw_fragment():
+    assert parse('{"descr') == ("", "", "")
+
+
+def test_generation_config_leaves_room_for_json():
+    budget = ResponseBudget(spoken_words=35, chat_words=250)
+    config = budget.generation_config({"max_output_tokens": 1024}, extra_tokens=64)
+    assert config['max_output_tokens'] == budget.max_output_tokens() + 64
@@ -0,0 +1,52 @@
+import types
+
+from AI_Assistant import MainWindow, ModelRouter, ResponseCache, TurnDeadline
+
+
+def make_window(tmp_path):
+    """Just the parts of MainWindow that cached_answer uses"""
+    return types.SimpleNamespace(
+        response_cache=ResponseCache(path=str(tmp_path / 'cache.json')),
+        model_router=ModelRouter(),
+    )
+
+
+def test_take_leaves_reserve_for_later_stages():
+    turn = TurnDeadline(budget=25, low_threshold=6)
+    assert turn.take(5, reserve=8, minimum=1) == 5
+    assert turn.take(30, reserve=8, minimum=1) < 17.1
+    assert not turn.is_low()
+
+
+def test_take_never_goes_below_minimum():
+    turn = TurnDeadline(budget=2, low_threshold=6)
+    assert turn.is_low()
+    assert turn.take(10, reserve=5, minimum=1) == 1
+
+
+def test_low_budget_falls_back_to_any_tier(tmp_path):
+    window = make_window(tmp_path)
+    window.response_cache.put("what is the capital of france", 'gemini-1.5-pro', "Paris.")
+
+    assert MainWindow.cached_answer(window, "what is the capital of france", 'gemini-2.0-flash-lite', True) == "Paris."
+
+
+def test_low_budget_miss_returns_none(tmp_path):
+    window = make_window(tmp_path)
+
+    assert MainWindow.cached_answer(window, "what is the capital of france", 'gemini-2.0-flash-lite', True) is None
+
+
+def test_low_budget_uses_configured_router_models(tmp_path):
+    window = make_window(tmp_path)
+    window.model_router = ModelRouter(strong_model='my-custom-model')
+    window.response_cache.put("what is the capital of france", 'my-custom-model', "Paris.")
+
+    assert MainWindow.cached_answer(window, "what is the capital of france", 'gemini-2.0-flash-lite', True) == "Paris."
+
+
+def test_normal_budget_only_uses_the_routed_model(tmp_path):
+    window = make_window(tmp_path)
+    window.response_cache.put("what is the capital of france", 'gemini-1.5-pro', "Paris.")
+
+    assert MainWindow.cached_answer(window, "what is the capital of france", 'gemini-2.0-flash-lite') is None
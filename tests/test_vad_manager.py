@@ -0,0 +1,50 @@
+import types
+
+from AI_Assistant import VADManager
+
+
+def make_vad():
+    vad = VADManager(hangover_ms=90, max_utterance_ms=3000)
+    # Frames are tagged by their first byte: odd tags are speech
+    vad.vad = types.SimpleNamespace(is_speech=lambda frame, sample_rate: bool(frame[0] % 2))
+    return vad
+
+
+def frame(vad, tag):
+    return bytes([tag]) * vad.frame_bytes
+
+
+def tags(vad, utterance):
+    return [utterance[offset] for offset in range(0, len(utterance), vad.frame_bytes)]
+
+
+def run(vad, frame_tags):
+    """Feed tagged frames and return (started utterance tags, ended utterance tags)"""
+    started = ended = None
+    for tag in frame_tags:
+        state, utterance = vad.process_audio(frame(vad, tag))
+        if state is True:
+            started = tags(vad, utterance)
+        elif state is False:
+            ended = tags(vad, utterance)
+            break
+    return started, ended
+
+
+def test_utterance_starts_with_the_full_pre_roll():
+    vad = make_vad()
+    started, ended = run(vad, [2, 4, 6, 8, 11, 13, 15, 17, 19, 20, 22, 24])
+
+    assert started == [4, 6, 8, 11, 13, 15, 17, 19]
+    assert ended == [4, 6, 8, 11, 13, 15, 17, 19, 20, 22, 24]
+
+
+def test_early_trigger_after_a_previous_utterance_has_no_stale_frames():
+    vad = make_vad()
+    run(vad, [2, 4, 6, 8, 11, 13, 15, 17, 19, 20, 22, 24])
+
+    # Five voiced frames in a row trigger before the eight-frame pre-roll has filled
+    started, ended = run(vad, [31, 33, 35, 37, 39, 40, 42, 44])
+
+    assert started == [31, 33, 35, 37, 39]
+    assert ended == [31, 33, 35, 37, 39, 40, 42, 44]